@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012-2014 Geoff Wilson <gmwils@gmail.com>
 
+from cihui import cache
+from cihui import outbound
+from cihui import skritter as skritter_tokens
 from cihui.handler import api
 from cihui.handler import auth
 from cihui.handler import skritter
@@ -17,14 +20,21 @@ class CiHuiApplication(tornado.web.Application):
                  account_database,
                  list_database,
                  cookie_secret=None,
-                 debug=False):
+                 debug=False,
+                 page_cache_bytes=wordlist.PAGE_CACHE_BYTES):
 
         self.account_db = account_database
         self.list_db = list_database
+        self.page_cache = cache.LRUCache(page_cache_bytes, sizeof=len)
 
         self.skritter_client_id = os.environ.get('SKRITTER_OAUTH_CLIENT_ID')
         self.skritter_client_secret = os.environ.get('SKRITTER_OAUTH_CLIENT_SECRET')
         self.skritter_redirect_uri = os.environ.get('SKRITTER_REDIRECT_URI')
+        self.skritter_http = outbound.Client('skritter')
+        self.skritter_tokens = skritter_tokens.TokenManager(self.account_db,
+                                                            self.skritter_client_id,
+                                                            self.skritter_client_secret,
+                                                            self.skritter_http)
 
         settings = {'static_path': os.path.join(os.path.dirname(__file__), '../static'),
                     'template_path': os.path.join(os.path.dirname(__file__), '../templates'),
@@ -45,24 +55,43 @@ class CiHuiApplication(tornado.web.Application):
                      dict(account_db=self.account_db,
                           client_id=self.skritter_client_id,
                           client_secret=self.skritter_client_secret,
-                          redirect_uri=self.skritter_redirect_uri)),
+                          redirect_uri=self.skritter_redirect_uri,
+                          token_manager=self.skritter_tokens)),
                     (r'/api/account', api.APIAccountHandler,
                      dict(account_db=self.account_db)),
                     (r'/api/account/skritter$', api.APIAccountSkritterHandler,
                      dict(account_db=self.account_db,
                           client_id=self.skritter_client_id,
                           client_secret=self.skritter_client_secret,
-                          redirect_uri=self.skritter_redirect_uri)),
+                          redirect_uri=self.skritter_redirect_uri,
+                          token_manager=self.skritter_tokens)),
                     (r'/api/list', api.APIListHandler,
                      dict(account_db=self.account_db,
                           list_db=self.list_db)),
+                    (r'/api/list/([0-9]+)$', api.APIListUpdateHandler,
+                     dict(account_db=self.account_db,
+                          list_db=self.list_db)),
+                    (r'/api/list/([0-9]+)/skritter$', api.APIListSkritterHandler,
+                     dict(account_db=self.account_db,
+                          list_db=self.list_db)),
+                    (r'/api/list/([0-9]+)/skritter/([0-9]+)$', api.APIListSkritterHandler,
+                     dict(account_db=self.account_db,
+                          list_db=self.list_db)),
+                    (r'/api/stats', api.APIStatsHandler,
+                     dict(account_db=self.account_db,
+                          list_db=self.list_db,
+                          page_cache=self.page_cache,
+                          token_manager=self.skritter_tokens,
+                          skritter_http=self.skritter_http)),
                     (r'/atom.xml', wordlist.AtomHandler,
-                     dict(list_db=self.list_db)),
+                     dict(list_db=self.list_db, page_cache=self.page_cache)),
                     (r'/login', auth.LoginHandler,
                      dict(account_db=self.account_db)),
                     (r'/logout', auth.LogoutHandler),
+                    (r'/list/([0-9]+)/skritter$', skritter.ListPushHandler,
+                     dict(list_db=self.list_db)),
                     tornado.web.url(r'/list/([0-9]+)[^\.]*(\.?\w*)', wordlist.WordListHandler,
-                                    dict(list_db=self.list_db),
+                                    dict(list_db=self.list_db, page_cache=self.page_cache),
                                     name='list'),
                     (r'/user/(\w+)$', user.UserHandler,
                      dict(account_db=self.account_db)),
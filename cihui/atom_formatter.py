@@ -1,25 +1,84 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import datetime
 
-from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
 
 
-def format_atom(title=None, entries=[]):
-    feed_elem = ElementTree.Element('feed', {'xmlns': 'http://www.w3.org/2005/Atom'})
-    if title:
-        title_elem = ElementTree.SubElement(feed_elem, 'title')
-        title_elem.text = title
+ATOM_NS = 'http://www.w3.org/2005/Atom'
 
-    for entry in entries:
-        entry_elem = ElementTree.SubElement(feed_elem, 'entry')
+
+def format_date(value):
+    "RFC 3339 date for a datetime, taking naive datetimes as UTC"
+    if not isinstance(value, datetime.datetime):
+        return value
+    if value.tzinfo is None:
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value.isoformat()
+
+
+def format_attributes(attributes):
+    return ''.join(' %s=%s' % (key, quoteattr(value)) for key, value in attributes.items())
+
+
+class AtomWriter(object):
+    """Write an Atom feed a piece at a time, as it is built.
+
+    write is called with each piece of the document as bytes. Entries
+    are dicts of element names to text, except for link, which is the
+    href of the entry's alternate link, and updated, which may be a
+    datetime. Entries after the first max_entries are dropped.
+    """
+    def __init__(self, write, title=None, links=[], feed_id=None, updated=None,
+                 max_entries=None):
+        self.write = write
+        self.max_entries = max_entries
+        self.entries = 0
+
+        self.write_text('<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="%s">' % ATOM_NS)
+        if title:
+            self.write_element('title', title)
+        if feed_id:
+            self.write_element('id', feed_id)
+        if updated is not None:
+            self.write_element('updated', format_date(updated))
+        for link in links:
+            self.write_text('<link%s />' % format_attributes(link))
+
+    def add_entry(self, entry):
+        "Write an entry. Returns False if the feed is full"
+        if self.max_entries is not None and self.entries >= self.max_entries:
+            return False
+
+        pieces = ['<entry>']
         for key, value in entry.items():
             if key == 'link':
-                link_elem = ElementTree.SubElement(entry_elem, key,
-                                                   {'href': value,
-                                                    'rel': 'alternate'})
+                pieces.append('<link%s />' % format_attributes({'href': value,
+                                                                'rel': 'alternate'}))
             else:
-                sub_elem = ElementTree.SubElement(entry_elem, key)
-                sub_elem.text = value
+                pieces.append('<%s>%s</%s>' % (key, escape(format_date(value) or ''), key))
+        pieces.append('</entry>')
+
+        self.write_text(''.join(pieces))
+        self.entries += 1
+        return True
+
+    def close(self):
+        self.write_text('</feed>')
+
+    def write_element(self, name, text):
+        self.write_text('<%s>%s</%s>' % (name, escape(text), name))
+
+    def write_text(self, text):
+        self.write(text.encode('utf-8'))
+
+
+def format_atom(title=None, entries=[], links=[]):
+    pieces = []
+    writer = AtomWriter(pieces.append, title=title, links=links)
+    for entry in entries:
+        writer.add_entry(entry)
+    writer.close()
 
-    return ElementTree.tostring(feed_elem, encoding='utf-8')
+    return b''.join(pieces)
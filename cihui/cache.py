@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import collections
+import sys
+
+
+def approximate_size(value):
+    "Rough memory footprint in bytes of strings, numbers and containers of them"
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += approximate_size(key) + approximate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += approximate_size(item)
+
+    return size
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the total size of its values.
+
+    Each entry carries a version (eg. a modified_at timestamp); a lookup
+    with a different version is a miss and drops the entry.
+    """
+    def __init__(self, max_bytes, sizeof=approximate_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, version=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] != version:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, version=None):
+        if key in self.entries:
+            self._remove(key)
+
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        while self.bytes + size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        self.entries[key] = (value, version, size)
+        self.bytes += size
+
+    def invalidate(self, key):
+        if key in self.entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
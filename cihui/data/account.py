@@ -4,22 +4,136 @@
 from cihui.data import base
 
 import base64
+import concurrent.futures
 import functools
 import hashlib
 import hmac
+import logging
 import os
+import tornado.ioloop
+
+
+# PBKDF2 rounds for new digests; older digests are upgraded at login
+PASSWORD_ITERATIONS = 100000
+PASSWORD_SCHEME = 'pbkdf2_sha256'
+
+# Digests are computed on this many threads, with at most
+# PASSWORD_QUEUE_LIMIT waiting or running before logins are turned away
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE_LIMIT = 100
 
 
 def build_password_digest(password, salt):
+    "Legacy single round SHA-256 digest"
     password_hash = hashlib.sha256(salt.encode() + password.encode())
     password_digest = base64.b64encode(password_hash.digest())
 
     return password_digest
 
 
+def build_pbkdf2_digest(password, salt, iterations=PASSWORD_ITERATIONS):
+    password_hash = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return '%s$%d$%s' % (PASSWORD_SCHEME, iterations,
+                         base64.b64encode(password_hash).decode())
+
+
+def verify_password(password, salt, password_digest):
+    """Check a password against a stored digest.
+
+    Returns (valid, needs_rehash), where needs_rehash is True for legacy
+    digests and for digests with fewer than PASSWORD_ITERATIONS rounds.
+    """
+    if password_digest is None or salt is None:
+        return False, False
+
+    if password_digest.startswith(PASSWORD_SCHEME + '$'):
+        _, iterations, _ = password_digest.split('$', 2)
+        current_digest = build_pbkdf2_digest(password, salt, int(iterations))
+        needs_rehash = int(iterations) < PASSWORD_ITERATIONS
+    else:
+        current_digest = build_password_digest(password, salt).decode()
+        needs_rehash = True
+
+    valid = hmac.compare_digest(password_digest.encode(), current_digest.encode())
+    return valid, valid and needs_rehash
+
+
+def new_password_digest(password):
+    "Return a (digest, salt) for storing a new password"
+    # See: https://crackstation.net/hashing-security.htm
+    salt = base64.b64encode(os.urandom(64)).decode()
+    return build_pbkdf2_digest(password, salt), salt
+
+
+class PasswordQueueFullError(Exception):
+    "A password digest was refused because too many are already waiting"
+
+
+class PasswordHasher(object):
+    """Runs password digests on a thread pool, off the IOLoop.
+
+    Callbacks run on the IOLoop that submitted the work. When `queue_limit`
+    digests are already waiting or running, new work is refused and the
+    callback receives None and a PasswordQueueFullError.
+    """
+    def __init__(self, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, callback, fn, *args):
+        if self.pending >= self.queue_limit:
+            self.rejected += 1
+            logging.warning('Password queue full (%d pending)', self.pending)
+            callback(None, PasswordQueueFullError('%d password digests pending' % self.pending))
+            return
+
+        self.pending += 1
+        future = self.executor.submit(fn, *args)
+        tornado.ioloop.IOLoop.current().add_future(
+            future, functools.partial(self._on_done, callback))
+
+    def _on_done(self, callback, future):
+        self.pending -= 1
+        self.completed += 1
+
+        try:
+            result = future.result()
+        except Exception:
+            logging.exception('Error computing password digest')
+            result = None
+
+        callback(result)
+
+    def stats(self):
+        return {'workers': self.workers,
+                'pending': self.pending,
+                'queue_limit': self.queue_limit,
+                'completed': self.completed,
+                'rejected': self.rejected}
+
+
+def account_from_row(result):
+    return {'account_id': result[0],
+            'account_email': result[1],
+            'account_name': result[2],
+            'created_at': result[3],
+            'modified_at': result[4],
+            'skritter_user': result[5],
+            'skritter_access_token': result[6],
+            'skritter_refresh_token': result[7],
+            'skritter_token_expiry': result[8]}
+
+
 class AccountData(base.AsyncDatabase):
-    def __init__(self, db_url, db=None):
+    def __init__(self, db_url, db=None, hasher=None):
         super(AccountData, self).__init__(db_url, db)
+        self.hasher = hasher or PasswordHasher()
+        self.rehashed = 0
         self.get_account_fields = ','.join(['id',
                                             'email',
                                             'name',
@@ -30,6 +144,11 @@ class AccountData(base.AsyncDatabase):
                                             'skritter_refresh_token',
                                             'skritter_token_expiry'])
 
+    def stats(self):
+        stats = super(AccountData, self).stats()
+        stats['passwords'] = dict(self.hasher.stats(), rehashed=self.rehashed)
+        return stats
+
     def authenticate_api_user(self, user, passwd):
         valid_user = os.environ.get('API_USER', 'user')
         valid_passwd = os.environ.get('API_PASS', 'secret')
@@ -40,8 +159,10 @@ class AccountData(base.AsyncDatabase):
 
         cb_id = self.add_callback(callback, user)
         cb = functools.partial(self._on_authenticate_web_user, passwd, next_url, cb_id)
-        self.db.execute('SELECT id, email, password_hash, password_salt FROM account WHERE email = %s', (user,),
-                        callback=cb)
+        self.execute('authenticate_web_user',
+                     'SELECT id, email, password_hash, password_salt FROM account WHERE lower(email) = lower(%s)'
+                     ' ORDER BY email = %s DESC NULLS LAST, id LIMIT 1', (user, user),
+                     callback=cb, cb_id=cb_id)
 
     def _on_authenticate_web_user(self, passwd, next_url, cb_id, cursor, error=None):
         callback, user = self.get_callback(cb_id)
@@ -57,66 +178,145 @@ class AccountData(base.AsyncDatabase):
             password_hash = result[2]
             password_salt = result[3]
 
-            current_digest = build_password_digest(passwd, password_salt)
-
-            if hmac.compare_digest(password_hash.encode(), current_digest):
-                # TODO(gmwils): return user id instead of email
-                callback(account_id, next_url, account_email)
-                return
+            cb = functools.partial(self._on_password_checked, account_id, account_email,
+                                   passwd, password_hash, next_url, callback)
+            self.hasher.submit(cb, verify_password, passwd, password_salt, password_hash)
+            return
 
         callback()
 
+    def _on_password_checked(self, account_id, account_email, passwd, password_hash,
+                             next_url, callback, result, error=None):
+        if error is not None:
+            callback(error=error)
+            return
+
+        if result is None or not result[0]:
+            callback()
+            return
+
+        if result[1]:
+            cb = functools.partial(self._on_password_rehashed, account_id, password_hash)
+            self.hasher.submit(cb, new_password_digest, passwd)
+
+        # TODO(gmwils): return user id instead of email
+        callback(account_id, next_url, account_email)
+
+    def _on_password_rehashed(self, account_id, old_password_hash, result, error=None):
+        if result is None:
+            return
+
+        # Leave the digest alone if the password changed in the meantime
+        password_digest, password_salt = result
+        self.execute('rehash_password',
+                     'UPDATE account SET password_hash=%s, password_salt=%s WHERE id=%s AND password_hash=%s',
+                     (password_digest, password_salt, account_id, old_password_hash),
+                     callback=functools.partial(self._on_store_rehashed, account_id))
+
+    def _on_store_rehashed(self, account_id, cursor, error=None):
+        if error is not None:
+            logging.error('Error storing new password digest for %s: %s', account_id, error)
+        elif cursor is not None and cursor.rowcount == 1:
+            self.rehashed += 1
+
     def get_account(self, email, callback):
         cb_id = self.add_callback(callback, email)
         cb = functools.partial(self._on_get_account_response, cb_id)
 
-        self.db.execute('SELECT ' + self.get_account_fields +
-                        ' FROM account WHERE email = %s;',
-                        (email,),
-                        callback=cb)
+        self.execute('get_account',
+                     'SELECT ' + self.get_account_fields +
+                     ' FROM account WHERE lower(email) = lower(%s) ORDER BY email = %s DESC NULLS LAST, id LIMIT 1;',
+                     (email, email),
+                     callback=cb, cb_id=cb_id)
 
     def get_account_by_id(self, account_id, callback):
         cb_id = self.add_callback(callback, account_id)
         cb = functools.partial(self._on_get_account_response, cb_id)
 
-        self.db.execute('SELECT ' + self.get_account_fields +
-                        ' FROM account WHERE id = %s;',
-                        (account_id,),
-                        callback=cb)
+        self.execute('get_account_by_id',
+                     'SELECT ' + self.get_account_fields +
+                     ' FROM account WHERE id = %s;',
+                     (account_id,),
+                     callback=cb, cb_id=cb_id)
 
     def _on_get_account_response(self, cb_id, cursor, error=None):
         callback, email = self.get_callback(cb_id)
 
         if cursor is None or cursor.rowcount == 0:
             callback(None)
+            return
 
         result = cursor.fetchone()
         response = {}
 
         if result is not None and len(result) >= 5:
-            response['account_id'] = result[0]
-            response['account_email'] = result[1]
-            response['account_name'] = result[2]
-            response['created_at'] = result[3]
-            response['modified_at'] = result[4]
-            response['skritter_user'] = result[5]
-            response['skritter_access_token'] = result[6]
-            response['skritter_refresh_token'] = result[7]
-            response['skritter_token_expiry'] = result[8]
+            response = account_from_row(result)
 
         callback(response)
 
+    def get_accounts(self, callback, emails=(), account_ids=()):
+        """Fetch the accounts with any of the emails or ids in one query.
+
+        Emails match without regard to case. The callback receives a list
+        of accounts in the form get_account returns, ordered by id, or None
+        on error.
+        """
+        cb_id = self.add_callback(callback)
+        cb = functools.partial(self._on_get_accounts_response, cb_id)
+
+        self.execute('get_accounts',
+                     'SELECT ' + self.get_account_fields +
+                     ' FROM account WHERE lower(email) = ANY(%s) OR id = ANY(%s) ORDER BY id;',
+                     ([email.lower() for email in emails], list(account_ids)),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_get_accounts_response(self, cb_id, cursor, error=None):
+        callback, _ = self.get_callback(cb_id)
+
+        if error is not None or cursor is None:
+            logging.warning('Error fetching accounts: %s', error)
+            callback(None)
+            return
+
+        callback([account_from_row(result) for result in cursor])
+
+    def get_expiring_skritter_accounts(self, expires_before, callback, limit=100, exclude_ids=()):
+        """Fetch up to limit accounts with a Skritter refresh token whose
+        access token expires before expires_before, soonest first, other
+        than those in exclude_ids.
+
+        The callback receives a list of accounts, or None on error.
+        """
+        cb_id = self.add_callback(callback)
+        cb = functools.partial(self._on_get_accounts_response, cb_id)
+
+        self.execute('get_expiring_skritter_accounts',
+                     'SELECT ' + self.get_account_fields +
+                     ''' FROM account
+                         WHERE skritter_refresh_token IS NOT NULL AND skritter_token_expiry < %s
+                           AND id <> ALL(%s)
+                         ORDER BY skritter_token_expiry
+                         LIMIT %s;''',
+                     (expires_before, list(exclude_ids), limit),
+                     callback=cb, cb_id=cb_id)
+
     def create_account(self, email, passwd, callback):
+        cb = functools.partial(self._on_create_account_digest, email, callback)
+        self.hasher.submit(cb, new_password_digest, passwd)
+
+    def _on_create_account_digest(self, email, callback, result, error=None):
+        if result is None:
+            callback(None)
+            return
+
         cb_id = self.add_callback(callback, email)
         cb = functools.partial(self._on_create_account_response, cb_id)
 
-        # See: https://crackstation.net/hashing-security.htm
-        passwd_salt = base64.b64encode(os.urandom(64)).decode()
-        passwd_digest = build_password_digest(passwd, passwd_salt)
-
-        self.db.execute('INSERT INTO account (email, password_hash, password_salt) VALUES (%s, %s, %s) RETURNING id',
-                        (email, passwd_digest.decode(), passwd_salt),
-                        callback=cb)
+        passwd_digest, passwd_salt = result
+        self.execute('create_account',
+                     'INSERT INTO account (email, password_hash, password_salt) VALUES (%s, %s, %s) RETURNING id',
+                     (email, passwd_digest, passwd_salt),
+                     callback=cb, cb_id=cb_id)
 
     def _on_create_account_response(self, cb_id, cursor, error=None):
         callback, email = self.get_callback(cb_id)
@@ -132,9 +332,10 @@ class AccountData(base.AsyncDatabase):
         cb_id = self.add_callback(callback, account_id)
         cb = functools.partial(self._on_update_account_response, cb_id)
 
-        self.db.execute('UPDATE account SET email=%s, name=%s WHERE id=%s',
-                        (email, username, account_id),
-                        callback=cb)
+        self.execute('update_account',
+                     'UPDATE account SET email=%s, name=%s WHERE id=%s',
+                     (email, username, account_id),
+                     callback=cb, cb_id=cb_id)
 
     def _on_update_account_response(self, cb_id, cursor, error=None):
         callback, account_id = self.get_callback(cb_id)
@@ -151,6 +352,7 @@ class AccountData(base.AsyncDatabase):
         cb_id = self.add_callback(callback, account_id)
         cb = functools.partial(self._on_update_account_response, cb_id)
 
-        self.db.execute('UPDATE account SET skritter_user_id=%s, skritter_access_token=%s, skritter_refresh_token=%s, skritter_token_expiry=%s WHERE id=%s',
-                        (skritter_user_id, access_token, refresh_token, expiry_date, account_id),
-                        callback=cb)
+        self.execute('store_skritter_token',
+                     'UPDATE account SET skritter_user_id=%s, skritter_access_token=%s, skritter_refresh_token=%s, skritter_token_expiry=%s WHERE id=%s',
+                     (skritter_user_id, access_token, refresh_token, expiry_date, account_id),
+                     callback=cb, cb_id=cb_id)
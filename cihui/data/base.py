@@ -2,42 +2,223 @@
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
 from cihui.data import database_url
+
+import bisect
+import collections
+import functools
+import logging
 import momoko
+import time
+import tornado.ioloop
 
 
-class BaseDatabase(object):
-    def __init__(self):
-        self.callback_counter = 0
-        # TODO(gmwils): Ensure the dict doesn't grow forever. Compact somehow
-        self.callbacks = {}
+# Defaults for the pending callback registry
+CALLBACK_LIMIT = 10000
+CALLBACK_TIMEOUT = 300  # seconds
+CALLBACK_SWEEP_INTERVAL = 30  # seconds
 
-    def add_callback(self, cb, rock=''):
-        cb_counter = self.callback_counter
-        self.callback_counter += 1
-        cb_id = '%d|%s' % (cb_counter, rock)
+# Upper bounds of the query latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SLOW_QUERY_MS = 500
+
+
+class CallbackExpiredError(Exception):
+    "The result for a database callback did not arrive before it expired"
+
+
+class CallbackRegistry(object):
+    """Callbacks waiting on a database result, keyed by an integer id.
+
+    An entry is removed when its result arrives, when it is older than
+    `timeout` seconds, or when the registry is full and it is the oldest.
+    Expired entries are swept periodically on the IOLoop. An entry with
+    an expiry handler, set by set_expiry, has it called as it expires, so
+    the caller still gets a result.
+    """
+    def __init__(self, limit=CALLBACK_LIMIT, timeout=CALLBACK_TIMEOUT,
+                 sweep_interval=CALLBACK_SWEEP_INTERVAL):
+        self.limit = limit
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
 
-        self.callbacks[cb_id] = cb
+        self.counter = 0
+        self.entries = collections.OrderedDict()
+        self.expired = 0
+        self.completed = 0
+        self.sweeper = None
+        self.expiring = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, cb_id):
+        return cb_id in self.entries
+
+    def add(self, callback, rock=''):
+        if len(self.entries) >= self.limit:
+            self.sweep()
+            while len(self.entries) >= self.limit:
+                self._expire_oldest()
+
+        cb_id = self.counter
+        self.counter += 1
+        # Deadlines only increase, so entries stay ordered by deadline
+        self.entries[cb_id] = (callback, rock, time.time() + self.timeout, None)
+
+        if self.sweeper is None:
+            self._start_sweeper()
 
         return cb_id
 
+    def get(self, cb_id):
+        "Return the (callback, rock) for cb_id without removing it"
+        entry = self.entries.get(cb_id)
+        if entry is None:
+            return None, None
+
+        return entry[0], entry[1]
+
+    def set_expiry(self, cb_id, on_expire):
+        "Call on_expire with no arguments if cb_id expires"
+        entry = self.entries.get(cb_id)
+        if entry is not None:
+            self.entries[cb_id] = entry[:3] + (on_expire,)
+
+    def pop(self, cb_id):
+        entry = self.entries.pop(cb_id, None)
+        if entry is None:
+            return None, None
+
+        if cb_id != self.expiring:
+            self.completed += 1
+        return entry[0], entry[1]
+
+    def sweep(self):
+        now = time.time()
+        while self.entries:
+            _, _, deadline, _ = next(iter(self.entries.values()))
+            if deadline > now:
+                break
+            self._expire_oldest()
+
+    def stats(self):
+        return {'outstanding': len(self.entries),
+                'expired': self.expired,
+                'completed': self.completed}
+
+    def _expire_oldest(self):
+        cb_id, (_, rock, _, on_expire) = next(iter(self.entries.items()))
+        self.expired += 1
+        logging.warning('Expired database callback %d (%s)', cb_id, rock)
+
+        # The handler usually pops the entry to reach the callback
+        if on_expire is not None:
+            self.expiring = cb_id
+            try:
+                on_expire()
+            except Exception:
+                logging.exception('Error expiring database callback %d', cb_id)
+            finally:
+                self.expiring = None
+        self.entries.pop(cb_id, None)
+
+    def _start_sweeper(self):
+        self.sweeper = tornado.ioloop.PeriodicCallback(self.sweep,
+                                                       self.sweep_interval * 1000)
+        self.sweeper.start()
+
+
+def params_shape(params):
+    "Describe query parameters by type and length, without their values"
+    shape = []
+    for param in params or []:
+        if isinstance(param, (list, tuple)):
+            shape.append('%s[%d]' % (type(param).__name__, len(param)))
+        else:
+            shape.append(type(param).__name__)
+
+    return '(%s)' % ', '.join(shape)
+
+
+class QueryStats(object):
+    """Latency, row and error counts per statement name.
+
+    Durations run from the call to execute until the result arrives, and
+    include the time spent waiting for a pool connection. Statements that
+    take slow_query_ms or longer are logged; None disables the log.
+    """
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self.statements = {}
+
+    def record(self, name, duration, pool_wait, rows, error, params=None):
+        stats = self.statements.get(name)
+        if stats is None:
+            stats = self.statements[name] = {'calls': 0, 'errors': 0, 'rows': 0,
+                                             'total_ms': 0.0, 'max_ms': 0.0,
+                                             'pool_wait_ms': 0.0,
+                                             'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+
+        duration_ms = duration * 1000
+        stats['calls'] += 1
+        stats['rows'] += rows
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+        stats['pool_wait_ms'] += pool_wait * 1000
+        stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, duration_ms)] += 1
+        if error is not None:
+            stats['errors'] += 1
+
+        if self.slow_query_ms is not None and duration_ms >= self.slow_query_ms:
+            logging.warning('Slow query %s%s: %.1fms (%.1fms waiting for a connection)',
+                            name, params_shape(params), duration_ms, pool_wait * 1000)
+
+    def stats(self):
+        labels = ['le_%d' % bound for bound in LATENCY_BUCKETS] + ['inf']
+        return dict((name, dict(stats, histogram=dict(zip(labels, stats['histogram']))))
+                    for name, stats in self.statements.items())
+
+
+def _discard_result(*args, **kwargs):
+    pass
+
+
+class BaseDatabase(object):
+    def __init__(self, callback_limit=CALLBACK_LIMIT, callback_timeout=CALLBACK_TIMEOUT):
+        self.callbacks = CallbackRegistry(callback_limit, callback_timeout)
+
+    def add_callback(self, cb, rock=''):
+        return self.callbacks.add(cb, rock)
+
     def get_callback(self, cb_id):
-        callback = self.callbacks.get(cb_id, None)
-        _, rock = cb_id.split('|', 2)
+        callback, rock = self.callbacks.pop(cb_id)
 
-        if callback is not None:
-            del self.callbacks[cb_id]
+        if callback is None:
+            logging.warning('Result arrived for expired database callback %s', cb_id)
+            callback = _discard_result
 
         return callback, rock
 
+    def callback_stats(self):
+        return self.callbacks.stats()
+
 
 class AsyncDatabase(BaseDatabase):
     def __init__(self, db_url, db=None):
         super(AsyncDatabase, self).__init__()
+        self.conn_lifetime = None
+        self.connection_opened = {}
+        self.query_stats = QueryStats()
 
         if db is not None:
             self.db = db
+        elif db_url.startswith('fake://'):
+            # Imported here as the fake backend depends on AccountData
+            from cihui.data import fake
+            self.db = fake.for_url(db_url)
         else:
             settings = database_url.build_settings_from_dburl(db_url)
+            self.query_stats.slow_query_ms = settings['slow_query_ms']
             if settings.get('user') is not None:
                 dsn = 'dbname=%s user=%s password=%s host=%s port=%s' % (
                     settings.get('database'),
@@ -51,4 +232,98 @@ class AsyncDatabase(BaseDatabase):
                     settings.get('host', 'localhost'),
                     settings.get('port', 5432))
 
-            self.db = momoko.Pool(dsn)
+            self.db = momoko.Pool(dsn,
+                                  size=settings['min_conn'],
+                                  max_size=settings['max_conn'])
+
+            if settings['conn_lifetime']:
+                self.conn_lifetime = settings['conn_lifetime']
+                self.recycler = tornado.ioloop.PeriodicCallback(
+                    self.recycle_connections,
+                    settings['cleanup_timeout'] * 1000)
+                self.recycler.start()
+
+    def execute(self, name, sql, params, callback, cb_id=None):
+        """Run sql on the pool, recording its timings under the statement name.
+
+        If cb_id expires first, callback is called with no cursor and a
+        CallbackExpiredError, and the late result is discarded.
+        """
+        if cb_id is not None:
+            error = CallbackExpiredError('No result for %s in %ss' % (name, self.callbacks.timeout))
+            self.callbacks.set_expiry(cb_id, functools.partial(callback, None, error))
+
+        started = time.time()
+        connected = [started]
+        queued = self._waiting_for_connection()
+
+        # The name comment identifies the statement in Postgres logs too
+        cb = functools.partial(self._on_execute, name, params, started, connected, callback)
+        self.db.execute('/* %s */ %s' % (name, sql), params, callback=cb)
+
+        if self._waiting_for_connection() > queued:
+            # No connection was free, so note when the pool hands one over
+            def on_connection(future):
+                connected[0] = time.time()
+
+            self.db._conns.waiting_queue[0].add_done_callback(on_connection)
+
+    def _on_execute(self, name, params, started, connected, callback, cursor, error=None):
+        rows = 0
+        if error is None and cursor is not None:
+            rows = max(cursor.rowcount, 0)
+
+        self.query_stats.record(name, time.time() - started, connected[0] - started,
+                                rows, error, params)
+        callback(cursor, error)
+
+    def _waiting_for_connection(self):
+        if not isinstance(self.db, momoko.Pool):
+            return 0
+
+        return len(self.db._conns.waiting_queue)
+
+    def recycle_connections(self):
+        "Close idle connections older than conn_lifetime so the pool reopens them"
+        if not isinstance(self.db, momoko.Pool):
+            return
+
+        # Ages are measured from the first sweep that sees a connection
+        conns = self.db._conns
+        now = time.time()
+        alive = conns.get_alive()
+        for conn in list(self.connection_opened):
+            if conn not in alive:
+                del self.connection_opened[conn]
+
+        for conn in list(conns.free):
+            opened = self.connection_opened.setdefault(conn, now)
+            if now - opened > self.conn_lifetime:
+                conns.free.discard(conn)
+                conn.close()
+                conns.dead.add(conn)
+                del self.connection_opened[conn]
+
+    def pool_stats(self):
+        return pool_stats(self.db)
+
+    def stats(self):
+        return {'callbacks': self.callback_stats(),
+                'pool': self.pool_stats(),
+                'queries': self.query_stats.stats()}
+
+
+def pool_stats(pool):
+    "Occupancy of a momoko pool, or an empty dict for other database objects"
+    if not isinstance(pool, momoko.Pool):
+        return {}
+
+    # Pool._conns is private to momoko 1.1, which requirements.txt pins
+    conns = pool._conns
+    return {'size': pool.size,
+            'max_size': pool.max_size,
+            'idle': len(conns.free),
+            'busy': len(conns.busy),
+            'waiting': len(conns.waiting_queue),
+            'pending': len(conns.pending),
+            'dead': len(conns.dead)}
@@ -2,12 +2,22 @@
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
 import dj_database_url
+import os
+import urllib.parse
 
 
-def build_settings_from_dburl(db_url, min_conn=1, max_conn=20, cleanup_timeout=10):
+# Pool settings that may be given as DATABASE_URL query parameters
+# (eg. ?max_conn=5) or environment variables (eg. DATABASE_MAX_CONN=5).
+POOL_SETTINGS = ['min_conn', 'max_conn', 'cleanup_timeout', 'conn_lifetime',
+                 'slow_query_ms']
+
+
+def build_settings_from_dburl(db_url, min_conn=1, max_conn=20, cleanup_timeout=10,
+                              conn_lifetime=None, slow_query_ms=500, environ=None):
     settings = {}
 
-    db_url_settings = dj_database_url.parse(db_url)
+    url, _, query = db_url.partition('?')
+    db_url_settings = dj_database_url.parse(url)
 
     mapping = {'NAME': 'database',
                'HOST': 'host',
@@ -21,5 +31,19 @@ def build_settings_from_dburl(db_url, min_conn=1, max_conn=20, cleanup_timeout=1
     settings['min_conn'] = min_conn
     settings['max_conn'] = max_conn
     settings['cleanup_timeout'] = cleanup_timeout
+    settings['conn_lifetime'] = conn_lifetime
+    settings['slow_query_ms'] = slow_query_ms
+
+    if environ is None:
+        environ = os.environ
+
+    query_params = urllib.parse.parse_qs(query)
+    for name in POOL_SETTINGS:
+        value = environ.get('DATABASE_' + name.upper())
+        if name in query_params:
+            value = query_params[name][-1]
+
+        if value is not None:
+            settings[name] = int(value)
 
     return settings
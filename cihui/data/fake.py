@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+"""In-memory stand-in for a momoko pool, for load tests and benchmarks.
+
+FakeDatabase answers the statements issued by AccountData and
+WordListData, identified by the /* name */ comment AsyncDatabase.execute
+puts in front of each query. Use it with a DATABASE_URL like
+
+    fake://?lists=1000&words=50&latency_ms=2&failure_rate=0.01
+
+Seeded accounts are user<n>@example.com, all with the password 'password'.
+"""
+
+from cihui.data import account
+from cihui.data import wordlist
+from cihui import uri
+
+import collections
+import datetime
+import functools
+import json
+import psycopg2
+import random
+import re
+import tornado.ioloop
+import urllib.parse
+
+
+STATEMENT_NAME = re.compile(r'^/\* (\w+) \*/ ')
+
+SEED_PASSWORD = 'password'
+
+# Settings that may be given as fake:// query parameters
+URL_SETTINGS = {'accounts': int, 'lists': int, 'words': int, 'seed': int,
+                'latency_ms': float, 'jitter_ms': float, 'failure_rate': float}
+
+_databases = {}
+
+
+class MissingWordError(psycopg2.Error):
+    "What require_list_word raises for patch_list"
+    pgcode = wordlist.MISSING_WORD_SQLSTATE
+
+
+@functools.lru_cache()
+def seed_password_digest():
+    "Digest and salt shared by seeded accounts, as PBKDF2 is slow on purpose"
+    return account.new_password_digest(SEED_PASSWORD)
+
+
+def for_url(db_url):
+    "The FakeDatabase for a fake:// url, shared by every caller using that url"
+    if db_url not in _databases:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(db_url).query)
+        settings = dict((name, URL_SETTINGS[name](values[-1]))
+                        for name, values in query.items() if name in URL_SETTINGS)
+
+        seed = dict((name, settings.pop(name)) for name in ['accounts', 'lists', 'words']
+                    if name in settings)
+        database = FakeDatabase(**settings)
+        database.seed(**seed)
+        _databases[db_url] = database
+
+    return _databases[db_url]
+
+
+class FakeCursor(object):
+    def __init__(self, rows=None, rowcount=None):
+        self.rows = list(rows or [])
+        self.rowcount = len(self.rows) if rowcount is None else rowcount
+
+    def __iter__(self):
+        rows, self.rows = self.rows, []
+        return iter(rows)
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class FakeDatabase(object):
+    """Accounts and lists held in dicts, answered after an artificial delay.
+
+    Each result is delivered on the IOLoop after latency_ms, plus up to
+    jitter_ms. failure_rate is the chance of any statement failing, and
+    statement names in fail_statements always fail.
+    """
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0, seed=None, ioloop=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.fail_statements = set()
+        self.random = random.Random(seed)
+        self.ioloop = ioloop
+
+        self.accounts = {}
+        self.lists = {}
+        self.list_words = {}  # list id -> [(position, zi, pinyin, definitions)]
+        self.skritter_pushes = {}
+        self.skritter_push_words = {}  # push id -> {word index: (zi, result)}
+        self.next_account_id = 1
+        self.next_list_id = 1
+        self.next_push_id = 1
+
+        self.calls = collections.Counter()
+        self.failures = collections.Counter()
+
+    def execute(self, sql, params=(), callback=None):
+        match = STATEMENT_NAME.match(sql)
+        if match is None:
+            raise ValueError('Statement has no name: %.40s' % sql)
+
+        name = match.group(1)
+        method = getattr(self, '_' + name, None)
+        if method is None:
+            raise NotImplementedError('No fake for statement %s' % name)
+
+        self.calls[name] += 1
+        if name in self.fail_statements or self.random.random() < self.failure_rate:
+            self.failures[name] += 1
+            result = (None, psycopg2.OperationalError('Injected failure in %s' % name))
+        else:
+            try:
+                result = (method(sql[match.end():], list(params)), None)
+            except psycopg2.Error as error:
+                result = (None, error)
+
+        if callback is not None:
+            self._respond(callback, *result)
+
+    def _respond(self, callback, cursor, error):
+        ioloop = self.ioloop or tornado.ioloop.IOLoop.current()
+        delay = self.latency_ms + self.random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            ioloop.add_timeout(ioloop.time() + delay / 1000.0,
+                               lambda: callback(cursor, error))
+        else:
+            ioloop.add_callback(callback, cursor, error)
+
+    def seed(self, accounts=10, lists=0, words=20):
+        "Add accounts, and public lists of words spread across them"
+        password_hash, password_salt = seed_password_digest()
+
+        account_ids = []
+        for n in range(accounts):
+            account_ids.append(self.add_account('user%d@example.com' % (len(self.accounts) + 1),
+                                                password_hash, password_salt))
+
+        for n in range(lists):
+            self.add_list('List %d' % (len(self.lists) + 1),
+                          [['字%d' % i, 'zi%d' % (i % 5), ['word %d' % i]] for i in range(words)],
+                          account_ids[n % len(account_ids)] if account_ids else None)
+
+    def add_account(self, email, password_hash=None, password_salt=None, name=None):
+        now = datetime.datetime.now()
+        account_id = self.next_account_id
+        self.next_account_id += 1
+        self.accounts[account_id] = {'id': account_id, 'email': email, 'name': name,
+                                     'password_hash': password_hash,
+                                     'password_salt': password_salt,
+                                     'created_at': now, 'modified_at': now,
+                                     'skritter_user_id': None,
+                                     'skritter_access_token': None,
+                                     'skritter_refresh_token': None,
+                                     'skritter_token_expiry': None}
+        return account_id
+
+    def add_list(self, title, words, account_id, public=True):
+        list_id = self.next_list_id
+        self.next_list_id += 1
+        self.lists[list_id] = {'id': list_id, 'title': title, 'stub': uri.title_to_stub(title),
+                               'public': public, 'account_id': account_id,
+                               'modified_at': datetime.datetime.utcnow()}
+        self._set_words(list_id, words)
+        return list_id
+
+    def _set_words(self, list_id, words):
+        self.list_words[list_id] = [(position, word[0], word[1], json.dumps(word[2]))
+                                    for position, word in enumerate(words)]
+        self.lists[list_id]['word_count'] = len(words)
+
+    def _set_word_columns(self, list_id, columns):
+        self.list_words[list_id] = list(zip(*columns))
+        self.lists[list_id]['word_count'] = len(self.list_words[list_id])
+
+    def _account_for(self, account_id, email=None):
+        if account_id in self.accounts:
+            return self.accounts[account_id]
+
+        if email is None:
+            return None
+
+        # An exact match wins over emails differing only by case
+        matches = sorted((row['email'] != email, row['id']) for row in self.accounts.values()
+                         if row['email'].lower() == email.lower())
+        return self.accounts[matches[0][1]] if matches else None
+
+    def _check_account(self, account_id):
+        if account_id is not None and account_id not in self.accounts:
+            raise psycopg2.IntegrityError('list account_id %s is not in account' % account_id)
+
+    # Lists
+
+    def _page(self, rows, params):
+        "Order rows by (modified_at, id) descending and apply page_query's cursor and limit"
+        limit = params[-1]
+        if len(params) > 1:
+            before = tuple(params[:2])
+            rows = [row for row in rows if (row['modified_at'], row['id']) < before]
+
+        rows.sort(key=lambda row: (row['modified_at'], row['id']), reverse=True)
+        return rows[:limit]
+
+    def _get_lists(self, sql, params):
+        rows = [row for row in self.lists.values() if row['public']]
+        return FakeCursor([(row['id'], row['title'], row['stub'], row['modified_at'])
+                           for row in self._page(rows, params[1:])])
+
+    def _get_lists_version(self, sql, params):
+        rows = [row for row in self.lists.values() if row['public']]
+        return FakeCursor([(max([row['modified_at'] for row in rows], default=None), len(rows))])
+
+    def _get_user_lists(self, sql, params):
+        rows = [row for row in self.lists.values() if row['account_id'] == params[0]]
+        return FakeCursor([(row['id'], row['title'], row['stub'], row['public'], row['modified_at'])
+                           for row in self._page(rows, params[1:])])
+
+    def _get_word_list(self, sql, params):
+        row = self.lists.get(params[0])
+        if row is None:
+            return FakeCursor()
+
+        list_row = (row['id'], row['title'], None, row['modified_at'], row['public'],
+                    row['account_id'], row['word_count'])
+        words = self.list_words[row['id']] or [(None, None, None, None)]
+        return FakeCursor([list_row + word[1:] for word in words])
+
+    def _get_list_info(self, sql, params):
+        row = self.lists.get(params[0])
+        if row is None:
+            return FakeCursor()
+
+        return FakeCursor([(row['id'], row['title'], row['modified_at'], row['public'],
+                            row['account_id'], row['word_count'])])
+
+    def _get_list_words(self, sql, params):
+        list_id, after_position, limit = params
+        words = [word for word in self.list_words.get(list_id, []) if word[0] > after_position]
+        return FakeCursor(words[:limit])
+
+    def _lists_by_id(self, list_ids, account_id):
+        return [self.lists[list_id] for list_id in sorted(set(list_ids))
+                if list_id in self.lists and (self.lists[list_id]['public'] or
+                                              self.lists[list_id]['account_id'] == account_id)]
+
+    def _list_by_id_row(self, row):
+        return (row['id'], row['title'], row['stub'], row['public'], row['account_id'],
+                row['modified_at'], row['word_count'])
+
+    def _get_lists_by_id(self, sql, params):
+        return FakeCursor([self._list_by_id_row(row) for row in self._lists_by_id(*params)])
+
+    def _get_lists_by_id_words(self, sql, params):
+        after_position, limit = params[:2]
+        rows = []
+        for row in self._lists_by_id(*params[4:]):
+            words = [word for word in self.list_words[row['id']] if word[0] > after_position]
+            for word in words[:limit] or [(None, None, None, None)]:
+                rows.append(self._list_by_id_row(row) + word)
+        return FakeCursor(rows)
+
+    def _backfill_list_words(self, sql, params):
+        # Fake lists always keep their words in list_word
+        return FakeCursor()
+
+    def _list_exists(self, sql, params):
+        ids = [row['id'] for row in self.lists.values() if row['title'] == params[0]]
+        return FakeCursor([(max(ids) if ids else None,)])
+
+    def _list_exists_for_account(self, sql, params):
+        ids = [row['id'] for row in self.lists.values()
+               if row['title'] == params[0] and row['account_id'] == params[1]]
+        return FakeCursor([(max(ids) if ids else None,)])
+
+    def _upsert_list(self, sql, params):
+        _, _, title, stub, word_count, account_id, modified_at = params[:7]
+        self._check_account(account_id)
+
+        for row in self.lists.values():
+            if row['title'] == title and row['account_id'] == account_id:
+                row.update(stub=stub, modified_at=modified_at)
+                self._set_word_columns(row['id'], params[7:])
+                return FakeCursor([(row['id'], False)])
+
+        list_id = self.add_list(title, [], account_id, public=True)
+        self.lists[list_id]['modified_at'] = modified_at
+        self._set_word_columns(list_id, params[7:])
+        return FakeCursor([(list_id, True)])
+
+    def _create_list_update(self, sql, params):
+        word_count, modified_at, stub, list_id, account_id, email = params[:6]
+        row = self.lists.get(list_id)
+        owner = self._account_for(account_id, email)
+        if row is None or owner is None or row['account_id'] != owner['id']:
+            return FakeCursor()
+
+        row.update(stub=stub, modified_at=modified_at)
+        self._set_word_columns(list_id, params[7:])
+        return FakeCursor(rowcount=word_count)
+
+    def _create_list_insert(self, sql, params):
+        title, stub, word_count, account_id, email = params[:5]
+        owner = self._account_for(account_id, email)
+        list_id = self.add_list(title, [], owner['id'] if owner else None, public=True)
+        self._set_word_columns(list_id, params[6:])
+        return FakeCursor([(list_id,)])
+
+    def _patch_list(self, sql, params):
+        """Replay patch_list's batch, statement by statement.
+
+        Parameters are split between the statements by counting their
+        placeholders.
+        """
+        list_id, account_id = params[:2]
+        row = self.lists.get(list_id)
+        if row is None or row['account_id'] != account_id:
+            return FakeCursor()
+
+        # Work on a copy, as a missing word aborts the whole batch
+        words = list(self.list_words[list_id])
+        for statement in sql.split(';\n'):
+            count = statement.count('%s')
+            args, params = params[:count], params[count:]
+            statement = ' '.join(statement.split())
+
+            if statement.startswith('INSERT INTO list_word'):
+                start = max([word[0] for word in words] or [-1]) + 1
+                words.extend((start + position, zi, pinyin, definitions)
+                             for position, zi, pinyin, definitions in zip(*args[2:]))
+            elif statement.startswith('WITH changed AS ('):
+                index, position = args[-4:-2]
+                if position >= len(words):
+                    raise MissingWordError('Operation %d: no word at position %d' %
+                                           (index, position))
+                if 'DELETE FROM list_word' in statement:
+                    del words[position]
+                else:
+                    zi, pinyin, definitions = args[:3]
+                    words[position] = (words[position][0], zi, pinyin, definitions)
+            elif statement.startswith('UPDATE list'):
+                row['modified_at'] = args[0]
+
+        self.list_words[list_id] = words
+        row['word_count'] = len(words)
+        return FakeCursor([(len(words),)])
+
+    # Skritter pushes
+
+    def _push_row(self, row):
+        list_row = self.lists[row['list_id']]
+        return (row['id'], row['account_id'], row['list_id'], row['status'],
+                row['skritter_list_id'], row['position'], row['pushed'], row['error'],
+                row['created_at'], row['modified_at'], list_row['title'], list_row['word_count'])
+
+    def _queue_skritter_push(self, sql, params):
+        account_id, created_at, modified_at, list_id, _ = params
+        if not self._lists_by_id([list_id], account_id):
+            return FakeCursor()
+        self._check_account(account_id)
+
+        for row in self.skritter_pushes.values():
+            if row['account_id'] == account_id and row['list_id'] == list_id and \
+                    row['status'] != 'done':
+                if row['status'] == 'failed':
+                    row.update(status='queued', error=None, modified_at=modified_at)
+                return FakeCursor([self._push_row(row)])
+
+        push_id = self.next_push_id
+        self.next_push_id += 1
+        self.skritter_pushes[push_id] = {'id': push_id, 'account_id': account_id,
+                                         'list_id': list_id, 'status': 'queued',
+                                         'skritter_list_id': None, 'position': -1, 'pushed': 0,
+                                         'error': None, 'created_at': created_at,
+                                         'modified_at': modified_at}
+        self.skritter_push_words[push_id] = {}
+        return FakeCursor([self._push_row(self.skritter_pushes[push_id])])
+
+    def _get_skritter_push(self, sql, params):
+        row = self.skritter_pushes.get(params[0])
+        return FakeCursor([self._push_row(row)] if row else [])
+
+    def _claim_skritter_push(self, sql, params):
+        modified_at, stale_before = params
+        for push_id in sorted(self.skritter_pushes):
+            row = self.skritter_pushes[push_id]
+            if row['status'] == 'queued' or \
+                    (row['status'] == 'running' and row['modified_at'] < stale_before):
+                row.update(status='running', modified_at=modified_at)
+                return FakeCursor([self._push_row(row)])
+
+        return FakeCursor()
+
+    def _save_skritter_push_batch(self, sql, params):
+        words, zis, results, push_id, skritter_list_id, position, pushed, status, modified_at, _ = params
+        row = self.skritter_pushes.get(push_id)
+        if row is None or row['status'] != 'running':
+            return FakeCursor(rowcount=0)
+
+        self.skritter_push_words[push_id].update(zip(words, zip(zis, results)))
+        row.update(skritter_list_id=skritter_list_id, position=position, pushed=pushed,
+                   status=status, modified_at=modified_at)
+        return FakeCursor(rowcount=1)
+
+    def _finish_skritter_push(self, sql, params):
+        status, error, modified_at, push_id = params
+        row = self.skritter_pushes.get(push_id)
+        if row is None:
+            return FakeCursor(rowcount=0)
+
+        row.update(status=status, error=error, modified_at=modified_at)
+        return FakeCursor(rowcount=1)
+
+    def _get_skritter_push_words(self, sql, params):
+        push_id, after, limit = params
+        words = sorted(self.skritter_push_words.get(push_id, {}).items())
+        return FakeCursor([(word, zi, result) for word, (zi, result) in words
+                           if word > after][:limit])
+
+    # Accounts
+
+    def _account_row(self, row):
+        return (row['id'], row['email'], row['name'], row['created_at'], row['modified_at'],
+                row['skritter_user_id'], row['skritter_access_token'],
+                row['skritter_refresh_token'], row['skritter_token_expiry'])
+
+    def _authenticate_web_user(self, sql, params):
+        row = self._account_for(None, params[0])
+        if row is None:
+            return FakeCursor()
+
+        return FakeCursor([(row['id'], row['email'], row['password_hash'], row['password_salt'])])
+
+    def _rehash_password(self, sql, params):
+        password_hash, password_salt, account_id, old_password_hash = params
+        row = self.accounts.get(account_id)
+        if row is None or row['password_hash'] != old_password_hash:
+            return FakeCursor(rowcount=0)
+
+        row.update(password_hash=password_hash, password_salt=password_salt)
+        return FakeCursor(rowcount=1)
+
+    def _get_account(self, sql, params):
+        row = self._account_for(None, params[0])
+        return FakeCursor([self._account_row(row)] if row else [])
+
+    def _get_account_by_id(self, sql, params):
+        row = self.accounts.get(params[0])
+        return FakeCursor([self._account_row(row)] if row else [])
+
+    def _get_accounts(self, sql, params):
+        emails, account_ids = params
+        return FakeCursor([self._account_row(row) for row in self.accounts.values()
+                           if row['email'].lower() in emails or row['id'] in account_ids])
+
+    def _get_expiring_skritter_accounts(self, sql, params):
+        expires_before, exclude_ids, limit = params
+        rows = [row for row in self.accounts.values()
+                if row['id'] not in exclude_ids and
+                row['skritter_refresh_token'] is not None and
+                row['skritter_token_expiry'] is not None and
+                row['skritter_token_expiry'] < expires_before]
+        rows.sort(key=lambda row: row['skritter_token_expiry'])
+        return FakeCursor([self._account_row(row) for row in rows[:limit]])
+
+    def _create_account(self, sql, params):
+        email, password_hash, password_salt = params
+        if any(row['email'].lower() == email.lower() for row in self.accounts.values()):
+            raise psycopg2.IntegrityError('duplicate key value violates unique constraint "uq_account_email"')
+
+        return FakeCursor([(self.add_account(email, password_hash, password_salt),)])
+
+    def _update_account(self, sql, params):
+        email, name, account_id = params
+        row = self.accounts.get(account_id)
+        if row is None:
+            return FakeCursor(rowcount=0)
+
+        row.update(email=email, name=name)
+        return FakeCursor(rowcount=1)
+
+    def _store_skritter_token(self, sql, params):
+        row = self.accounts.get(params[-1])
+        if row is None:
+            return FakeCursor(rowcount=0)
+
+        row.update(zip(['skritter_user_id', 'skritter_access_token',
+                        'skritter_refresh_token', 'skritter_token_expiry'], params[:4]))
+        return FakeCursor(rowcount=1)
@@ -2,6 +2,7 @@
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
 from cihui.data import base
+from cihui import cache
 from cihui import uri
 
 import datetime
@@ -10,20 +11,182 @@ import json
 import logging
 
 
+# Upper bound on the memory used by cached word lists
+LIST_CACHE_BYTES = 32 * 1024 * 1024
+
+# Words are read from list_word in pages of this many rows
+WORD_PAGE_SIZE = 1000
+
+# Rows for list_word, from the arrays built by word_columns
+WORD_ROWS_SQL = '''unnest(%s::int[], %s::text[], %s::text[], %s::text[])
+                     AS w(position, zi, pinyin, definitions)'''
+
+
+# Moves the words of the lists matching filter from list.words to list_word
+MOVE_WORDS_SQL = '''WITH batch AS (
+                          SELECT id, COALESCE(words, '[]')::json AS words
+                          FROM list
+                          WHERE word_count IS NULL {filter}
+                          FOR UPDATE SKIP LOCKED),
+                      new_words AS (
+                          INSERT INTO list_word (list_id, position, zi, pinyin, definitions)
+                          SELECT batch.id, w.ordinality - 1, w.value->>0,
+                                 COALESCE(w.value->>1, ''), COALESCE(w.value->2, '[]')::text
+                          FROM batch, json_array_elements(batch.words) WITH ORDINALITY AS w)
+                      UPDATE list
+                      SET word_count = json_array_length(batch.words), words = NULL
+                      FROM batch
+                      WHERE list.id = batch.id
+                      RETURNING list.id'''
+
+# The account given by id or email, preferring an exact email match over
+# one differing only by case
+ACCOUNT_ID_SQL = '''(SELECT id FROM account WHERE id = %s OR lower(email) = lower(%s)
+                     ORDER BY email = %s DESC NULLS LAST, id LIMIT 1)'''
+
+# Owned list ids for the patch_list statements
+OWNED_LIST_SQL = 'SELECT id FROM list WHERE id = %s AND account_id = %s'
+
+# Position of the nth word in a list
+NTH_POSITION_SQL = '''SELECT position FROM list_word
+                       WHERE list_id = %s ORDER BY position OFFSET %s LIMIT 1'''
+
+# Fails a patch_list batch, through require_list_word, when the word
+# changed by a remove or replace is not in the owned list
+REQUIRE_WORD_SQL = '''SELECT require_list_word((SELECT count(*) FROM changed), %s, %s)
+                       FROM (''' + OWNED_LIST_SQL + ''') l'''
+
+# SQLSTATE raised by require_list_word
+MISSING_WORD_SQLSTATE = 'P0002'
+
+
+# Lists matching get_lists_by_id, with the word count of lists not yet
+# moved to list_word
+LISTS_BY_ID_SQL = '''SELECT l.id, l.title, l.stub, l.public, l.account_id, l.modified_at,
+                           COALESCE(l.word_count, json_array_length(COALESCE(l.words, '[]')::json))
+                           {words}
+                    FROM list l
+                    {join}
+                    WHERE l.id = ANY(%s) AND (l.public OR l.account_id = %s)
+                    ORDER BY l.id{order}'''
+
+# A page of each list's words, from list_word or from list.words if the
+# list has not been moved yet. A list's words are only ever in one of them.
+LIST_WORDS_PAGE_SQL = '''LEFT JOIN LATERAL (
+                           (SELECT position, zi, pinyin, definitions
+                            FROM list_word
+                            WHERE list_id = l.id AND position > %s
+                            ORDER BY position
+                            LIMIT %s)
+                           UNION ALL
+                           (SELECT (j.ordinality - 1)::int, j.value->>0, COALESCE(j.value->>1, ''),
+                                   COALESCE(j.value->2, '[]')::text
+                            FROM json_array_elements(CASE WHEN l.word_count IS NULL
+                                                          THEN COALESCE(l.words, '[]')::json END)
+                                 WITH ORDINALITY AS j
+                            WHERE j.ordinality - 1 > %s
+                            ORDER BY j.ordinality
+                            LIMIT %s)) w ON true'''
+
+
+# Columns of a Skritter push p and its list l, for push_from_row
+SKRITTER_PUSH_COLUMNS = '''p.id, p.account_id, p.list_id, p.status, p.skritter_list_id,
+                           p.position, p.pushed, p.error, p.created_at, p.modified_at, l.title,
+                           COALESCE(l.word_count, json_array_length(COALESCE(l.words, '[]')::json))'''
+
+# Results per page of get_skritter_push_words
+PUSH_WORD_PAGE_SIZE = 1000
+
+
+# Lists per page on the index, home and atom pages
+LIST_PAGE_SIZE = 50
+
+LIST_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def make_list_cursor(word_list):
+    "Cursor for the page of lists after word_list"
+    return '%s_%d' % (word_list['modified_at'].strftime(LIST_CURSOR_FORMAT),
+                      word_list['id'])
+
+
+def parse_list_cursor(cursor):
+    "Return the (modified_at, id) for a cursor. Raises ValueError if invalid"
+    modified_at, _, list_id = cursor.rpartition('_')
+    return (datetime.datetime.strptime(modified_at, LIST_CURSOR_FORMAT),
+            int(list_id))
+
+
+def page_query(sql, params, before, limit):
+    "Add keyset pagination on (modified_at, id) to a list query"
+    params = list(params)
+    if before is not None:
+        sql += ' AND (modified_at, id) < (%s, %s)'
+        params += list(before)
+
+    sql += ' ORDER BY modified_at DESC, id DESC LIMIT %s;'
+    params.append(limit)
+
+    return sql, params
+
+
+def word_columns(words):
+    "Split words into position, zi, pinyin and definitions arrays for WORD_ROWS_SQL"
+    positions = []
+    zis = []
+    pinyins = []
+    definitions = []
+
+    for position, word in enumerate(words):
+        positions.append(position)
+        zis.append(word[0])
+        pinyins.append(word[1] if len(word) > 1 else '')
+        definitions.append(json.dumps(word[2] if len(word) > 2 else []))
+
+    return [positions, zis, pinyins, definitions]
+
+
+def row_to_word(zi, pinyin, definitions):
+    return [zi, pinyin, json.loads(definitions)]
+
+
+def push_from_row(row):
+    return dict(zip(['id', 'account_id', 'list_id', 'status', 'skritter_list_id', 'position',
+                     'pushed', 'error', 'created_at', 'modified_at', 'title', 'word_count'], row))
+
+
+def copy_word_list(word_list, **changes):
+    "Copy of a cached word list that callers can modify"
+    word_list = dict(word_list, **changes)
+    if isinstance(word_list.get('words'), list):
+        word_list['words'] = list(word_list['words'])
+    return word_list
+
+
 class WordListData(base.AsyncDatabase):
-    def __init__(self, db_url, db=None):
+    def __init__(self, db_url, db=None, cache_bytes=LIST_CACHE_BYTES):
         super(WordListData, self).__init__(db_url, db)
+        self.list_cache = cache.LRUCache(cache_bytes)
+
+    def stats(self):
+        stats = super(WordListData, self).stats()
+        stats['list_cache'] = self.list_cache.stats()
+        return stats
 
-    def get_lists(self, callback):
+    def get_lists(self, callback, before=None, limit=LIST_PAGE_SIZE):
+        """Fetch a page of public lists, most recently modified first.
+
+        before is the (modified_at, id) of the last list on the previous
+        page, as returned by parse_list_cursor.
+        """
         cb_id = self.add_callback(callback)
         cb = functools.partial(self._on_get_lists_response, cb_id)
 
-        self.db.execute('''SELECT id, title, stub
-                           FROM list
-                           WHERE public = %s
-                           ORDER BY modified_at DESC;''',
-                        ('true',),
-                        callback=cb)
+        sql, params = page_query('''SELECT id, title, stub, modified_at
+                                     FROM list
+                                     WHERE public = %s''',
+                                 ['true'], before, limit)
+        self.execute('get_lists', sql, params, callback=cb, cb_id=cb_id)
 
     def _on_get_lists_response(self, cb_id, cursor, error=None):
         callback, _ = self.get_callback(cb_id)
@@ -35,20 +198,46 @@ class WordListData(base.AsyncDatabase):
             word_lists = []
             for word_list in cursor:
                 word_lists.append({'id': word_list[0], 'title': word_list[1],
-                                   'stub': word_list[2]})
+                                   'stub': word_list[2],
+                                   'modified_at': word_list[3]})
 
             callback(word_lists)
 
-    def get_user_lists(self, user_id, callback):
+    def get_lists_version(self, callback):
+        """Fetch the latest modified_at and count of the public lists.
+
+        The callback receives a dict of both, or None on error. Any change
+        to the public lists changes one of them, so pages built from
+        get_lists can be validated without fetching them.
+        """
+        cb_id = self.add_callback(callback)
+        cb = functools.partial(self._on_get_lists_version_response, cb_id)
+
+        self.execute('get_lists_version',
+                     'SELECT max(modified_at), count(*) FROM list WHERE public = %s;',
+                     ['true'],
+                     callback=cb, cb_id=cb_id)
+
+    def _on_get_lists_version_response(self, cb_id, cursor, error=None):
+        callback, _ = self.get_callback(cb_id)
+
+        if error is not None or cursor is None or cursor.rowcount != 1:
+            logging.warning('Error fetching the lists version: %s', error)
+            callback(None)
+            return
+
+        modified_at, count = cursor.fetchone()
+        callback({'modified_at': modified_at, 'count': count})
+
+    def get_user_lists(self, user_id, callback, before=None, limit=LIST_PAGE_SIZE):
         cb_id = self.add_callback(callback)
         cb = functools.partial(self._on_get_user_lists_response, cb_id)
 
-        self.db.execute('''SELECT id, title, stub, public
-                           FROM list
-                           WHERE account_id = %s
-                           ORDER BY modified_at DESC;''',
-                        (user_id,),
-                        callback=cb)
+        sql, params = page_query('''SELECT id, title, stub, public, modified_at
+                                     FROM list
+                                     WHERE account_id = %s''',
+                                 [user_id], before, limit)
+        self.execute('get_user_lists', sql, params, callback=cb, cb_id=cb_id)
 
     # TODO(gmwils) refactor based on get_list
     def _on_get_user_lists_response(self, cb_id, cursor, error=None):
@@ -63,29 +252,64 @@ class WordListData(base.AsyncDatabase):
                 word_lists.append({'id': word_list[0],
                                    'title': word_list[1],
                                    'stub': word_list[2],
-                                   'public': word_list[3]})
+                                   'public': word_list[3],
+                                   'modified_at': word_list[4]})
 
             callback(word_lists)
 
-    def get_word_list(self, list_id, callback):
+    def get_word_list(self, list_id, callback, list_info=None):
+        """Fetch a list with its words.
+
+        Lists are cached, and a cached list is only used after checking its
+        modified_at against the database. The public and account_id fields
+        always come from the database. Pass the list_info the caller has
+        just fetched with get_list_info to skip checking it again.
+        """
+        if list_id not in self.list_cache:
+            self.list_cache.misses += 1
+            self._fetch_word_list(list_id, callback)
+        elif list_info is not None:
+            self._on_check_cached_list(list_id, callback, list_info)
+        else:
+            cb = functools.partial(self._on_check_cached_list, list_id, callback)
+            self.get_list_info(list_id, cb)
+
+    def _on_check_cached_list(self, list_id, callback, list_info):
+        if list_info is None:
+            self.list_cache.invalidate(list_id)
+            callback(None)
+            return
+
+        word_list = self.list_cache.get(list_id, list_info['modified_at'])
+        if word_list is None:
+            self._fetch_word_list(list_id, callback)
+        else:
+            callback(copy_word_list(word_list, **list_info))
+
+    def _fetch_word_list(self, list_id, callback):
         cb_id = self.add_callback(callback, list_id)
         cb = functools.partial(self._on_get_word_list_response, cb_id)
 
-        self.db.execute('''SELECT id, title, words, modified_at, public, account_id
-                           FROM list
-                           WHERE id = %s;''',
-                        (list_id,),
-                        callback=cb)
+        self.execute('get_word_list',
+                     '''SELECT l.id, l.title, l.words, l.modified_at, l.public, l.account_id,
+                               l.word_count, w.zi, w.pinyin, w.definitions
+                        FROM list l
+                        LEFT JOIN list_word w ON w.list_id = l.id
+                        WHERE l.id = %s
+                        ORDER BY w.position;''',
+                     (list_id,),
+                     callback=cb, cb_id=cb_id)
 
     def _on_get_word_list_response(self, cb_id, cursor, error=None):
         callback, list_id = self.get_callback(cb_id)
 
-        if cursor.rowcount != 1:
+        if error is not None or cursor is None or cursor.rowcount == 0:
             logging.warning('Invalid response for get_word_list(%s)', list_id)
             callback(None)
             return
 
-        result = cursor.fetchone()
+        rows = cursor.fetchall()
+        result = rows[0]
         word_list = {}
         if len(result) > 2:
             word_list['id'] = result[0]
@@ -94,29 +318,428 @@ class WordListData(base.AsyncDatabase):
             word_list['modified_at'] = result[3]
             word_list['public'] = result[4]
             word_list['account_id'] = result[5]
-            if words is not None:
+            word_list['word_count'] = result[6]
+            if word_list['word_count'] is not None:
+                words = [row_to_word(*row[7:10]) for row in rows if row[7] is not None]
+            elif words is not None:
                 words = json.loads(words)
 
             word_list['words'] = words
+            self.list_cache.put(word_list['id'], word_list, word_list['modified_at'])
+            word_list = copy_word_list(word_list)
 
         callback(word_list)
 
+    def get_list_info(self, list_id, callback):
+        "Fetch a list without its words"
+        cb_id = self.add_callback(callback, list_id)
+        cb = functools.partial(self._on_get_list_info_response, cb_id)
+
+        self.execute('get_list_info',
+                     '''SELECT id, title, modified_at, public, account_id, word_count
+                        FROM list
+                        WHERE id = %s;''',
+                     (list_id,),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_get_list_info_response(self, cb_id, cursor, error=None):
+        callback, list_id = self.get_callback(cb_id)
+
+        if error is not None or cursor is None or cursor.rowcount != 1:
+            logging.warning('Invalid response for get_list_info(%s)', list_id)
+            callback(None)
+            return
+
+        result = cursor.fetchone()
+        callback({'id': result[0],
+                  'title': result[1],
+                  'modified_at': result[2],
+                  'public': result[3],
+                  'account_id': result[4],
+                  'word_count': result[5]})
+
+    def get_list_words(self, list_id, callback, after_position=-1, limit=WORD_PAGE_SIZE):
+        """Fetch a page of words from list_word, ordered by position.
+
+        The callback receives a dict of the words and next_position, the
+        after_position for the following page (None after the last page),
+        or None on error. Lists that have not been moved to list_word
+        return no words.
+        """
+        cb_id = self.add_callback(callback, limit)
+        cb = functools.partial(self._on_get_list_words_response, cb_id)
+
+        self.execute('get_list_words',
+                     '''SELECT position, zi, pinyin, definitions
+                        FROM list_word
+                        WHERE list_id = %s AND position > %s
+                        ORDER BY position
+                        LIMIT %s;''',
+                     (list_id, after_position, limit),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_get_list_words_response(self, cb_id, cursor, error=None):
+        callback, limit = self.get_callback(cb_id)
+
+        if error is not None or cursor is None:
+            logging.warning('Error fetching list words: %s', error)
+            callback(None)
+            return
+
+        words = []
+        position = None
+        for row in cursor:
+            position = row[0]
+            words.append(row_to_word(*row[1:4]))
+
+        if len(words) < limit:
+            position = None
+
+        callback({'words': words, 'next_position': position})
+
+    def get_lists_by_id(self, list_ids, callback, account_id=None, words=False,
+                        after_position=-1, limit=WORD_PAGE_SIZE):
+        """Fetch many lists in one query, ordered by id.
+
+        Only public lists and those of account_id are returned. With words
+        set each list also has a page of its words and the next_position
+        to fetch the following page from, as with get_list_words. The
+        callback receives a list of dicts, or None on error.
+        """
+        list_ids = list(list_ids)
+        cb_id = self.add_callback(callback, limit if words else None)
+        cb = functools.partial(self._on_get_lists_by_id_response, cb_id)
+
+        if words:
+            self.execute('get_lists_by_id_words',
+                         LISTS_BY_ID_SQL.format(words=', w.position, w.zi, w.pinyin, w.definitions',
+                                                join=LIST_WORDS_PAGE_SQL,
+                                                order=', w.position;'),
+                         [after_position, limit, after_position, limit, list_ids, account_id],
+                         callback=cb, cb_id=cb_id)
+        else:
+            self.execute('get_lists_by_id',
+                         LISTS_BY_ID_SQL.format(words='', join='', order=';'),
+                         [list_ids, account_id],
+                         callback=cb, cb_id=cb_id)
+
+    def _on_get_lists_by_id_response(self, cb_id, cursor, error=None):
+        callback, limit = self.get_callback(cb_id)
+
+        if error is not None or cursor is None:
+            logging.warning('Error fetching lists by id: %s', error)
+            callback(None)
+            return
+
+        word_lists = []
+        for row in cursor:
+            if not word_lists or word_lists[-1]['id'] != row[0]:
+                word_lists.append({'id': row[0],
+                                   'title': row[1],
+                                   'stub': row[2],
+                                   'public': row[3],
+                                   'account_id': row[4],
+                                   'modified_at': row[5],
+                                   'word_count': row[6]})
+                if limit is not None:
+                    word_lists[-1].update(words=[], next_position=None)
+
+            if limit is not None and row[7] is not None:
+                word_lists[-1]['words'].append(row_to_word(*row[8:11]))
+                word_lists[-1]['next_position'] = row[7]
+
+        if limit is not None:
+            for word_list in word_lists:
+                if len(word_list['words']) < limit:
+                    word_list['next_position'] = None
+
+        callback(word_lists)
+
+    def backfill_list_words(self, batch_size, callback):
+        """Move the words of up to batch_size lists from list.words to list_word.
+
+        The callback receives the ids of the lists moved, or None on error.
+        Safe to run while the site is live; locked lists are skipped.
+        """
+        cb_id = self.add_callback(callback, batch_size)
+        cb = functools.partial(self._on_backfill_list_words_response, cb_id)
+
+        self.execute('backfill_list_words',
+                     MOVE_WORDS_SQL.format(filter='ORDER BY id LIMIT %s'),
+                     (batch_size,),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_backfill_list_words_response(self, cb_id, cursor, error=None):
+        callback, _ = self.get_callback(cb_id)
+
+        if error is not None or cursor is None:
+            logging.error('Error moving words to list_word: %s', error)
+            callback(None)
+            return
+
+        callback([row[0] for row in cursor])
+
+    def patch_list(self, list_id, account_id, operations, callback):
+        """Apply word operations to a list in one round trip.
+
+        operations is a sequence of ('append', words), ('remove', index) or
+        ('replace', index, word), applied in order. Indexes count words in
+        the list as it stands after the earlier operations. The callback
+        receives the new word count, or None if the list does not exist
+        for the account. If an index has no word nothing is changed, and
+        the callback receives None and a message naming the operation.
+        """
+        owned = [list_id, account_id]
+
+        # Lock the list, then move its words to list_word if still needed
+        statements = [OWNED_LIST_SQL + ' FOR UPDATE',
+                      MOVE_WORDS_SQL.format(filter='AND id = %s')]
+        params = owned + [list_id]
+
+        for index, operation in enumerate(operations):
+            action = operation[0]
+            if action == 'append':
+                statements.append(
+                    '''INSERT INTO list_word (list_id, position, zi, pinyin, definitions)
+                       SELECT l.id,
+                              (SELECT COALESCE(max(position), -1) + 1 FROM list_word WHERE list_id = l.id)
+                              + w.position,
+                              w.zi, w.pinyin, w.definitions
+                       FROM (''' + OWNED_LIST_SQL + ''') l, ''' + WORD_ROWS_SQL)
+                params += owned + word_columns(operation[1])
+
+            elif action == 'remove':
+                statements.append(
+                    '''WITH changed AS (
+                           DELETE FROM list_word
+                           WHERE list_id IN (''' + OWNED_LIST_SQL + ''')
+                           AND position = (''' + NTH_POSITION_SQL + ''')
+                           RETURNING 1)
+                       ''' + REQUIRE_WORD_SQL)
+                params += owned + [list_id, operation[1], index, operation[1]] + owned
+
+            elif action == 'replace':
+                zi, pinyin, definitions = [column[0] for column in word_columns([operation[2]])[1:]]
+                statements.append(
+                    '''WITH changed AS (
+                           UPDATE list_word SET zi = %s, pinyin = %s, definitions = %s
+                           WHERE list_id IN (''' + OWNED_LIST_SQL + ''')
+                           AND position = (''' + NTH_POSITION_SQL + ''')
+                           RETURNING 1)
+                       ''' + REQUIRE_WORD_SQL)
+                params += ([zi, pinyin, definitions] + owned + [list_id, operation[1]] +
+                           [index, operation[1]] + owned)
+
+            else:
+                raise ValueError('Unknown list operation: %s' % action)
+
+        statements.append(
+            '''UPDATE list
+               SET word_count = (SELECT count(*) FROM list_word WHERE list_id = list.id),
+                   modified_at = %s
+               WHERE id = %s AND account_id = %s
+               RETURNING word_count''')
+        params += [datetime.datetime.utcnow()] + owned
+
+        self.list_cache.invalidate(list_id)
+        cb_id = self.add_callback(callback, list_id)
+        cb = functools.partial(self._on_patch_list_response, cb_id)
+
+        # Statements sent together run in a single transaction
+        self.execute('patch_list', ';\n'.join(statements), params, callback=cb, cb_id=cb_id)
+
+    def _on_patch_list_response(self, cb_id, cursor, error=None):
+        callback, list_id = self.get_callback(cb_id)
+
+        if getattr(error, 'pgcode', None) == MISSING_WORD_SQLSTATE:
+            callback(None, str(error).strip().splitlines()[0])
+            return
+
+        if error is not None or cursor is None or cursor.rowcount != 1:
+            logging.warning('Failed to patch list %s: %s', list_id, error)
+            callback(None)
+            return
+
+        callback(cursor.fetchone()[0])
+
+    def queue_skritter_push(self, list_id, account_id, callback):
+        """Queue the account's push of a list to Skritter.
+
+        The list must be public or the account's. An unfinished push of
+        the same list is returned instead of starting another, and one
+        that failed is queued again to resume where it stopped. The
+        callback receives the push, or None if there is no such list.
+        """
+        cb_id = self.add_callback(callback, list_id)
+        cb = functools.partial(self._on_skritter_push_response, cb_id)
+
+        now = datetime.datetime.utcnow()
+        self.execute('queue_skritter_push',
+                     '''WITH push AS (
+                            INSERT INTO skritter_push AS p (account_id, list_id, created_at, modified_at)
+                            SELECT %s, id, %s, %s FROM list WHERE id = %s AND (public OR account_id = %s)
+                            ON CONFLICT (account_id, list_id) WHERE status <> 'done' DO UPDATE
+                            SET status = CASE WHEN p.status = 'failed' THEN 'queued' ELSE p.status END,
+                                error = CASE WHEN p.status = 'failed' THEN NULL ELSE p.error END,
+                                modified_at = CASE WHEN p.status = 'failed' THEN EXCLUDED.modified_at
+                                                   ELSE p.modified_at END
+                            RETURNING *)
+                        SELECT ''' + SKRITTER_PUSH_COLUMNS + '''
+                        FROM push p JOIN list l ON l.id = p.list_id''',
+                     (account_id, now, now, list_id, account_id),
+                     callback=cb, cb_id=cb_id)
+
+    def get_skritter_push(self, push_id, callback):
+        "Fetch a push to Skritter. The callback receives it, or None"
+        cb_id = self.add_callback(callback, push_id)
+        cb = functools.partial(self._on_skritter_push_response, cb_id)
+
+        self.execute('get_skritter_push',
+                     '''SELECT ''' + SKRITTER_PUSH_COLUMNS + '''
+                        FROM skritter_push p JOIN list l ON l.id = p.list_id
+                        WHERE p.id = %s;''',
+                     (push_id,),
+                     callback=cb, cb_id=cb_id)
+
+    def claim_skritter_push(self, stale_before, callback):
+        """Take the oldest queued push to run it.
+
+        A push still running but not saved since stale_before is taken to
+        have lost its worker, and is claimed again to resume it. The
+        callback receives the push, or None if none are waiting.
+        """
+        cb_id = self.add_callback(callback, None)
+        cb = functools.partial(self._on_skritter_push_response, cb_id)
+
+        self.execute('claim_skritter_push',
+                     '''UPDATE skritter_push p SET status = 'running', modified_at = %s
+                        FROM list l
+                        WHERE p.id = (SELECT id FROM skritter_push
+                                      WHERE status = 'queued' OR (status = 'running' AND modified_at < %s)
+                                      ORDER BY id
+                                      LIMIT 1
+                                      FOR UPDATE SKIP LOCKED)
+                        AND l.id = p.list_id
+                        RETURNING ''' + SKRITTER_PUSH_COLUMNS,
+                     (datetime.datetime.utcnow(), stale_before),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_skritter_push_response(self, cb_id, cursor, error=None):
+        callback, push_id = self.get_callback(cb_id)
+
+        if error is not None or cursor is None or cursor.rowcount != 1:
+            if error is not None:
+                logging.warning('Error fetching Skritter push %s: %s', push_id, error)
+            callback(None)
+            return
+
+        callback(push_from_row(cursor.fetchone()))
+
+    def save_skritter_push_batch(self, push_id, skritter_list_id, position, pushed, results,
+                                 callback, status='running'):
+        """Record the progress of a running push and the results of its
+        latest words, as (word index, zi, result). A status of done
+        finishes the push along with its last words.
+
+        The callback receives True if the push was saved.
+        """
+        columns = [list(column) for column in zip(*results)] or [[], [], []]
+        cb_id = self.add_callback(callback, push_id)
+        cb = functools.partial(self._on_skritter_push_saved, cb_id)
+
+        self.execute('save_skritter_push_batch',
+                     '''WITH results AS (
+                            INSERT INTO skritter_push_word (push_id, word, zi, result)
+                            SELECT p.id, r.word, r.zi, r.result
+                            FROM skritter_push p,
+                                 unnest(%s::int[], %s::text[], %s::text[]) AS r(word, zi, result)
+                            WHERE p.id = %s AND p.status = 'running'
+                            ON CONFLICT (push_id, word) DO UPDATE
+                            SET zi = EXCLUDED.zi, result = EXCLUDED.result)
+                        UPDATE skritter_push
+                        SET skritter_list_id = %s, position = %s, pushed = %s, status = %s,
+                            modified_at = %s
+                        WHERE id = %s AND status = 'running';''',
+                     columns + [push_id, skritter_list_id, position, pushed, status,
+                                datetime.datetime.utcnow(), push_id],
+                     callback=cb, cb_id=cb_id)
+
+    def finish_skritter_push(self, push_id, status, callback, error=None):
+        "Mark a push done or failed. The callback receives True if it was saved"
+        cb_id = self.add_callback(callback, push_id)
+        cb = functools.partial(self._on_skritter_push_saved, cb_id)
+
+        self.execute('finish_skritter_push',
+                     '''UPDATE skritter_push SET status = %s, error = %s, modified_at = %s
+                        WHERE id = %s;''',
+                     (status, error, datetime.datetime.utcnow(), push_id),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_skritter_push_saved(self, cb_id, cursor, error=None):
+        callback, push_id = self.get_callback(cb_id)
+
+        if error is not None or cursor is None or cursor.rowcount != 1:
+            logging.warning('Failed to save Skritter push %s: %s', push_id, error)
+            callback(False)
+            return
+
+        callback(True)
+
+    def get_skritter_push_words(self, push_id, callback, after=-1, limit=PUSH_WORD_PAGE_SIZE):
+        """Fetch a page of a push's word results, in word order.
+
+        The callback receives a dict of the results, each a dict of the
+        word index, zi and result, and next_word, the after for the
+        following page (None after the last page). It receives None on
+        error.
+        """
+        cb_id = self.add_callback(callback, limit)
+        cb = functools.partial(self._on_get_skritter_push_words_response, cb_id)
+
+        self.execute('get_skritter_push_words',
+                     '''SELECT word, zi, result
+                        FROM skritter_push_word
+                        WHERE push_id = %s AND word > %s
+                        ORDER BY word
+                        LIMIT %s;''',
+                     (push_id, after, limit),
+                     callback=cb, cb_id=cb_id)
+
+    def _on_get_skritter_push_words_response(self, cb_id, cursor, error=None):
+        callback, limit = self.get_callback(cb_id)
+
+        if error is not None or cursor is None:
+            logging.warning('Error fetching Skritter push words: %s', error)
+            callback(None)
+            return
+
+        results = [{'word': row[0], 'zi': row[1], 'result': row[2]} for row in cursor]
+        next_word = results[-1]['word'] if len(results) == limit else None
+        callback({'words': results, 'next_word': next_word})
+
     def list_exists(self, list_name, callback):
         cb_id = self.add_callback(callback, list_name)
         cb = functools.partial(self._on_list_exists, cb_id)
-        self.db.execute('SELECT max(id) FROM list WHERE title=%s', (list_name,),
-                        callback=cb)
+        self.execute('list_exists',
+                     'SELECT max(id) FROM list WHERE title=%s', (list_name,),
+                     callback=cb, cb_id=cb_id)
 
     def list_exists_for_account(self, list_name, account_id, callback):
-        cb_id = self.add_callback(callback, '%s,%s' % (list_name, account_id))
+        cb_id = self.add_callback(callback, (list_name, account_id))
         cb = functools.partial(self._on_list_exists, cb_id)
-        self.db.execute('SELECT max(id) FROM list WHERE title=%s AND account_id=%s',
-                        (list_name, account_id,),
-                        callback=cb)
+        self.execute('list_exists_for_account',
+                     'SELECT max(id) FROM list WHERE title=%s AND account_id=%s',
+                     (list_name, account_id,),
+                     callback=cb, cb_id=cb_id)
 
     def _on_list_exists(self, cb_id, cursor, error=None):
         callback, list_name = self.get_callback(cb_id)
 
+        if error is not None or cursor is None:
+            logging.warning('Error looking up list %s: %s', list_name, error)
+            callback(None)
+            return
+
         result = cursor.fetchone()
         if result is not None:
             list_id = result[0]
@@ -124,48 +747,114 @@ class WordListData(base.AsyncDatabase):
         else:
             callback(None)
 
+    def upsert_list(self, list_name, list_elements, account_id, callback):
+        """Create the account's list with this title, or replace its words.
+
+        The callback receives the list id and True if the list was created,
+        or (None, None) on error.
+        """
+        cb_id = self.add_callback(callback, list_name)
+        cb = functools.partial(self._on_upsert_list_response, cb_id)
+
+        # Uploads of the same title wait on the lock, so each statement
+        # sees the words committed by the one before. xmax is only zero
+        # for a row that was inserted rather than updated.
+        self.execute(
+            'upsert_list',
+            '''SELECT pg_advisory_xact_lock(%s, hashtext(%s));
+               WITH upserted AS (
+                   INSERT INTO list (title, stub, word_count, account_id, modified_at)
+                   VALUES (%s, %s, %s, %s, %s)
+                   ON CONFLICT (account_id, title) DO UPDATE
+                   SET words = NULL, word_count = EXCLUDED.word_count,
+                       modified_at = EXCLUDED.modified_at, stub = EXCLUDED.stub
+                   RETURNING id, xmax = 0 AS created),
+               old_words AS (
+                   DELETE FROM list_word WHERE list_id IN (SELECT id FROM upserted) RETURNING 1),
+               new_words AS (
+                   INSERT INTO list_word (list_id, position, zi, pinyin, definitions)
+                   SELECT upserted.id, w.position, w.zi, w.pinyin, w.definitions
+                   FROM upserted, ''' + WORD_ROWS_SQL + '''
+                   WHERE (SELECT count(*) FROM old_words) >= 0)
+               SELECT id, created FROM upserted''',
+            [account_id,
+             list_name,
+             list_name,
+             uri.title_to_stub(list_name),
+             len(list_elements),
+             account_id,
+             datetime.datetime.utcnow()] + word_columns(list_elements),
+            callback=cb, cb_id=cb_id)
+
+    def _on_upsert_list_response(self, cb_id, cursor, error=None):
+        callback, list_name = self.get_callback(cb_id)
+
+        if error is not None or cursor is None or cursor.rowcount != 1:
+            logging.warning('Failed to save list %s: %s', list_name, error)
+            callback(None, None)
+            return
+
+        list_id, created = cursor.fetchone()
+        self.list_cache.invalidate(list_id)
+        callback(list_id, created)
+
     def create_list(self, list_name, list_elements, callback, list_id=None, account_id=None, email_address=None):
         cb_id = self.add_callback(callback, list_id)
         cb = functools.partial(self._on_create_list_response, cb_id)
 
         if list_id is not None:
-            self.db.execute(
-                'UPDATE list SET words=%s, modified_at=%s, stub=%s WHERE id=%s AND account_id in (SELECT id FROM account WHERE id = %s or email = %s)',
-                (json.dumps(list_elements),
-                 datetime.datetime.now(),
+            self.list_cache.invalidate(list_id)
+
+            # Counting old_words runs the delete before the insert, so the
+            # new rows can reuse the old positions
+            self.execute(
+                'create_list_update',
+                '''WITH updated AS (
+                       UPDATE list SET words=NULL, word_count=%s, modified_at=%s, stub=%s
+                       WHERE id=%s AND account_id = ''' + ACCOUNT_ID_SQL + '''
+                       RETURNING id),
+                   old_words AS (
+                       DELETE FROM list_word WHERE list_id IN (SELECT id FROM updated) RETURNING 1)
+                   INSERT INTO list_word (list_id, position, zi, pinyin, definitions)
+                   SELECT updated.id, w.position, w.zi, w.pinyin, w.definitions
+                   FROM updated, ''' + WORD_ROWS_SQL + '''
+                   WHERE (SELECT count(*) FROM old_words) >= 0''',
+                [len(list_elements),
+                 datetime.datetime.utcnow(),
                  uri.title_to_stub(list_name),
                  list_id,
                  account_id,
-                 email_address),
-                callback=cb)
+                 email_address,
+                 email_address] + word_columns(list_elements),
+                callback=cb, cb_id=cb_id)
 
         else:
-            self.db.execute(
-                'INSERT INTO list (title, words, stub, account_id) VALUES (%s, %s, %s, (SELECT id FROM account WHERE id = %s OR email = %s)) RETURNING id',
-                (list_name,
-                 json.dumps(list_elements),
+            self.execute(
+                'create_list_insert',
+                '''WITH new_list AS (
+                       INSERT INTO list (title, stub, word_count, account_id)
+                       VALUES (%s, %s, %s, ''' + ACCOUNT_ID_SQL + ''')
+                       RETURNING id),
+                   new_words AS (
+                       INSERT INTO list_word (list_id, position, zi, pinyin, definitions)
+                       SELECT new_list.id, w.position, w.zi, w.pinyin, w.definitions
+                       FROM new_list, ''' + WORD_ROWS_SQL + ''')
+                   SELECT id FROM new_list''',
+                [list_name,
                  uri.title_to_stub(list_name),
+                 len(list_elements),
                  account_id,
-                 email_address),
-                callback=cb)
+                 email_address,
+                 email_address] + word_columns(list_elements),
+                callback=cb, cb_id=cb_id)
 
     def _on_create_list_response(self, cb_id, cursor, error=None):
-        callback, list_id_str = self.get_callback(cb_id)
-
-        if callback is None:
-            # XXX(gmwils) should log an error here
-            return
+        callback, list_id = self.get_callback(cb_id)
 
         if error is not None:
             callback(False)
             return
 
-        list_id = None
-        try:
-            list_id = int(list_id_str)
-        except ValueError:
-            pass
-
         if list_id is None:
             result = cursor.fetchone()
             list_id = result[0]
@@ -1,20 +1,111 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import csv
+import io
+import itertools
+
+
+# Words formatted at a time by format_words
+FORMAT_CHUNK_WORDS = 1000
+
+# Fields of a formatted word, by position in a dialect's columns
+ZI, PINYIN, DESCRIPTION = range(3)
+
+# Tabs and line breaks would split a field of an unquoted tab separated line
+TAB_SAFE = str.maketrans('\t\r\n', '   ')
+
+
+class CSVDialect(csv.Dialect):
+    "Every field quoted, with quotes doubled"
+    delimiter = ','
+    quotechar = '"'
+    doublequote = True
+    quoting = csv.QUOTE_ALL
+    lineterminator = '\n'
+    skipinitialspace = False
+    columns = (ZI, PINYIN, DESCRIPTION)
+
+
+class TSVDialect(CSVDialect):
+    "Unquoted and tab separated; tabs and line breaks in fields become spaces"
+    delimiter = '\t'
+    quotechar = None
+    quoting = csv.QUOTE_NONE
+    columns = (ZI, DESCRIPTION, PINYIN)
+
+
+class PlecoDialect(TSVDialect):
+    "Pleco flashcard import: hanzi, pinyin and definition"
+    columns = (ZI, PINYIN, DESCRIPTION)
+
+
+class AnkiDialect(CSVDialect):
+    "Anki text import: tab separated, fields with tabs, quotes or line breaks quoted"
+    delimiter = '\t'
+    quoting = csv.QUOTE_MINIMAL
+
+
+DIALECTS = {'csv': CSVDialect,
+            'tsv': TSVDialect,
+            'pleco': PlecoDialect,
+            'anki': AnkiDialect}
+
 
 def format_description(desc):
     return '; '.join(desc)
 
 
-def format_word_as_csv(word):
-    description = ''
+def word_fields(word):
+    "The (zi, pinyin, description) of a word"
     if len(word) > 2:
-        description = format_description(word[2])
-    return '"%s","%s","%s"' % (word[0], word[1], description)
+        return word[0], word[1], format_description(word[2])
+    return word[0], word[1] if len(word) > 1 else '', ''
+
+
+def tab_safe(field):
+    # Checking first is much cheaper than translating every field
+    if '\t' in field or '\n' in field or '\r' in field:
+        return field.translate(TAB_SAFE)
+    return field
+
+
+def format_words(words, dialect=CSVDialect, chunk_words=FORMAT_CHUNK_WORDS, encoding='utf-8'):
+    """Yield words as lines of dialect, chunk_words at a time, encoded.
+
+    dialect is a csv.Dialect with columns, the order of the ZI, PINYIN and
+    DESCRIPTION fields. Dialects without quoting are taken to be tab
+    separated, and tabs and line breaks in their fields become spaces.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect)
+    first, second, third = dialect.columns
+    delimiter, terminator = dialect.delimiter, dialect.lineterminator
+
+    words = iter(words)
+    while True:
+        chunk = list(itertools.islice(words, chunk_words))
+        if not chunk:
+            return
+
+        if dialect.quoting == csv.QUOTE_NONE:
+            # Nothing to quote, so joining is quicker than the csv writer
+            yield ''.join([delimiter.join((tab_safe(fields[first]),
+                                           tab_safe(fields[second]),
+                                           tab_safe(fields[third]))) + terminator
+                           for fields in map(word_fields, chunk)]).encode(encoding)
+        else:
+            writer.writerows([(fields[first], fields[second], fields[third])
+                              for fields in map(word_fields, chunk)])
+            yield buffer.getvalue().encode(encoding)
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def format_word_as_csv(word):
+    return ','.join('"%s"' % field.replace('"', '""') for field in word_fields(word))
 
 
 def format_word_as_tsv(word):
-    description = ''
-    if len(word) > 2:
-        description = format_description(word[2])
-    return '%s\t%s\t%s' % (word[0], description, word[1])
+    zi, pinyin, description = map(tab_safe, word_fields(word))
+    return '%s\t%s\t%s' % (zi, description, pinyin)
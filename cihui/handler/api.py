@@ -1,19 +1,16 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2014 Geoff van der Meer <gmwils@gmail.com>
 
-from base64 import b64encode
+from cihui import skritter
+from cihui import upload
+from cihui.data import wordlist
 from cihui.handler import common
-from datetime import datetime, timedelta
-from tornado import gen
 
 import base64
+import collections
 import functools
 import json
-import logging
-import tornado.httpclient
 import tornado.web
-import unicodedata
-import urllib.parse
 
 
 class APIHandler(common.BaseHandler):
@@ -54,28 +51,153 @@ class APIHandler(common.BaseHandler):
     def authenticate_api_user(self, user, passwd):
         return self.account_db.authenticate_api_user(user, passwd)
 
+    def write_json(self, params, status=200):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps(params))
+
+
+class APIStatsHandler(APIHandler):
+    def initialize(self, account_db, list_db, page_cache=None, token_manager=None,
+                   skritter_http=None):
+        self.account_db = account_db
+        self.list_db = list_db
+        self.page_cache = page_cache
+        self.token_manager = token_manager
+        self.skritter_http = skritter_http
+
+    def get(self):
+        stats = {'account_db': self.account_db.stats(),
+                 'list_db': self.list_db.stats()}
+        if self.page_cache is not None:
+            stats['page_cache'] = self.page_cache.stats()
+        if self.token_manager is not None:
+            stats['skritter_tokens'] = self.token_manager.stats()
+        if self.skritter_http is not None:
+            stats['skritter_http'] = self.skritter_http.stats()
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps(stats))
+
+
+# Most emails and account ids looked up by one request
+MAX_ACCOUNT_LOOKUPS = 1000
+
+
+def format_account(account):
+    result = {}
+    result['account_id'] = account['account_id']
+    result['account_email'] = account.get('account_email')
+    result['skritter_user'] = account.get('skritter_user', '')
+    result['skritter_access_token'] = account.get('skritter_access_token', '')
+    expiry_date = account.get('skritter_token_expiry', None)
+    if expiry_date is not None:
+        result['skritter_token_expiry'] = expiry_date.isoformat()
+
+    return result
+
+
+def parse_account_lookups(emails, account_ids):
+    "Unique emails and account ids to look up. Raises ValueError"
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        raise ValueError('emails must be a list of strings')
+    if not isinstance(account_ids, list) or \
+            not all(isinstance(account_id, int) and not isinstance(account_id, bool)
+                    for account_id in account_ids):
+        raise ValueError('account_ids must be a list of integers')
+
+    emails = list(collections.OrderedDict.fromkeys(email for email in emails if email))
+    account_ids = list(collections.OrderedDict.fromkeys(account_ids))
+    if len(emails) + len(account_ids) == 0:
+        raise ValueError('No emails or account_ids supplied')
+    if len(emails) + len(account_ids) > MAX_ACCOUNT_LOOKUPS:
+        raise ValueError('At most %d emails and account_ids per request' % MAX_ACCOUNT_LOOKUPS)
+
+    return emails, account_ids
+
 
 class APIAccountHandler(APIHandler):
     @tornado.web.asynchronous
     def get(self):
-        email = self.get_argument('email', None)
+        """Look up one account by email, or many by the comma separated
+        emails and account_ids arguments.
+        """
+        emails = self.get_argument('emails', None)
+        account_ids = self.get_argument('account_ids', None)
+        if emails is None and account_ids is None:
+            email = self.get_argument('email', None)
+
+            if email is not None:
+                self.account_db.get_account(email, self.got_account)
+            else:
+                self.got_account(None)
+            return
 
-        if email is not None:
-            self.account_db.get_account(email, self.got_account)
-        else:
-            self.got_account(None)
+        try:
+            emails = [email.strip() for email in (emails or '').split(',')]
+            try:
+                account_ids = [int(account_id) for account_id in (account_ids or '').split(',')
+                               if account_id.strip()]
+            except ValueError:
+                raise ValueError('account_ids must be integers')
+
+            self.get_accounts(*parse_account_lookups(emails, account_ids))
+        except ValueError as e:
+            self.failed_lookup(e)
+
+    @tornado.web.asynchronous
+    def post(self):
+        "Look up the accounts with the emails and account_ids of a JSON body"
+        try:
+            body_json = json.loads(self.request.body.decode('utf-8'))
+            if not isinstance(body_json, dict):
+                raise ValueError('Expected a JSON object')
+
+            self.get_accounts(*parse_account_lookups(body_json.get('emails', []),
+                                                     body_json.get('account_ids', [])))
+        except ValueError as e:
+            self.failed_lookup(e)
+
+    def get_accounts(self, emails, account_ids):
+        cb = functools.partial(self.got_accounts, emails, account_ids)
+        self.account_db.get_accounts(cb, emails=emails, account_ids=account_ids)
+
+    def got_accounts(self, emails, account_ids, accounts):
+        if accounts is None:
+            self.write_json({'error': 'Error: Failed to fetch accounts'}, status=500)
+            self.finish()
+            return
+
+        # Emails that differ only in case prefer the exact match, then the
+        # oldest account
+        by_email = {}
+        by_lower_email = {}
+        by_id = {}
+        for account in accounts:
+            by_email[account['account_email']] = account
+            by_lower_email.setdefault(account['account_email'].lower(), account)
+            by_id[account['account_id']] = account
+
+        def found(account):
+            if account is None:
+                return {'found': False}
+            return dict(format_account(account), found=True)
+
+        self.write_json({'emails': dict((email, found(by_email.get(email) or
+                                                      by_lower_email.get(email.lower())))
+                                        for email in emails),
+                         'account_ids': dict((str(account_id), found(by_id.get(account_id)))
+                                             for account_id in account_ids)})
+        self.finish()
+
+    def failed_lookup(self, error):
+        self.write_json({'error': 'Error: %s' % error}, status=400)
+        self.finish()
 
     def got_account(self, account):
         result = {}
         if account is not None:
-            result['account_id'] = account['account_id']
-            result['account_email'] = account.get('account_email')
-            result['skritter_user'] = account.get('skritter_user', '')
-            result['skritter_access_token'] = account.get('skritter_access_token', '')
-            expiry_date = account.get('skritter_token_expiry', None)
-            if expiry_date is not None:
-                result['skritter_token_expiry'] = expiry_date.isoformat()
-
+            result = format_account(account)
             self.write(json.dumps(result))
         else:
             self.set_status(500)
@@ -85,12 +207,15 @@ class APIAccountHandler(APIHandler):
 
 
 class APIAccountSkritterHandler(APIHandler):
-    def initialize(self, account_db, client_id, client_secret, redirect_uri):
+    def initialize(self, account_db, client_id, client_secret, redirect_uri, token_manager=None):
         super(APIAccountSkritterHandler, self).initialize(account_db)
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        self.token_manager = token_manager or skritter.TokenManager(account_db, client_id,
+                                                                    client_secret)
 
+    @tornado.web.asynchronous
     def post(self):
         email = self.get_argument('email', None)
 
@@ -99,80 +224,65 @@ class APIAccountSkritterHandler(APIHandler):
         else:
             self.got_account(None)
 
-    @tornado.web.asynchronous
     def got_account(self, account):
-        result = {}
-        if account is not None:
-            account_id = account['account_id']
-            skritter_refresh_token = account.get('skritter_refresh_token', None)
-
-            if skritter_refresh_token is None:
-                logging.error('Account does not have a Skritter token: %s', account_id)
-                self.finish()
-                return
-
-            # Request OAuth refresh token from Skritter
-            client = tornado.httpclient.AsyncHTTPClient()
-            params = {
-                'grant_type': 'refresh_token',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'refresh_token': skritter_refresh_token
-                }
-
-            data = urllib.parse.urlencode(params)
-            token_url = 'https://www.skritter.com/api/v0/oauth2/token?%s' % data
-            credentials = '%s:%s' % (self.client_id, self.client_secret)
-            credentials = b'basic ' + b64encode(credentials.encode('utf-8'))
-
-            headers = {'AUTHORIZATION': credentials}
-            cb = functools.partial(self._on_handle_refresh_token, account_id)
-            client.fetch(token_url, cb, headers=headers)
-
-        else:
+        if not account:
             # TODO(gmwils): set an error code
-            self.write(json.dumps(result))
-            self.finish()
-
-    @tornado.web.asynchronous
-    @gen.engine
-    def _on_handle_refresh_token(self, account_id, response):
-        # TODO(gmwils): refactor against skritter.py
-        if response.error or response.code != 200:
-            logging.error('Error requesting Skritter OAuth token: %s', response.error)
+            self.write(json.dumps({}))
             self.finish()
             return
 
-        token_response = json.loads(response.body.decode('utf-8'))
-
-        skritter_user_id = token_response.get('user_id')
-        access_token = token_response.get('access_token')
-        expires_in = token_response.get('expires_in', 0)
-        refresh_token = token_response.get('refresh_token')
-        expiry_date = datetime.utcnow() + timedelta(seconds=expires_in)
-
-        error = yield gen.Task(self.account_db.store_skritter_token,
-                               account_id,
-                               skritter_user_id,
-                               access_token,
-                               refresh_token,
-                               expiry_date)
+        self.token_manager.get_token(account, self.got_token)
 
-        if error is not None:
-            logging.error('Error storing Skritter refresh token')
+    def got_token(self, token):
+        if token is None:
+            self.write_json({'error': 'Error: No Skritter token'}, status=502)
         else:
-            result = {}
-            result['skritter_access_token'] = access_token
-            self.write(json.dumps(result))
+            self.write_json({'skritter_access_token': token['access_token'],
+                             'skritter_token_expiry': token['expiry'].isoformat()})
+
+        self.finish()
 
 
 def normalize_word_array(word):
-    zi, pinyin, definitions = word
-    definitions = [unicodedata.normalize('NFC', definition) for definition in definitions]
+    "NFC normalize a [zi, pinyin, definitions] word. Raises upload.WordError"
+    return upload.WordNormalizer().word(word)
+
 
-    return [unicodedata.normalize('NFC', zi),
-            unicodedata.normalize('NFC', pinyin),
-            definitions]
+# Bytes of an upload passed to the parser at a time
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+# Most lists fetched by one GET
+MAX_LIST_IDS = 100
+
+# Values of the fields argument of a GET
+LIST_FIELDS = ('metadata', 'words')
+
+
+def parse_list_ids(ids):
+    "Unique list ids from a comma separated string. Raises ValueError"
+    list_ids = []
+    for list_id in ids.split(','):
+        if list_id.strip():
+            try:
+                list_id = int(list_id)
+            except ValueError:
+                raise ValueError('ids must be integers')
+            if list_id not in list_ids:
+                list_ids.append(list_id)
+
+    if len(list_ids) == 0:
+        raise ValueError('No list ids supplied')
+    if len(list_ids) > MAX_LIST_IDS:
+        raise ValueError('At most %d list ids per request' % MAX_LIST_IDS)
+
+    return list_ids
+
+
+def format_list(word_list):
+    "JSON ready copy of a list from get_lists_by_id"
+    return dict(word_list,
+                modified_at=word_list['modified_at'].isoformat(),
+                list_path='/list/%d.html' % word_list['id'])
 
 
 class APIListHandler(APIHandler):
@@ -180,54 +290,314 @@ class APIListHandler(APIHandler):
         self.account_db = account_db
         self.list_db = list_db
 
+    def prepare(self):
+        "Refuse uploads over upload.MAX_UPLOAD_BYTES by their Content-Length"
+        try:
+            content_length = int(self.request.headers.get('Content-Length', 0))
+        except ValueError:
+            self.failed_upload(upload.UploadError('Invalid Content-Length'))
+            return
+
+        if self.request.method == 'POST' and content_length > upload.MAX_UPLOAD_BYTES:
+            self.failed_upload(upload.UploadError('Upload larger than %d bytes' %
+                                                  upload.MAX_UPLOAD_BYTES, 413))
+
+    @tornado.web.asynchronous
+    def get(self):
+        """Fetch the lists with the comma separated ids, either with a page
+        of their words or, with fields=metadata, without.
+        """
+        try:
+            list_ids = parse_list_ids(self.get_argument('ids', ''))
+            fields = self.get_argument('fields', 'words')
+            if fields not in LIST_FIELDS:
+                raise ValueError('fields must be one of %s' % ', '.join(LIST_FIELDS))
+
+            account_id = self.get_int_argument('account_id', None)
+            after_position = self.get_int_argument('after', -1)
+            limit = self.get_int_argument('limit', wordlist.WORD_PAGE_SIZE)
+            if not 0 < limit <= wordlist.WORD_PAGE_SIZE:
+                raise ValueError('limit must be from 1 to %d' % wordlist.WORD_PAGE_SIZE)
+
+        except ValueError as e:
+            self.write_json({'error': 'Error: %s' % e}, status=400)
+            self.finish()
+            return
+
+        cb = functools.partial(self.got_lists, list_ids)
+        self.list_db.get_lists_by_id(list_ids, cb, account_id=account_id,
+                                     words=(fields == 'words'),
+                                     after_position=after_position, limit=limit)
+
+    def get_int_argument(self, name, default):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('%s must be an integer' % name)
+
+    def got_lists(self, list_ids, word_lists):
+        if word_lists is None:
+            self.failed_list('Failed to fetch lists')
+            return
+
+        found = set(word_list['id'] for word_list in word_lists)
+        self.write_json({'lists': [format_list(word_list) for word_list in word_lists],
+                         'missing': [list_id for list_id in list_ids if list_id not in found]})
+        self.finish()
+
     @tornado.web.asynchronous
     def post(self):
-        body_str = self.request.body.decode('utf-8')
-        body_json = json.loads(body_str)
-        list_name = body_json.get('title', None)
-        words = body_json.get('words', None)
-        account_id = body_json.get('account_id', None)
+        if self.get_argument('title', None) is not None:
+            self.post_words()
+            return
+
+        try:
+            body_json = json.loads(self.request.body.decode('utf-8'))
+            list_name = body_json.get('title', None)
+            words = body_json.get('words', None)
+            account_id = body_json.get('account_id', None)
+        except (AttributeError, TypeError, ValueError) as e:
+            self.failed_upload(upload.UploadError('Invalid JSON body: %s' % e))
+            return
 
         if list_name is None:
-            self.created_list(False, 'Missing title')
+            self.failed_list('Missing title')
             return
 
-        if words is None or len(words) == 0:
-            self.created_list(False, 'No word list supplied')
+        # Anything else that is not a list is reported by WordNormalizer
+        if words in (None, [], ''):
+            self.failed_list('No word list supplied')
             return
 
         if account_id is None:
-            self.created_list(False, 'Account id required')
+            self.failed_list('Account id required')
+            return
+
+        try:
+            words = upload.WordNormalizer().words(words)
+        except upload.WordError as e:
+            self.failed_upload(upload.UploadError('Invalid words', errors=e.errors))
             return
 
-        words = [normalize_word_array(word) for word in words]
+        self.list_db.upsert_list(list_name, words, account_id, self.saved_list)
+
+    def post_words(self):
+        """Save a list whose words are the body, as a JSON array or as
+        NDJSON (Content-Type application/x-ndjson), with the title and
+        account_id as arguments.
+        """
+        list_name = self.get_argument('title')
+        ndjson = self.request.headers.get('Content-Type', '').startswith('application/x-ndjson')
+        parser = upload.WordParser(ndjson=ndjson)
+
+        try:
+            account_id = int(self.get_argument('account_id'))
+        except (tornado.web.MissingArgumentError, ValueError):
+            self.failed_upload(upload.UploadError('Account id required'))
+            return
 
-        cb = functools.partial(self.on_list_exists,
-                               list_name,
-                               words,
-                               account_id)
+        # Tornado has read the whole body by now, but parsing it a slice at
+        # a time avoids decoding it in one piece and stops at the first
+        # malformed word
+        try:
+            body = memoryview(self.request.body)
+            for start in range(0, len(body), UPLOAD_CHUNK_BYTES):
+                parser.feed(body[start:start + UPLOAD_CHUNK_BYTES])
+            words = parser.close()
+        except upload.UploadError as e:
+            self.failed_upload(e)
+            return
+
+        if len(words) == 0:
+            self.failed_upload(upload.UploadError('No word list supplied'))
+            return
 
-        self.list_db.list_exists_for_account(list_name, account_id, cb)
+        self.list_db.upsert_list(list_name, words, account_id, self.saved_list)
 
-    def on_list_exists(self, list_name, words, account_id, list_id=None):
-        self.list_db.create_list(list_name, words, self.created_list,
-                                 list_id, account_id=account_id)
+    def failed_upload(self, error):
+        result = {'error': 'Error: %s' % error}
+        if error.errors is not None:
+            result['errors'] = error.errors
+
+        self.write_json(result, status=error.status)
+        self.finish()
+
+    def saved_list(self, list_id, created):
+        if list_id is None:
+            self.failed_list()
+            return
 
-    def created_list(self, success, reason=None, list_id=None):
-        params = {}
-        if success:
-            self.set_status(201)
-            if list_id is not None:
-                params['list_id'] = list_id
-                params['list_path'] = '/list/%d.html' % list_id
+        params = {'list_id': list_id,
+                  'list_path': '/list/%d.html' % list_id,
+                  'created': created}
+        self.write_json(params, status=201 if created else 200)
+        self.finish()
 
+    def failed_list(self, reason=None):
+        if reason is not None:
+            error = 'Error: %s' % reason
         else:
-            self.set_status(500)
-            if reason is not None:
-                params['error'] = 'Error: %s' % reason
+            error = 'Failed to create list.'
+
+        self.write_json({'error': error}, status=500)
+        self.finish()
+
+
+def parse_list_operations(operations):
+    """Check and normalize PATCH operations for WordListData.patch_list.
+
+    Raises ValueError describing the first invalid operation.
+    """
+    if not isinstance(operations, list) or len(operations) == 0:
+        raise ValueError('No operations supplied')
+
+    normalizer = upload.WordNormalizer()
+    parsed = []
+    for index, operation in enumerate(operations):
+        action = None
+        if isinstance(operation, dict):
+            action = operation.get('op')
+
+        try:
+            if action == 'append':
+                words = operation.get('words')
+                if not words:
+                    raise ValueError('no words to append')
+                parsed.append(('append', normalizer.words(words)))
+
+            elif action in ('remove', 'replace'):
+                position = operation.get('position')
+                if not isinstance(position, int) or isinstance(position, bool) or position < 0:
+                    raise ValueError('position must be a non-negative integer')
+
+                if action == 'remove':
+                    parsed.append(('remove', position))
+                else:
+                    word = operation.get('word')
+                    if word is None:
+                        raise ValueError('no replacement word')
+                    parsed.append(('replace', position, normalizer.word(word)))
+
             else:
-                params['error'] = 'Failed to create list.'
+                raise ValueError('unknown op %r' % (action,))
+
+        except (TypeError, ValueError) as e:
+            raise ValueError('Operation %d: %s' % (index, e))
+
+    return parsed
+
+
+class APIListUpdateHandler(APIHandler):
+    def initialize(self, account_db, list_db):
+        self.account_db = account_db
+        self.list_db = list_db
+
+    @tornado.web.asynchronous
+    def patch(self, list_id):
+        try:
+            body_json = json.loads(self.request.body.decode('utf-8'))
+            account_id = body_json.get('account_id', None)
+            if not isinstance(account_id, int):
+                raise ValueError('Account id required')
+
+            operations = parse_list_operations(body_json.get('operations', None))
+
+        except (AttributeError, ValueError) as e:
+            self.write_json({'error': 'Error: %s' % e}, status=400)
+            self.finish()
+            return
+
+        cb = functools.partial(self.patched_list, int(list_id))
+        self.list_db.patch_list(int(list_id), account_id, operations, cb)
+
+    def patched_list(self, list_id, word_count, missing_word=None):
+        if missing_word is not None:
+            # The client's copy of the list is out of date
+            self.write_json({'error': 'Error: %s' % missing_word}, status=409)
+        elif word_count is None:
+            self.write_json({'error': 'Error: No list %d for account' % list_id}, status=404)
+        else:
+            self.write_json({'list_id': list_id, 'word_count': word_count})
+
+        self.finish()
+
+
+def format_push(push, list_id):
+    "JSON ready copy of a Skritter push"
+    return dict(push,
+                created_at=push['created_at'].isoformat(),
+                modified_at=push['modified_at'].isoformat(),
+                push_path='/api/list/%d/skritter/%d' % (list_id, push['id']))
+
+
+class APIListSkritterHandler(APIHandler):
+    def initialize(self, account_db, list_db):
+        self.account_db = account_db
+        self.list_db = list_db
+
+    @tornado.web.asynchronous
+    def post(self, list_id):
+        """Queue a push of the list to the account's Skritter vocab lists,
+        or resume the account's unfinished push of it.
+        """
+        try:
+            body_json = json.loads(self.request.body.decode('utf-8'))
+            account_id = body_json.get('account_id', None)
+            if not isinstance(account_id, int):
+                raise ValueError('Account id required')
+        except (AttributeError, ValueError) as e:
+            self.write_json({'error': 'Error: %s' % e}, status=400)
+            self.finish()
+            return
+
+        cb = functools.partial(self.queued_push, int(list_id))
+        self.list_db.queue_skritter_push(int(list_id), account_id, cb)
+
+    def queued_push(self, list_id, push):
+        if push is None:
+            self.write_json({'error': 'Error: No list %d for account' % list_id}, status=404)
+        else:
+            self.write_json(format_push(push, list_id), status=202)
+
+        self.finish()
+
+    @tornado.web.asynchronous
+    def get(self, list_id, push_id=None):
+        "Fetch a push with a page of its word results"
+        if push_id is None:
+            raise tornado.web.HTTPError(405)
+
+        try:
+            after = int(self.get_argument('after', -1))
+            limit = int(self.get_argument('limit', wordlist.PUSH_WORD_PAGE_SIZE))
+            if not 0 < limit <= wordlist.PUSH_WORD_PAGE_SIZE:
+                raise ValueError('limit must be from 1 to %d' % wordlist.PUSH_WORD_PAGE_SIZE)
+        except ValueError as e:
+            self.write_json({'error': 'Error: %s' % e}, status=400)
+            self.finish()
+            return
+
+        cb = functools.partial(self.got_push, int(list_id), after, limit)
+        self.list_db.get_skritter_push(int(push_id), cb)
+
+    def got_push(self, list_id, after, limit, push):
+        if push is None or push['list_id'] != list_id:
+            self.write_json({'error': 'Error: No such push of list %d' % list_id}, status=404)
+            self.finish()
+            return
+
+        cb = functools.partial(self.got_push_words, format_push(push, list_id))
+        self.list_db.get_skritter_push_words(push['id'], cb, after=after, limit=limit)
+
+    def got_push_words(self, push, words):
+        if words is None:
+            self.write_json({'error': 'Error: Failed to fetch push results'}, status=500)
+        else:
+            push.update(words)
+            self.write_json(push)
 
-        self.set_header('Content-Type', 'application/json; charset=UTF-8')
-        self.write(json.dumps(params))
         self.finish()
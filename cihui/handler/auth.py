@@ -25,8 +25,12 @@ class LoginHandler(common.BaseHandler):
                                               self.authenticated)
 
     @tornado.web.asynchronous
-    def authenticated(self, user_id=None, redirect_url=None, username=None):
-        if user_id is not None:
+    def authenticated(self, user_id=None, redirect_url=None, username=None, error=None):
+        if error is not None:
+            # The password could not be checked, which says nothing about
+            # whether it was right
+            self.send_error(503)
+        elif user_id is not None:
             self.set_secure_cookie('session_id', '%s|%s' % (user_id, username),
                                    expires_days=30)
             self.redirect(redirect_url or '/')
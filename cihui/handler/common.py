@@ -1,9 +1,33 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import datetime
+import email.utils
+import hashlib
 import tornado.web
 
 
+def make_etag(*parts):
+    "Strong entity tag for a response built from parts"
+    digest = hashlib.sha1('|'.join(map(str, parts)).encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    "Whether an If-None-Match header lists etag, using weak comparison"
+    if if_none_match.strip() == '*':
+        return True
+
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+
 class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
         # TODO(gmwils): refactor & test
@@ -13,3 +37,37 @@ class BaseHandler(tornado.web.RequestHandler):
             return user_id
 
         return None
+
+    def not_modified(self, modified_at, *parts):
+        """Set ETag and Last-Modified for a response built from data last
+        modified at modified_at, and send a 304 if the client's copy is
+        current. parts are whatever else the response depends on.
+
+        Returns True if the response has been finished.
+        """
+        if modified_at is None:
+            return False
+
+        etag = make_etag(modified_at.isoformat(), *parts)
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', modified_at)
+
+        # If-Modified-Since is only used by clients without the etag, and
+        # Last-Modified has whole seconds
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            current = etag_matches(if_none_match, etag)
+        else:
+            current = False
+            if_modified_since = self.request.headers.get('If-Modified-Since')
+            if if_modified_since is not None:
+                date_tuple = email.utils.parsedate(if_modified_since)
+                if date_tuple is not None:
+                    since = datetime.datetime(*date_tuple[:6])
+                    current = since >= modified_at.replace(microsecond=0)
+
+        if current:
+            self.set_status(304)
+            self.finish()
+
+        return current
@@ -1,35 +1,25 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
 
-from base64 import b64encode
+from cihui import skritter
 from cihui.handler import common
-from datetime import datetime, timedelta
-from tornado import gen
 
-import json
-import logging
-import tornado.httpclient
 import tornado.web
-import urllib.parse
 
 
 class AuthHandler(common.BaseHandler):
-    def initialize(self, account_db, client_id, client_secret, redirect_uri):
+    def initialize(self, account_db, client_id, client_secret, redirect_uri, token_manager=None):
         self.account_db = account_db
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        self.token_manager = token_manager or skritter.TokenManager(account_db, client_id,
+                                                                    client_secret)
 
     @tornado.web.asynchronous
     def get(self, action=None):
         if action == 'get':
-            params = {
-                'response_type': 'code',
-                'client_id': self.client_id,
-                'redirect_uri': self.redirect_uri,
-                }
-            data = urllib.parse.urlencode(params)
-            self.redirect('https://www.skritter.com/api/v0/oauth2/authorize?%s' % data)
+            self.redirect(skritter.authorize_url(self.client_id, self.redirect_uri))
 
         elif action == 'auth':
             code = self.get_argument('code', None)
@@ -38,51 +28,31 @@ class AuthHandler(common.BaseHandler):
                 self.redirect('/')
                 return
 
-            # Request OAuth token from Skritter
-            client = tornado.httpclient.AsyncHTTPClient()
-            params = {
-                'grant_type': 'authorization_code',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'redirect_uri': self.redirect_uri,
-                'code': code
-                }
-
-            data = urllib.parse.urlencode(params)
-            token_url = 'https://www.skritter.com/api/v0/oauth2/token?%s' % data
-            credentials = '%s:%s' % (self.client_id, self.client_secret)
-            credentials = b'basic ' + b64encode(credentials.encode('utf-8'))
-
-            headers = {'AUTHORIZATION': credentials}
-            client.fetch(token_url, self.handle_token, headers=headers)
+            self.token_manager.authorize(self.current_user, code, self.redirect_uri,
+                                         self.got_token)
 
         else:
             self.redirect('/')
 
-    @tornado.web.asynchronous
-    @gen.engine
-    def handle_token(self, response):
-        if response.error or response.code != 200:
-            logging.error('Error requesting Skritter OAuth token: %s', response.error)
+    def got_token(self, token):
+        if token is not None:
+            self.redirect('/user/%s' % self.current_user)
+        else:
             self.redirect('/')
-            return
 
-        token_response = json.loads(response.body.decode('utf-8'))
 
-        user_id = token_response.get('user_id')
-        access_token = token_response.get('access_token')
-        expires_in = token_response.get('expires_in', 0)
-        refresh_token = token_response.get('refresh_token')
-        expiry_date = datetime.utcnow() + timedelta(seconds=expires_in)
+class ListPushHandler(common.BaseHandler):
+    "Queue a push of a list to the logged in user's Skritter account"
+    def initialize(self, list_db):
+        self.list_db = list_db
 
-        error = yield gen.Task(self.account_db.store_skritter_token,
-                               self.current_user,
-                               user_id,
-                               access_token,
-                               refresh_token,
-                               expiry_date)
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def post(self, list_id):
+        self.list_db.queue_skritter_push(int(list_id), int(self.current_user), self.queued_push)
 
-        if error is None:
-            self.redirect('/user/%s' % self.current_user)
-        else:
+    def queued_push(self, push):
+        if push is None:
             self.redirect('/')
+        else:
+            self.redirect('/list/%d?skritter=%s' % (push['list_id'], push['status']))
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import functools
+import gzip
+import tornado.concurrent
+import tornado.escape
 import tornado.web
+import zlib
 
 from cihui import atom_formatter
 from cihui import formatter
+from cihui.data import wordlist
 from cihui.handler import common
 
 from tornado import gen
@@ -13,6 +19,35 @@ from tornado import gen
 class BaseListHandler(common.BaseHandler):
     def initialize(self, list_db):
         self.list_db = list_db
+        self.client_closed = False
+        self.flushed = None
+
+    def on_connection_close(self):
+        self.client_closed = True
+        self._on_flushed(self.flushed)
+
+    def encode(self, chunk):
+        "The bytes to send for chunk"
+        return tornado.escape.utf8(chunk)
+
+    def write_chunk(self, chunk):
+        """Write and flush a chunk of the response.
+
+        The future resolves once the chunk is on the socket, or straight
+        away if the client has disconnected.
+        """
+        self.flushed = tornado.concurrent.Future()
+        if self.client_closed:
+            self.flushed.set_result(None)
+        else:
+            self.write(self.encode(chunk))
+            self.flush(callback=functools.partial(self._on_flushed, self.flushed))
+
+        return self.flushed
+
+    def _on_flushed(self, flushed):
+        if flushed is not None and not flushed.done():
+            flushed.set_result(None)
 
     def format_wordlists(self, word_lists):
         if word_lists is None:
@@ -25,6 +60,24 @@ class BaseListHandler(common.BaseHandler):
 
         return list(map(add_stub, word_lists))
 
+    def get_page_cursor(self):
+        "The (modified_at, id) the requested page starts after, if any"
+        before = self.get_argument('before', None)
+        if before is None:
+            return None
+
+        try:
+            return wordlist.parse_list_cursor(before)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+    def next_page_uri(self, word_lists, limit=wordlist.LIST_PAGE_SIZE):
+        if word_lists is None or len(word_lists) < limit:
+            return None
+
+        return '%s?before=%s' % (self.request.path,
+                                 wordlist.make_list_cursor(word_lists[-1]))
+
 
 def make_stub(list_id, stub=''):
     if stub:
@@ -41,10 +94,18 @@ class IndexHandler(BaseListHandler):
             self.redirect('/home')
             return
 
-        word_lists = yield gen.Task(self.list_db.get_lists)
+        version = yield gen.Task(self.list_db.get_lists_version)
+        if version is not None and self.not_modified(version['modified_at'], version['count'],
+                                                     'index', self.request.uri):
+            return
+
+        word_lists = yield gen.Task(self.list_db.get_lists,
+                                    before=self.get_page_cursor(),
+                                    limit=wordlist.LIST_PAGE_SIZE)
+        next_page = self.next_page_uri(word_lists)
         word_lists = self.format_wordlists(word_lists)
 
-        self.render('index.html', word_lists=word_lists)
+        self.render('index.html', word_lists=word_lists, next_page=next_page)
 
 
 class HomeHandler(BaseListHandler):
@@ -56,36 +117,125 @@ class HomeHandler(BaseListHandler):
             return
 
         word_lists = yield gen.Task(self.list_db.get_user_lists,
-                                    self.current_user)
+                                    self.current_user,
+                                    before=self.get_page_cursor(),
+                                    limit=wordlist.LIST_PAGE_SIZE)
+        next_page = self.next_page_uri(word_lists)
         word_lists = self.format_wordlists(word_lists)
 
-        self.render('home.html', word_lists=word_lists)
+        self.render('home.html', word_lists=word_lists, next_page=next_page)
+
+
+# Entries in each page of the Atom feed
+ATOM_MAX_ENTRIES = wordlist.LIST_PAGE_SIZE
 
 
 class AtomHandler(BaseListHandler):
+    def initialize(self, list_db, page_cache=None, max_entries=ATOM_MAX_ENTRIES):
+        super(AtomHandler, self).initialize(list_db)
+        self.page_cache = page_cache
+        self.max_entries = max_entries
+
     @tornado.web.asynchronous
-    @gen.engine
+    @gen.coroutine
     def get(self):
-        word_lists = yield gen.Task(self.list_db.get_lists)
-        entry_list = []
-        for word_list in word_lists:
-            entry = {'title': word_list.get('title'),
-                     'link': '/list/%s' % make_stub(word_list.get('id'),
-                                                    word_list.get('stub'))}
-            entry_list.append(entry)
+        before = self.get_page_cursor()
+        version = yield gen.Task(self.list_db.get_lists_version)
+        if version is not None and self.not_modified(version['modified_at'], version['count'],
+                                                     'atom', self.request.uri):
+            return
 
-        self.write(atom_formatter.format_atom(title='CiHui',
-                                              entries=entry_list))
+        self.set_header('Content-Type', 'application/atom+xml; charset=utf-8')
+
+        # Feeds are cached until a public list changes
+        cache_key = ('atom', self.request.host, self.request.uri)
+        if version is not None and self.page_cache is not None:
+            feed = self.page_cache.get(cache_key, version)
+            if feed is not None:
+                self.finish(feed)
+                return
+
+        word_lists = yield gen.Task(self.list_db.get_lists,
+                                    before=before,
+                                    limit=self.max_entries)
+        word_lists = word_lists or []
+
+        links = []
+        next_page = self.next_page_uri(word_lists, self.max_entries)
+        if next_page is not None:
+            links.append({'rel': 'next', 'href': next_page})
+
+        pieces = []
+        sent = 0
+        writer = atom_formatter.AtomWriter(pieces.append,
+                                           title='CiHui',
+                                           links=links,
+                                           feed_id=self.absolute_uri('/atom.xml'),
+                                           updated=version and version['modified_at'],
+                                           max_entries=self.max_entries)
+        for word_list in word_lists:
+            link = '/list/%s' % make_stub(word_list.get('id'), word_list.get('stub'))
+            writer.add_entry({'title': word_list.get('title'),
+                              'link': link,
+                              'id': self.absolute_uri('/list/%s' % word_list.get('id')),
+                              'updated': word_list.get('modified_at')})
+
+            # Send each entry as it is written, so the feed is not held
+            # until finish()
+            yield self.write_chunk(b''.join(pieces[sent:]))
+            sent = len(pieces)
+            if self.client_closed:
+                return
+        writer.close()
+        self.write(b''.join(pieces[sent:]))
+
+        if version is not None and self.page_cache is not None:
+            self.page_cache.put(cache_key, b''.join(pieces), version)
         self.finish()
 
+    def absolute_uri(self, path):
+        return '%s://%s%s' % (self.request.protocol, self.request.host, path)
+
 
 def add_description(entry):
+    # Words may be shared with the list cache, so copy rather than append
     if entry is not None:
-        entry.append(formatter.format_description(entry[2]))
+        entry = entry + [formatter.format_description(entry[2])]
     return entry
 
 
+EXPORT_FORMATS = {'.csv': ('text/csv', formatter.CSVDialect),
+                  '.tsv': ('text/tsv', formatter.TSVDialect),
+                  '.pleco': ('text/plain', formatter.PlecoDialect),
+                  '.anki': ('text/plain', formatter.AnkiDialect)}
+
+# Words formatted and flushed to the client at a time when exporting
+EXPORT_CHUNK_WORDS = wordlist.WORD_PAGE_SIZE
+
+# Upper bound on the memory used by cached, gzipped pages and exports
+PAGE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Pages larger than this once gzipped are sent without being cached
+PAGE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+GZIP_LEVEL = 6
+
+
+def gzip_compressor():
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
 class WordListHandler(BaseListHandler):
+    def initialize(self, list_db, page_cache=None):
+        super(WordListHandler, self).initialize(list_db)
+        self.page_cache = page_cache
+
+        # Responses are gzipped as they are written, to fill page_cache
+        # and for clients that accept it
+        self.gzip = False
+        self.compressor = None
+        self.compressed = None
+
     def valid_to_show_list(self, word_list):
         if word_list is None:
             return False
@@ -101,47 +251,182 @@ class WordListHandler(BaseListHandler):
     @tornado.web.asynchronous
     @gen.coroutine
     def get(self, list_id, list_format):
-        word_list = yield gen.Task(self.list_db.get_word_list, int(list_id))
+        # Only the list's metadata is needed to answer a conditional request
+        list_info = yield gen.Task(self.list_db.get_list_info, int(list_id))
 
-        if not self.valid_to_show_list(word_list):
-            if not self.current_user:
-                self.redirect('/')
-            else:
-                self.redirect('/home')
+        if not self.valid_to_show_list(list_info):
+            self.redirect_invalid_list()
+            return
+
+        if not list_info.get('public'):
+            self.set_header('Cache-Control', 'private')
 
+        export = list_format in EXPORT_FORMATS
+        validator = [list_info['id'], list_format if export else 'html']
+        skritter_push = None
+        if not export:
+            # Download links are built from the path the page was requested by
+            base_uri = self.get_base_uri()
+            validator.append(base_uri)
+
+            # The page shows who is logged in, so only anonymous pages are cached
+            self.add_header('Vary', 'Cookie')
+            validator.append(self.current_user)
+            if self.current_user:
+                skritter_push = self.get_argument('skritter', None)
+                validator.append(skritter_push)
+
+        cacheable = self.page_cache is not None and (export or self.current_user is None)
+        if cacheable:
+            self.add_header('Vary', 'Accept-Encoding')
+            self.gzip = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+            if self.gzip:
+                validator.append('gzip')
+
+        if self.not_modified(list_info.get('modified_at'), *validator):
             return
 
-        if list_format == '.csv':
-            self.set_content_header('text/csv')
+        if export:
+            self.set_content_header(EXPORT_FORMATS[list_format][0])
 
-            for word in word_list['words']:
-                self.write('%s\n' % (formatter.format_word_as_csv(word)))
-            self.finish()
+        if cacheable:
+            cache_key = tuple(validator[:2 if export else 3])
+            body = self.page_cache.get(cache_key, list_info['modified_at'])
+            if body is not None:
+                self.finish_compressed(body)
+                return
 
-        elif list_format == '.tsv':
-            self.set_content_header('text/tsv')
+            self.start_compressing(cache_key, list_info['modified_at'])
 
-            for word in word_list['words']:
-                self.write('%s\n' % (formatter.format_word_as_tsv(word)))
-            self.finish()
+        if export:
+            yield self.export_list(list_info, list_format)
+            return
+
+        word_list = yield gen.Task(self.list_db.get_word_list, list_info['id'],
+                                   list_info=list_info)
 
-        elif word_list is not None:  # html list
+        if word_list is not None:  # html list
             words = word_list.get('words', [])
             words = list(map(add_description, words))
             word_count = len(words)
 
-            base_uri = self.get_base_uri()
-
-            self.render('word_list.html',
-                        title=word_list.get('title', ''),
-                        word_list_id=word_list.get('id', 0),
-                        modified_at=word_list.get('modified_at'),
-                        words=words,
-                        word_count=word_count,
-                        base_uri=base_uri)
+            html = self.render_string('word_list.html',
+                                      title=word_list.get('title', ''),
+                                      word_list_id=word_list.get('id', 0),
+                                      modified_at=word_list.get('modified_at'),
+                                      words=words,
+                                      word_count=word_count,
+                                      base_uri=base_uri,
+                                      skritter_push=skritter_push)
+            self.write(self.encode(html))
+            self.finish(self.encode_end())
         else:
             self.send_error(404)
 
+    @gen.coroutine
+    def export_list(self, word_list, list_format):
+        list_id = word_list['id']
+        dialect = EXPORT_FORMATS[list_format][1]
+
+        # Each chunk is sent before the next is read, so an export holds
+        # at most one chunk in memory
+        if word_list.get('word_count') is None:
+            # Words have not been moved to list_word yet
+            word_list = yield gen.Task(self.list_db.get_word_list, list_id,
+                                       list_info=word_list)
+            if word_list is None:
+                self.abort_export(404)
+                return
+            words = word_list.get('words') or []
+            for chunk in formatter.format_words(words, dialect, EXPORT_CHUNK_WORDS):
+                if self.client_closed:
+                    return
+                yield self.write_chunk(chunk)
+        else:
+            position = -1
+            while position is not None:
+                page = yield gen.Task(self.list_db.get_list_words, list_id,
+                                      after_position=position, limit=EXPORT_CHUNK_WORDS)
+                if self.client_closed:
+                    return
+                if page is None:
+                    self.abort_export()
+                    return
+                yield self.write_chunk(b''.join(formatter.format_words(page['words'], dialect,
+                                                                       EXPORT_CHUNK_WORDS)))
+                position = page['next_position']
+
+        self.finish(self.encode_end())
+
+    def abort_export(self, status=500):
+        "End an export that could not be read in full, without caching it"
+        self.compressor = None
+        self.compressed = None
+        if self.flushed is None:
+            self.send_error(status)
+        else:
+            # The status has been sent, so only a cut off response tells
+            # the client the export is incomplete
+            self.request.connection.stream.close()
+
+    def start_compressing(self, cache_key, version):
+        "Gzip what is written from here on, and cache it under cache_key"
+        self.compressor = gzip_compressor()
+        self.compressed = []
+        self.compressed_size = 0
+        self.cache_key = cache_key
+        self.cache_version = version
+        if self.gzip:
+            self.set_header('Content-Encoding', 'gzip')
+
+    def encode(self, chunk):
+        "The bytes to send for chunk, keeping them for the cache if compressing"
+        chunk = tornado.escape.utf8(chunk)
+        if self.compressor is None:
+            return chunk
+
+        # Sync each chunk so the client can decompress what it has so far
+        compressed = self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.keep_compressed(compressed)
+        return compressed if self.gzip else chunk
+
+    def encode_end(self):
+        "The bytes that end the response, caching it if compressing"
+        if self.compressor is None:
+            return b''
+
+        compressed = self.compressor.flush()
+        self.keep_compressed(compressed)
+        if self.compressed is not None:
+            self.page_cache.put(self.cache_key, b''.join(self.compressed), self.cache_version)
+        self.compressor = None
+
+        return compressed if self.gzip else b''
+
+    def keep_compressed(self, compressed):
+        if self.compressed is None:
+            return
+
+        self.compressed_size += len(compressed)
+        if self.compressed_size > PAGE_CACHE_MAX_ENTRY_BYTES:
+            self.compressed = None
+        else:
+            self.compressed.append(compressed)
+
+    def finish_compressed(self, body):
+        "Send a cached, gzipped body"
+        if self.gzip:
+            self.set_header('Content-Encoding', 'gzip')
+        else:
+            body = gzip.decompress(body)
+        self.finish(body)
+
+    def redirect_invalid_list(self):
+        if not self.current_user:
+            self.redirect('/')
+        else:
+            self.redirect('/home')
+
     def set_content_header(self, content_type='text/csv'):
         self.set_header('Content-Type', '%s; charset=utf-8' % content_type)
         self.set_status(200)
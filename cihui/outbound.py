@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
+
+import collections
+import functools
+import logging
+import random
+import time
+import tornado.httpclient
+import tornado.ioloop
+
+
+# Concurrent connections to a service; further requests queue for one
+MAX_CLIENTS = 10
+
+# Seconds to wait for a connection, and for the whole request
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 15
+
+# Idempotent requests that fail with a connection error, timeout or 5xx
+# are retried up to RETRIES times, waiting RETRY_BACKOFF seconds and then
+# doubling, up to MAX_BACKOFF
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+# The breaker opens after FAILURE_THRESHOLD failures in a row, and lets a
+# trial request through RESET_TIMEOUT seconds later
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+# Requests per second sent to a service, or None for no limit
+RATE = None
+
+# Recent request times kept for the latency stats
+LATENCY_SAMPLES = 1000
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class CircuitOpenError(HTTPError):
+    "A request not sent because the service's breaker is open"
+    def __init__(self, name):
+        super(CircuitOpenError, self).__init__(599, 'Circuit open for %s' % name)
+
+
+def is_failure(response):
+    "Whether a response shows the service is unhealthy"
+    return response.code == 599 or response.code >= 500
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class CircuitBreaker(object):
+    """Fail fast while a service is failing.
+
+    closed: requests are sent. After threshold failures in a row it opens.
+    open: requests are refused until reset_timeout has passed.
+    half-open: one trial request is sent; it closes the breaker if it
+    succeeds and opens it again if it fails.
+    """
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self._state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self._state == 'open' and self.clock() - self.opened_at >= self.reset_timeout:
+            self._state = 'half-open'
+            self.trial = False
+        return self._state
+
+    def allow(self):
+        state = self.state
+        if state == 'half-open' and not self.trial:
+            self.trial = True
+            return True
+        return state == 'closed'
+
+    def record(self, failed):
+        if not failed:
+            self._state = 'closed'
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self._state == 'half-open' or \
+                (self._state == 'closed' and self.failures >= self.threshold):
+            self._state = 'open'
+            self.opened_at = self.clock()
+            self.opened += 1
+
+
+class Client(object):
+    """Requests to another service, with one connection pool, timeouts,
+    retries and a circuit breaker.
+
+    fetch takes the arguments of AsyncHTTPClient.fetch. Requests without
+    timeouts get the client's. Responses always go to the callback,
+    with error set for failures; a request refused by the open breaker
+    gets a 599 with a CircuitOpenError. With a rate, requests and their
+    retries wait their turn to be sent at most rate a second.
+    """
+    def __init__(self, name, max_clients=MAX_CLIENTS, connect_timeout=CONNECT_TIMEOUT,
+                 request_timeout=REQUEST_TIMEOUT, retries=RETRIES, backoff=RETRY_BACKOFF,
+                 max_backoff=MAX_BACKOFF, breaker=None, rate=RATE, http_client=None,
+                 io_loop=None):
+        self.name = name
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.rate = rate
+        self.next_send = 0
+        self.http_client = http_client
+        self.io_loop = io_loop
+        self.random = random.Random()
+
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.attempts = 0
+        self.retried = 0
+        self.failures = 0
+        self.rejected = 0
+        self.delayed = 0
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        latency = {'samples': len(latencies)}
+        if latencies:
+            latency.update(mean_ms=1000 * sum(latencies) / len(latencies),
+                           p50_ms=1000 * percentile(latencies, 0.5),
+                           p95_ms=1000 * percentile(latencies, 0.95),
+                           max_ms=1000 * latencies[-1])
+
+        return {'requests': self.requests,
+                'attempts': self.attempts,
+                'retried': self.retried,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'delayed': self.delayed,
+                'breaker': self.breaker.state,
+                'breaker_opened': self.breaker.opened,
+                'latency': latency}
+
+    def get_io_loop(self):
+        if self.io_loop is None:
+            self.io_loop = tornado.ioloop.IOLoop.current()
+        return self.io_loop
+
+    def get_http_client(self):
+        # Created on first use, so it belongs to the IOLoop that runs it
+        if self.http_client is None:
+            self.http_client = tornado.httpclient.AsyncHTTPClient(
+                self.get_io_loop(), force_instance=True, max_clients=self.max_clients)
+        return self.http_client
+
+    def fetch(self, request, callback, idempotent=None, **kwargs):
+        """Fetch a request, retrying failures if it is idempotent.
+
+        idempotent defaults to whether the method is safe to repeat.
+        """
+        if not isinstance(request, HTTPRequest):
+            request = HTTPRequest(url=request, **kwargs)
+        if request.connect_timeout is None:
+            request.connect_timeout = self.connect_timeout
+        if request.request_timeout is None:
+            request.request_timeout = self.request_timeout
+        if idempotent is None:
+            idempotent = request.method in IDEMPOTENT_METHODS
+
+        self.requests += 1
+        self.attempt(request, callback, self.retries if idempotent else 0, 0)
+
+    def attempt(self, request, callback, retries, attempt):
+        if self.rate:
+            io_loop = self.get_io_loop()
+            now = io_loop.time()
+            send_at = max(now, self.next_send)
+            self.next_send = send_at + 1.0 / self.rate
+            if send_at > now:
+                self.delayed += 1
+                io_loop.add_timeout(send_at, functools.partial(self.send, request, callback,
+                                                               retries, attempt))
+                return
+
+        self.send(request, callback, retries, attempt)
+
+    def send(self, request, callback, retries, attempt):
+        if not self.breaker.allow():
+            self.rejected += 1
+            response = HTTPResponse(request, 599, error=CircuitOpenError(self.name),
+                                    request_time=0)
+            self.get_io_loop().add_callback(callback, response)
+            return
+
+        self.attempts += 1
+        self.get_http_client().fetch(request, functools.partial(self._on_response, request,
+                                                                callback, retries, attempt))
+
+    def _on_response(self, request, callback, retries, attempt, response):
+        if response.request_time is not None:
+            self.latencies.append(response.request_time)
+
+        failed = is_failure(response)
+        self.breaker.record(failed)
+        if not failed:
+            callback(response)
+            return
+
+        self.failures += 1
+        if attempt >= retries:
+            callback(response)
+            return
+
+        # Backing off by a random part of the delay spreads out the retries
+        # of requests that failed together
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay *= self.random.uniform(0.5, 1)
+        # The query may hold credentials, so it is left out
+        logging.warning('Retrying %s %s in %.2fs: %s', request.method,
+                        request.url.partition('?')[0], delay, response.error)
+
+        self.retried += 1
+        io_loop = self.get_io_loop()
+        io_loop.add_timeout(io_loop.time() + delay,
+                            functools.partial(self.attempt, request, callback, retries,
+                                              attempt + 1))
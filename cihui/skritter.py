@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+from base64 import b64encode
+from cihui import cache
+from cihui import outbound
+
+import collections
+import datetime
+import functools
+import json
+import logging
+import random
+import tornado.httpclient
+import tornado.ioloop
+import tornado.stack_context
+import urllib.parse
+
+
+AUTHORIZE_URL = 'https://www.skritter.com/api/v0/oauth2/authorize'
+TOKEN_URL = 'https://www.skritter.com/api/v0/oauth2/token'
+
+# Tokens are refreshed once they are this close to expiring
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Upper bound on the memory used by cached tokens
+TOKEN_CACHE_BYTES = 1024 * 1024
+
+# RefreshScheduler looks for tokens expiring within REFRESH_AHEAD every
+# REFRESH_INTERVAL seconds, give or take REFRESH_JITTER of it, and
+# refreshes up to REFRESH_BATCH of them, REFRESH_CONCURRENCY at a time
+REFRESH_AHEAD = datetime.timedelta(hours=1)
+REFRESH_INTERVAL = 60
+REFRESH_JITTER = 0.2
+REFRESH_BATCH = 100
+REFRESH_CONCURRENCY = 4
+
+# Accounts whose refresh failed are not retried for this long
+REFRESH_RETRY_DELAY = datetime.timedelta(minutes=15)
+
+API_URL = 'https://www.skritter.com/api/v0'
+
+# ListPusher looks for queued pushes every PUSH_INTERVAL seconds, and
+# sends a list's words PUSH_BATCH at a time, making at most PUSH_RATE
+# requests a second
+PUSH_INTERVAL = 5
+PUSH_BATCH = 100
+PUSH_RATE = 2
+
+# A running push that has not been saved for this long has lost its
+# worker, and is resumed by another
+PUSH_STALE = datetime.timedelta(minutes=5)
+
+
+def authorize_url(client_id, redirect_uri):
+    "Where to send a user to authorize access to their Skritter account"
+    return '%s?%s' % (AUTHORIZE_URL, urllib.parse.urlencode({'response_type': 'code',
+                                                             'client_id': client_id,
+                                                             'redirect_uri': redirect_uri}))
+
+
+def token_request(client_id, client_secret, params, token_url=TOKEN_URL):
+    "Request to the Skritter OAuth token endpoint"
+    params = dict(params, client_id=client_id, client_secret=client_secret)
+    credentials = '%s:%s' % (client_id, client_secret)
+
+    return tornado.httpclient.HTTPRequest(
+        '%s?%s' % (token_url, urllib.parse.urlencode(params)),
+        headers={'AUTHORIZATION': b'basic ' + b64encode(credentials.encode('utf-8'))})
+
+
+def parse_token_response(body, refresh_token=None):
+    """The token from a token endpoint response body, as a dict of the
+    user_id, access_token, refresh_token and expiry (naive UTC).
+
+    Skritter may not send a new refresh token; refresh_token is used then.
+    """
+    token_response = json.loads(body.decode('utf-8'))
+    expires_in = token_response.get('expires_in', 0)
+
+    return {'user_id': token_response.get('user_id'),
+            'access_token': token_response.get('access_token'),
+            'refresh_token': token_response.get('refresh_token') or refresh_token,
+            'expiry': datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)}
+
+
+def vocab_id(zi, lang='zh'):
+    "Skritter's id for the first vocab written as zi"
+    return '%s-%s-0' % (lang, zi)
+
+
+def account_token(account):
+    "The token stored with an account, as parse_token_response returns it"
+    return {'user_id': account.get('skritter_user'),
+            'access_token': account.get('skritter_access_token'),
+            'refresh_token': account.get('skritter_refresh_token'),
+            'expiry': account.get('skritter_token_expiry')}
+
+
+class TokenManager(object):
+    """Skritter access tokens for accounts, refreshed only when needed.
+
+    A token is used until it is within margin of expiring. Tokens are
+    cached in-process, and the newer of the cached and stored tokens
+    wins. Concurrent requests for an account whose token needs refreshing
+    share a single refresh.
+
+    http_client is an outbound.Client, one for Skritter by default.
+    """
+    def __init__(self, account_db, client_id, client_secret, http_client=None,
+                 margin=REFRESH_MARGIN, cache_bytes=TOKEN_CACHE_BYTES, token_url=TOKEN_URL):
+        self.account_db = account_db
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.http_client = http_client
+        self.token_url = token_url
+        self.margin = margin
+        self.tokens = cache.LRUCache(cache_bytes)
+        self.pending = {}
+
+        self.refreshes = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def stats(self):
+        return {'tokens': self.tokens.stats(),
+                'pending': len(self.pending),
+                'refreshes': self.refreshes,
+                'coalesced': self.coalesced,
+                'failures': self.failures}
+
+    def is_valid(self, token, margin=None):
+        return (token is not None and token['access_token'] is not None and
+                token['expiry'] is not None and
+                token['expiry'] - (margin or self.margin) > datetime.datetime.utcnow())
+
+    def get_token(self, account, callback, margin=None):
+        """Fetch a valid token for an account from get_account.
+
+        A token is refreshed if it expires within margin, by default the
+        manager's margin. The callback receives the token, as
+        parse_token_response returns it, or None if it could not be
+        refreshed.
+        """
+        account_id = account['account_id']
+        token = self.newest_token(self.tokens.get(account_id), account_token(account))
+
+        if self.is_valid(token, margin):
+            callback(token)
+        elif account_id in self.pending:
+            self.coalesced += 1
+            self.pending[account_id].append(callback)
+        elif token['refresh_token'] is None:
+            logging.error('Account does not have a Skritter token: %s', account_id)
+            callback(None)
+        else:
+            self.pending[account_id] = [callback]
+            self.refresh(account_id, token['refresh_token'])
+
+    def newest_token(self, cached, stored):
+        if cached is None or (stored['expiry'] is not None and stored['expiry'] > cached['expiry']):
+            return stored
+        return cached
+
+    def authorize(self, account_id, code, redirect_uri, callback):
+        """Exchange an authorization code for the account's first token.
+
+        The callback receives the token, or None if it could not be
+        fetched or stored.
+        """
+        # A code can only be used once, so the request is not retried
+        self.request_token(account_id, {'grant_type': 'authorization_code',
+                                        'redirect_uri': redirect_uri, 'code': code},
+                           callback, idempotent=False, must_store=True)
+
+    def refresh(self, account_id, refresh_token):
+        self.refreshes += 1
+        # Skritter may rotate the refresh token on use, so a retry after a
+        # lost response could spend a token that is no longer valid
+        self.request_token(account_id, {'grant_type': 'refresh_token',
+                                        'refresh_token': refresh_token},
+                           functools.partial(self.finish_refresh, account_id),
+                           refresh_token=refresh_token, idempotent=False)
+
+    def request_token(self, account_id, params, callback, refresh_token=None, idempotent=True,
+                      must_store=False):
+        if self.http_client is None:
+            self.http_client = outbound.Client('skritter')
+
+        request = token_request(self.client_id, self.client_secret, params, self.token_url)
+        self.http_client.fetch(request, functools.partial(self._on_token_response, account_id,
+                                                          refresh_token, callback, must_store),
+                               idempotent=idempotent)
+
+    def _on_token_response(self, account_id, refresh_token, callback, must_store, response):
+        token = None
+        if response.error or response.code != 200:
+            logging.error('Error requesting Skritter OAuth token for %s: %s',
+                          account_id, response.error)
+        else:
+            try:
+                token = parse_token_response(response.body, refresh_token)
+            except ValueError as e:
+                logging.error('Invalid Skritter OAuth token for %s: %s', account_id, e)
+
+        if token is None or token['access_token'] is None:
+            self.failures += 1
+            callback(None)
+            return
+
+        self.tokens.put(account_id, token)
+        self.account_db.store_skritter_token(account_id, token['user_id'], token['access_token'],
+                                             token['refresh_token'], token['expiry'],
+                                             functools.partial(self._on_token_stored, account_id,
+                                                               token, callback, must_store))
+
+    def _on_token_stored(self, account_id, token, callback, must_store, error):
+        # The cached token still serves this process if it was not stored
+        if error is not None:
+            logging.error('Error storing Skritter token for %s: %s', account_id, error)
+            if must_store:
+                token = None
+
+        callback(token)
+
+    def finish_refresh(self, account_id, token):
+        for callback in self.pending.pop(account_id, []):
+            callback(token)
+
+
+class RefreshScheduler(object):
+    """Refresh tokens on the IOLoop before they expire, so requests find
+    a fresh token.
+
+    Each check selects accounts whose tokens expire within ahead and
+    refreshes them through the token manager, at most concurrency at a
+    time; the next check is scheduled once they are done. Checks are
+    spread by jitter so several schedulers do not fall into step.
+    """
+    def __init__(self, account_db, token_manager, interval=REFRESH_INTERVAL, ahead=REFRESH_AHEAD,
+                 jitter=REFRESH_JITTER, batch_size=REFRESH_BATCH,
+                 concurrency=REFRESH_CONCURRENCY, retry_delay=REFRESH_RETRY_DELAY,
+                 io_loop=None):
+        self.account_db = account_db
+        self.token_manager = token_manager
+        self.interval = interval
+        self.ahead = ahead
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.random = random.Random()
+
+        self.running = False
+        self.timeout = None
+        self.queue = collections.deque()
+        self.active = 0
+        self.retry_after = {}  # account id -> when to try a failed refresh again
+
+        self.checks = 0
+        self.refreshed = 0
+        self.failed = 0
+
+    def stats(self):
+        return {'running': self.running,
+                'checks': self.checks,
+                'queued': len(self.queue),
+                'active': self.active,
+                'refreshed': self.refreshed,
+                'failed': self.failed,
+                'retrying': len(self.retry_after)}
+
+    def start(self):
+        self.running = True
+        self.schedule(self.random.uniform(0, self.interval * self.jitter))
+
+    def stop(self):
+        self.running = False
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+
+    def schedule(self, delay=None):
+        if not self.running or self.timeout is not None:
+            return
+
+        if delay is None:
+            delay = self.interval * (1 + self.random.uniform(-self.jitter, self.jitter))
+        self.timeout = self.io_loop.add_timeout(self.io_loop.time() + delay, self.check)
+
+    def check(self):
+        self.timeout = None
+        self.checks += 1
+
+        now = datetime.datetime.utcnow()
+        for account_id, retry_after in list(self.retry_after.items()):
+            if retry_after <= now:
+                del self.retry_after[account_id]
+
+        # Accounts held off are left out of the query, or enough failing
+        # ones would fill every batch ahead of everyone else
+        self.account_db.get_expiring_skritter_accounts(now + self.ahead, self.got_accounts,
+                                                       limit=self.batch_size,
+                                                       exclude_ids=list(self.retry_after))
+
+    def got_accounts(self, accounts):
+        if accounts is None:
+            logging.error('Error fetching accounts with expiring Skritter tokens')
+            accounts = []
+
+        self.queue.extend(account for account in accounts
+                          if account['account_id'] not in self.retry_after)
+        self.refresh_queued()
+
+    def refresh_queued(self):
+        while self.queue and self.active < self.concurrency:
+            account = self.queue.popleft()
+            self.active += 1
+            self.token_manager.get_token(account,
+                                         functools.partial(self._on_refreshed,
+                                                           account['account_id']),
+                                         margin=self.ahead)
+
+        if not self.queue and self.active == 0:
+            self.schedule()
+
+    def _on_refreshed(self, account_id, token):
+        self.active -= 1
+        if token is None:
+            self.failed += 1
+            self.retry_after[account_id] = datetime.datetime.utcnow() + self.retry_delay
+        else:
+            self.refreshed += 1
+
+        self.refresh_queued()
+
+
+class ListPusher(object):
+    """Push queued lists into Skritter, one list at a time.
+
+    Each push creates a Skritter vocab list, then for every batch of
+    words looks up their vocabs and adds those found as a section of the
+    list. Progress and each word's result, added or not_found, are saved
+    after every batch, so a push resumes where it stopped. A push that
+    fails is left for the user to push again. The rate of requests is
+    set by the http_client, an outbound.Client. An exception in any step
+    fails the push, so the worker carries on with the next.
+    """
+    def __init__(self, list_db, account_db, token_manager, http_client, api_url=API_URL,
+                 interval=PUSH_INTERVAL, batch_size=PUSH_BATCH, stale_after=PUSH_STALE,
+                 io_loop=None):
+        self.list_db = list_db
+        self.account_db = account_db
+        self.token_manager = token_manager
+        self.http_client = http_client
+        self.api_url = api_url
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stale_after = stale_after
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+
+        self.running = False
+        self.timeout = None
+        self.push = None
+        self.account = None
+        self.access_token = None
+        self.finishing = False
+
+        self.checks = 0
+        self.pushed = 0
+        self.failed = 0
+        self.words = 0
+
+    def stats(self):
+        return {'running': self.running,
+                'checks': self.checks,
+                'pushing': self.push['id'] if self.push else None,
+                'pushed': self.pushed,
+                'failed': self.failed,
+                'words': self.words}
+
+    def start(self):
+        self.running = True
+        self.schedule(0)
+
+    def stop(self):
+        self.running = False
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+
+    def schedule(self, delay=None):
+        if not self.running or self.timeout is not None:
+            return
+
+        delay = self.interval if delay is None else delay
+        # Each check starts afresh rather than inside the last push's context
+        with tornado.stack_context.NullContext():
+            self.timeout = self.io_loop.add_timeout(self.io_loop.time() + delay, self.check)
+
+    def check(self):
+        self.timeout = None
+        self.checks += 1
+
+        # Callbacks of the push carry this context, so an exception in
+        # any of them reaches _on_error
+        stale_before = datetime.datetime.utcnow() - self.stale_after
+        with tornado.stack_context.ExceptionStackContext(self._on_error):
+            self.list_db.claim_skritter_push(stale_before, self.got_push)
+
+    def _on_error(self, typ, value, tb):
+        logging.error('Error in Skritter push', exc_info=(typ, value, tb))
+        if self.push is not None and not self.finishing:
+            self.fail('Internal error: %s' % value)
+        else:
+            self.done()
+        return True
+
+    def got_push(self, push):
+        if push is None:
+            self.schedule()
+            return
+
+        logging.info('Pushing list %s to Skritter for %s from word %s',
+                     push['list_id'], push['account_id'], push['pushed'])
+        self.push = push
+        self.account_db.get_accounts(self.got_account, account_ids=[push['account_id']])
+
+    def got_account(self, accounts):
+        if not accounts:
+            self.fail('Account not found')
+            return
+
+        self.account = accounts[0]
+        self.next_batch()
+
+    def next_batch(self):
+        # Asked for every batch, so a long push outlasts the token
+        self.token_manager.get_token(self.account, self.got_token)
+
+    def got_token(self, token):
+        if token is None:
+            self.fail('No Skritter token')
+            return
+
+        self.access_token = token['access_token']
+        if self.push['skritter_list_id'] is None:
+            self.api_request('POST', '/vocablists', self.created_list,
+                             body={'name': self.push['title'], 'lang': 'zh'})
+        else:
+            self.list_db.get_lists_by_id([self.push['list_id']], self.got_words,
+                                         account_id=self.push['account_id'], words=True,
+                                         after_position=self.push['position'],
+                                         limit=self.batch_size)
+
+    def created_list(self, body):
+        try:
+            self.push['skritter_list_id'] = str(body['VocabList']['id'])
+        except (KeyError, TypeError):
+            self.fail('Skritter did not return the new list')
+            return
+
+        self.save_batch([], self.push['position'], self.next_batch)
+
+    def got_words(self, word_lists):
+        if not word_lists:
+            self.fail('List not found' if word_lists is not None else 'Error reading the list')
+            return
+
+        words = word_lists[0]['words']
+        if not words:
+            self.finish('done')
+            return
+
+        ids = [vocab_id(word[0]) for word in words]
+        self.api_request('GET', '/vocabs', functools.partial(self.got_vocabs, words,
+                                                             word_lists[0]['next_position']),
+                         params={'ids': '|'.join(ids), 'fields': 'id'})
+
+    def got_vocabs(self, words, next_position, body):
+        found = set(vocab.get('id') for vocab in body.get('Vocabs') or []
+                    if isinstance(vocab, dict))
+        first = self.push['pushed']
+        results = []
+        rows = []
+        for index, word in enumerate(words):
+            if vocab_id(word[0]) in found:
+                results.append((first + index, word[0], 'added'))
+                rows.append({'vocabId': vocab_id(word[0])})
+            else:
+                results.append((first + index, word[0], 'not_found'))
+
+        # A page that is not full is the last, which next_position marks
+        # with None. It is saved along with the push being done, so it is
+        # not sent again if the worker stops after saving it.
+        if next_position is None:
+            cb = functools.partial(self.save_batch, results, self.push['position'],
+                                   self.pushed_all, status='done')
+        else:
+            cb = functools.partial(self.save_batch, results, next_position, self.next_batch)
+        if not rows:
+            cb()
+            return
+
+        section = {'name': 'Words %d-%d' % (first + 1, first + len(words)), 'rows': rows}
+        self.api_request('POST', '/vocablists/%s/sections' % self.push['skritter_list_id'],
+                         lambda body: cb(), body=section)
+
+    def save_batch(self, results, position, callback, status='running'):
+        pushed = self.push['pushed'] + len(results)
+        self.list_db.save_skritter_push_batch(self.push['id'], self.push['skritter_list_id'],
+                                              position, pushed, results,
+                                              functools.partial(self._on_batch_saved,
+                                                                position, pushed, len(results),
+                                                                callback),
+                                              status=status)
+
+    def _on_batch_saved(self, position, pushed, words, callback, saved):
+        if not saved:
+            # Either the database failed or another worker took the push
+            logging.error('Could not save Skritter push %s', self.push['id'])
+            self.done()
+            return
+
+        self.push.update(position=position, pushed=pushed)
+        self.words += words
+        callback()
+
+    def api_request(self, method, path, callback, params=None, body=None):
+        url = self.api_url + path
+        if params is not None:
+            url += '?' + urllib.parse.urlencode(params)
+
+        request = tornado.httpclient.HTTPRequest(
+            url, method=method, body=json.dumps(body) if body is not None else None,
+            headers={'Authorization': 'bearer %s' % self.access_token,
+                     'Content-Type': 'application/json'})
+        self.http_client.fetch(request, functools.partial(self._on_api_response, path, callback))
+
+    def _on_api_response(self, path, callback, response):
+        if response.error or response.code != 200:
+            self.fail('Skritter %s failed: %s' % (path, response.error))
+            return
+
+        try:
+            body = json.loads(response.body.decode('utf-8'))
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            self.fail('Skritter %s did not return a JSON object' % path)
+            return
+
+        callback(body)
+
+    def pushed_all(self):
+        self.pushed += 1
+        self.done()
+
+    def fail(self, error):
+        logging.error('Skritter push %s failed: %s', self.push['id'], error)
+        self.failed += 1
+        self.finish('failed', error)
+
+    def finish(self, status, error=None):
+        self.finishing = True
+        if status == 'done':
+            self.pushed += 1
+        self.list_db.finish_skritter_push(self.push['id'], status, lambda saved: self.done(),
+                                          error=error)
+
+    def done(self):
+        self.push = None
+        self.account = None
+        self.access_token = None
+        self.finishing = False
+
+        # More pushes may be waiting
+        self.schedule(0)
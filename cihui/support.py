@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+from cihui import uimodules
 from tornado.testing import AsyncHTTPTestCase
 from tornado.web import Application
 
@@ -29,4 +30,5 @@ class UITestCase(HandlerTestCase):
         args = super().get_app_kwargs()
         args['static_path'] = os.path.join(os.path.dirname(__file__), '../static')
         args['template_path'] = os.path.join(os.path.dirname(__file__), '../templates')
+        args['ui_modules'] = uimodules
         return args
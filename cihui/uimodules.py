@@ -11,3 +11,15 @@ class WordEntry(tornado.web.UIModule):
             zi=zi,
             pinyin=pinyin,
             description=description)
+
+
+class WordList(tornado.web.UIModule):
+    """All the words of a list in one template pass.
+
+    The output is the same as a WordEntry per word, each on its own line,
+    followed by a newline. words are [zi, pinyin, definitions, description].
+    """
+    def render(self, words):
+        return self.render_string(
+            "modules/wordlist.html",
+            words=words)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import codecs
+import json
+import re
+import unicodedata
+
+
+# Largest list upload accepted, in bytes
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+
+# A word that has not ended after this many characters is malformed
+MAX_WORD_CHARS = 64 * 1024
+
+# Most validation errors reported for a list
+MAX_WORD_ERRORS = 20
+
+WHITESPACE = re.compile(r'\s*')
+
+normalize = unicodedata.normalize
+
+
+class UploadError(ValueError):
+    """An upload that is malformed (status 400) or too large (status 413).
+
+    errors holds the WordError errors for a malformed word.
+    """
+    def __init__(self, message, status=400, errors=None):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        self.errors = errors
+
+
+class WordError(ValueError):
+    """Words that failed validation.
+
+    errors holds a dict of the word index, field and error for each
+    problem found.
+    """
+    def __init__(self, errors):
+        super(WordError, self).__init__('; '.join(('%(field)s: %(error)s' if error['word'] is None
+                                                   else 'word %(word)d %(field)s: %(error)s') % error
+                                                  for error in errors))
+        self.errors = errors
+
+
+def word_errors(word, index=0):
+    "The problems with a word that should be [zi, pinyin, definitions]"
+    if not isinstance(word, list) or len(word) != 3:
+        return [{'word': index, 'field': 'word', 'error': 'expected [zi, pinyin, definitions]'}]
+
+    zi, pinyin, definitions = word
+    errors = []
+    if not isinstance(zi, str) or not zi:
+        errors.append({'word': index, 'field': 'zi', 'error': 'must be a non-empty string'})
+    if not isinstance(pinyin, str):
+        errors.append({'word': index, 'field': 'pinyin', 'error': 'must be a string'})
+    if not isinstance(definitions, (list, str)) or \
+            not all(isinstance(definition, str) for definition in definitions):
+        errors.append({'word': index, 'field': 'definitions', 'error': 'must be a list of strings'})
+
+    return errors
+
+
+class Definitions(dict):
+    "NFC normalized definitions, each normalized on first use"
+    def __missing__(self, definition):
+        if type(definition) is not str:
+            raise TypeError('definition must be a string')
+
+        self[definition] = normalized = normalize('NFC', definition)
+        return normalized
+
+
+class WordNormalizer(object):
+    """Check words and NFC normalize their strings.
+
+    Nearly all input is already NFC, which unicodedata spots quickly, so
+    the cost is mostly per string. Lists repeat many definitions; each
+    distinct one is normalized once and the words share one copy of it.
+    A single string is taken as the only definition.
+    """
+    def __init__(self):
+        self.definitions = Definitions()
+
+    def word(self, word, index=0):
+        "The normalized word. Raises WordError"
+        normalized = self.normalize(word)
+        if normalized is None:
+            raise WordError(word_errors(word, index) or
+                            [{'word': index, 'field': 'word', 'error': 'invalid'}])
+        return normalized
+
+    def words(self, words, max_errors=MAX_WORD_ERRORS):
+        "The normalized words. Raises WordError with up to max_errors problems"
+        if not isinstance(words, list):
+            raise WordError([{'word': None, 'field': 'words', 'error': 'must be a list'}])
+
+        # normalize raises TypeError for anything but a string, so valid
+        # words need little more checking and the batch is one comprehension
+        definition = self.definitions.__getitem__
+        try:
+            normalized = [[normalize('NFC', zi), normalize('NFC', pinyin),
+                           list(map(definition, definitions))]
+                          if zi and type(definitions) is list else None
+                          for zi, pinyin, definitions in words]
+            if None not in normalized:
+                return normalized
+        except (TypeError, ValueError):
+            pass
+
+        normalized = []
+        errors = []
+        for index, word in enumerate(words):
+            try:
+                normalized.append(self.word(word, index))
+            except WordError as e:
+                errors.extend(e.errors)
+                if len(errors) >= max_errors:
+                    break
+
+        if errors:
+            raise WordError(errors[:max_errors])
+        return normalized
+
+    def normalize(self, word):
+        "The normalized word, or None if it is invalid"
+        if type(word) is list and len(word) == 3:
+            zi, pinyin, definitions = word
+            if type(definitions) is str:
+                definitions = [definitions]
+
+            if zi and type(zi) is str and type(pinyin) is str and type(definitions) is list:
+                try:
+                    return [normalize('NFC', zi), normalize('NFC', pinyin),
+                            list(map(self.definitions.__getitem__, definitions))]
+                except TypeError:
+                    pass
+
+        return None
+
+
+class WordParser(object):
+    """Parse uploaded words as they arrive.
+
+    The upload is either a JSON array of words or, with ndjson set, one
+    word per line. Each word is checked and normalized as soon as it is
+    complete, so a malformed word stops the upload there. feed and close
+    raise UploadError with the position of the problem.
+    """
+    def __init__(self, ndjson=False, max_bytes=None):
+        self.ndjson = ndjson
+        self.normalizer = WordNormalizer()
+        self.max_bytes = max_bytes if max_bytes is not None else MAX_UPLOAD_BYTES
+
+        self.words = []
+        self.size = 0
+        self.text = ''
+        self.offset = 0  # characters parsed before text
+        self.line = 1
+        self.state = 'start'
+
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+
+    def expect(self, content_length):
+        "Reject an upload by its length before reading it"
+        if content_length > self.max_bytes:
+            raise UploadError('Upload larger than %d bytes' % self.max_bytes, 413)
+
+    def feed(self, data):
+        self.size += len(data)
+        self.expect(self.size)
+
+        try:
+            self.text += self.decoder.decode(data)
+        except UnicodeDecodeError:
+            raise UploadError('Upload is not UTF-8 after byte %d' % (self.size - len(data)))
+
+        self.parse(final=False)
+
+    def close(self):
+        "Parse what is left and return the words"
+        try:
+            self.text += self.decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise UploadError('Upload ends within a UTF-8 character')
+
+        self.parse(final=True)
+        if not self.ndjson and self.state != 'end':
+            raise UploadError('Upload ends before the closing ] at character %d' % self.offset)
+
+        return self.words
+
+    def parse(self, final):
+        if self.ndjson:
+            self.parse_lines(final)
+        else:
+            self.parse_array(final)
+
+    def parse_lines(self, final):
+        lines = self.text.split('\n')
+        self.text = '' if final else lines.pop()
+        if len(self.text) > MAX_WORD_CHARS:
+            raise UploadError('Line %d is longer than %d characters' % (self.line, MAX_WORD_CHARS))
+
+        for line in lines:
+            if line.strip():
+                try:
+                    word = json.loads(line)
+                except ValueError as e:
+                    raise UploadError('Line %d: %s' % (self.line, e))
+                self.add_word(word, 'line %d' % self.line)
+            self.line += 1
+
+    def parse_array(self, final):
+        text = self.text
+        position = 0
+
+        while True:
+            position = WHITESPACE.match(text, position).end()
+            if position == len(text):
+                break
+
+            char = text[position]
+            where = self.offset + position
+            if self.state == 'start':
+                if char != '[':
+                    raise UploadError('Expected a JSON array of words at character %d' % where)
+                self.state = 'first'
+                position += 1
+
+            elif self.state == 'first' and char == ']':
+                self.state = 'end'
+                position += 1
+
+            elif self.state in ('first', 'word'):
+                try:
+                    word, end = self.json_decoder.raw_decode(text, position)
+                except ValueError as e:
+                    # Most likely the rest of the word has not arrived yet
+                    if not final and len(text) - position < MAX_WORD_CHARS:
+                        break
+                    raise UploadError('Word %d is not valid JSON at character %d' %
+                                      (len(self.words), self.offset + getattr(e, 'pos', position)))
+
+                if end == len(text) and not final and not isinstance(word, list):
+                    break  # a number or literal may continue in the next slice
+                self.add_word(word, 'character %d' % where)
+                self.state = 'separator'
+                position = end
+
+            elif self.state == 'separator':
+                if char == ',':
+                    self.state = 'word'
+                elif char == ']':
+                    self.state = 'end'
+                else:
+                    raise UploadError('Expected , or ] after word %d at character %d' %
+                                      (len(self.words) - 1, where))
+                position += 1
+
+            else:
+                raise UploadError('Unexpected data after the words at character %d' % where)
+
+        self.offset += position
+        self.text = text[position:]
+
+    def add_word(self, word, where):
+        try:
+            self.words.append(self.normalizer.word(word, len(self.words)))
+        except WordError as e:
+            raise UploadError('Word %d (%s): %s' % (len(self.words), where,
+                                                    ', '.join('%(field)s %(error)s' % error
+                                                              for error in e.errors)),
+                              errors=e.errors)
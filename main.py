@@ -8,9 +8,12 @@ import tornado.ioloop
 from cihui import app
 from cihui.data import account
 from cihui.data import wordlist
+from cihui.handler import wordlist as wordlist_handler
 
 
 db_url = os.environ.get('DATABASE_URL', 'postgresql://localhost:5432/cihui')
+list_cache_bytes = int(os.environ.get('LIST_CACHE_BYTES', wordlist.LIST_CACHE_BYTES))
+page_cache_bytes = int(os.environ.get('PAGE_CACHE_BYTES', wordlist_handler.PAGE_CACHE_BYTES))
 port = int(os.environ.get("PORT", 5000))
 debugMode = False
 
@@ -18,9 +21,10 @@ if len(sys.argv) > 1 and sys.argv[1] == '--debug':
     debugMode = True
 
 application = app.CiHuiApplication(account.AccountData(db_url),
-                                   wordlist.WordListData(db_url),
+                                   wordlist.WordListData(db_url, cache_bytes=list_cache_bytes),
                                    os.environ.get('COOKIE_SECRET', None),
-                                   debug=debugMode
+                                   debug=debugMode,
+                                   page_cache_bytes=page_cache_bytes
                                    )
 
 
@@ -0,0 +1,43 @@
+"""Add list_word table
+
+Revision ID: 3c6f2a1b7d4
+Revises: 1d8e0b3b949
+Create Date: 2014-08-02 10:12:45.218233
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c6f2a1b7d4'
+down_revision = '1d8e0b3b949'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'list_word',
+        sa.Column('list_id',
+                  sa.Integer,
+                  sa.ForeignKey('list.id', onupdate='CASCADE', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('position', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('zi', sa.Unicode, nullable=False),
+        sa.Column('pinyin', sa.Unicode, nullable=False, server_default=''),
+        # JSON array of definition strings
+        sa.Column('definitions', sa.Unicode, nullable=False, server_default='[]'),
+        )
+
+    # NULL until the list's words have been moved out of list.words
+    op.add_column('list', sa.Column('word_count', sa.Integer, nullable=True))
+
+
+def downgrade():
+    op.execute('''UPDATE list
+                  SET words = (SELECT COALESCE(json_agg(json_build_array(w.zi, w.pinyin, w.definitions::json)
+                                                        ORDER BY w.position), '[]')::text
+                               FROM list_word w
+                               WHERE w.list_id = list.id)
+                  WHERE word_count IS NOT NULL''')
+    op.drop_column('list', 'word_count')
+    op.drop_table('list_word')
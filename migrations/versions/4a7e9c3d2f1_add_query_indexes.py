@@ -0,0 +1,46 @@
+"""Add indexes for list and account queries
+
+Revision ID: 4a7e9c3d2f1
+Revises: 3c6f2a1b7d4
+Create Date: 2014-08-09 15:41:07.532118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a7e9c3d2f1'
+down_revision = '3c6f2a1b7d4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # WordListData.get_lists: public lists, newest first
+    op.execute('CREATE INDEX ix_list_public_modified ON list (modified_at DESC, id DESC) WHERE public')
+
+    # WordListData.get_user_lists: an account's lists, newest first
+    op.execute('CREATE INDEX ix_list_account_modified ON list (account_id, modified_at DESC, id DESC)')
+
+    # WordListData.list_exists_for_account
+    op.create_index('ix_list_account_title', 'list', ['account_id', 'title'])
+
+    # AccountData email lookups are case-insensitive, so accounts whose
+    # emails differ only by case would be ambiguous. Merging them means
+    # choosing whose password and lists to keep, so that is left to be
+    # done by hand.
+    duplicates = op.get_bind().execute('''SELECT lower(email), array_agg(id ORDER BY id)
+                                          FROM account
+                                          GROUP BY lower(email)
+                                          HAVING count(*) > 1''').fetchall()
+    if duplicates:
+        raise RuntimeError('Merge accounts whose emails differ only by case first: %s' %
+                           ', '.join('%s %s' % (email, ids) for email, ids in duplicates))
+
+    op.execute('CREATE UNIQUE INDEX ix_account_lower_email ON account (lower(email))')
+
+
+def downgrade():
+    op.drop_index('ix_account_lower_email')
+    op.drop_index('ix_list_account_title')
+    op.drop_index('ix_list_account_modified')
+    op.drop_index('ix_list_public_modified')
@@ -0,0 +1,34 @@
+"""Unique list title per account
+
+Revision ID: 5e2b8d4c9a3
+Revises: 4a7e9c3d2f1
+Create Date: 2014-08-16 11:03:52.840316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2b8d4c9a3'
+down_revision = '4a7e9c3d2f1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Uploads updated the newest list with a title, so keep its title and
+    # rename the older duplicates
+    op.execute('''UPDATE list
+                  SET title = list.title || ' (' || list.id || ')'
+                  WHERE EXISTS (SELECT 1 FROM list newer
+                                WHERE newer.account_id = list.account_id
+                                AND newer.title = list.title
+                                AND newer.id > list.id)''')
+
+    # The constraint's index replaces ix_list_account_title
+    op.drop_index('ix_list_account_title')
+    op.create_unique_constraint('uq_list_account_title', 'list', ['account_id', 'title'])
+
+
+def downgrade():
+    op.drop_constraint('uq_list_account_title', 'list')
+    op.create_index('ix_list_account_title', 'list', ['account_id', 'title'])
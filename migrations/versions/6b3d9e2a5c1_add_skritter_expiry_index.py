@@ -0,0 +1,24 @@
+"""Add an index for accounts with expiring Skritter tokens
+
+Revision ID: 6b3d9e2a5c1
+Revises: 5e2b8d4c9a3
+Create Date: 2014-08-30 10:12:45.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b3d9e2a5c1'
+down_revision = '5e2b8d4c9a3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # AccountData.get_expiring_skritter_accounts
+    op.execute('''CREATE INDEX ix_account_skritter_token_expiry ON account (skritter_token_expiry)
+                  WHERE skritter_refresh_token IS NOT NULL''')
+
+
+def downgrade():
+    op.drop_index('ix_account_skritter_token_expiry')
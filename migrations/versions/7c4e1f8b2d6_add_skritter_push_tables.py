@@ -0,0 +1,64 @@
+"""Add tables for pushing lists to Skritter
+
+Revision ID: 7c4e1f8b2d6
+Revises: 6b3d9e2a5c1
+Create Date: 2014-09-06 09:41:12.527310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c4e1f8b2d6'
+down_revision = '6b3d9e2a5c1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'skritter_push',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('account_id',
+                  sa.Integer,
+                  sa.ForeignKey('account.id', onupdate='CASCADE', ondelete='CASCADE'),
+                  nullable=False),
+        sa.Column('list_id',
+                  sa.Integer,
+                  sa.ForeignKey('list.id', onupdate='CASCADE', ondelete='CASCADE'),
+                  nullable=False),
+        # queued, running, done or failed
+        sa.Column('status', sa.Unicode(16), nullable=False, server_default='queued'),
+        sa.Column('skritter_list_id', sa.Unicode(255), nullable=True),
+        # list_word position of the last word sent, and words sent so far
+        sa.Column('position', sa.Integer, nullable=False, server_default='-1'),
+        sa.Column('pushed', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('error', sa.Unicode, nullable=True),
+        sa.Column('created_at', sa.DateTime, nullable=False, server_default=sa.func.now()),
+        sa.Column('modified_at', sa.DateTime, nullable=False, server_default=sa.func.now()),
+        )
+
+    # One unfinished push per account and list, which pushing again resumes
+    op.execute('''CREATE UNIQUE INDEX uq_skritter_push_unfinished ON skritter_push (account_id, list_id)
+                  WHERE status <> 'done' ''')
+
+    # WordListData.claim_skritter_push
+    op.execute('''CREATE INDEX ix_skritter_push_waiting ON skritter_push (id)
+                  WHERE status IN ('queued', 'running')''')
+
+    op.create_table(
+        'skritter_push_word',
+        sa.Column('push_id',
+                  sa.Integer,
+                  sa.ForeignKey('skritter_push.id', onupdate='CASCADE', ondelete='CASCADE'),
+                  primary_key=True),
+        # Index of the word in the push
+        sa.Column('word', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('zi', sa.Unicode, nullable=False),
+        # added or not_found
+        sa.Column('result', sa.Unicode(16), nullable=False),
+        )
+
+
+def downgrade():
+    op.drop_table('skritter_push_word')
+    op.drop_table('skritter_push')
@@ -0,0 +1,32 @@
+"""Add require_list_word for patching lists
+
+Revision ID: 8e2a6d4b1f9
+Revises: 7c4e1f8b2d6
+Create Date: 2014-09-13 10:22:37.614093
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e2a6d4b1f9'
+down_revision = '7c4e1f8b2d6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # WordListData.patch_list calls this after removing or replacing a
+    # word. Raising aborts the whole patch when the position has no word.
+    op.execute('''CREATE FUNCTION require_list_word(changed bigint, operation int, word int)
+                  RETURNS void AS $$
+                  BEGIN
+                      IF changed = 0 THEN
+                          RAISE EXCEPTION 'Operation %: no word at position %', operation, word
+                              USING ERRCODE = 'no_data_found';
+                      END IF;
+                  END
+                  $$ LANGUAGE plpgsql''')
+
+
+def downgrade():
+    op.execute('DROP FUNCTION require_list_word(bigint, int, int)')
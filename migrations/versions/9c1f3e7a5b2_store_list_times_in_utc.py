@@ -0,0 +1,32 @@
+"""Store list times in UTC
+
+Revision ID: 9c1f3e7a5b2
+Revises: 8e2a6d4b1f9
+Create Date: 2014-09-14 09:41:12.203518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c1f3e7a5b2'
+down_revision = '8e2a6d4b1f9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # List times were written in the server's local time. They are shown
+    # as UTC in the Atom feed and Last-Modified, so store them that way.
+    op.execute('''UPDATE list
+                  SET created_at = created_at AT TIME ZONE current_setting('TimeZone') AT TIME ZONE 'UTC',
+                      modified_at = modified_at AT TIME ZONE current_setting('TimeZone') AT TIME ZONE 'UTC';''')
+    op.alter_column('list', 'created_at', server_default=sa.text("timezone('UTC', NOW())"))
+    op.alter_column('list', 'modified_at', server_default=sa.text("timezone('UTC', NOW())"))
+
+
+def downgrade():
+    op.alter_column('list', 'created_at', server_default=sa.text('NOW()'))
+    op.alter_column('list', 'modified_at', server_default=sa.text('NOW()'))
+    op.execute('''UPDATE list
+                  SET created_at = created_at AT TIME ZONE 'UTC' AT TIME ZONE current_setting('TimeZone'),
+                      modified_at = modified_at AT TIME ZONE 'UTC' AT TIME ZONE current_setting('TimeZone');''')
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Move words from the list.words JSON column into the list_word table,
+# a batch of lists at a time. Safe to run while the site is up.
+#
+# Usage: python scripts/backfill_list_words.py [batch_size]
+
+from cihui.data import wordlist
+from tornado import gen
+
+import functools
+import os
+import sys
+import tornado.ioloop
+
+
+@gen.coroutine
+def backfill(list_db, batch_size):
+    total = 0
+    while True:
+        list_ids = yield gen.Task(list_db.backfill_list_words, batch_size)
+        if list_ids is None:
+            print('Stopped after an error; %d lists moved' % total)
+            return
+
+        if len(list_ids) == 0:
+            break
+
+        total += len(list_ids)
+        print('Moved %d lists (%d total)' % (len(list_ids), total))
+
+    print('Done; %d lists moved' % total)
+
+
+if __name__ == '__main__':
+    db_url = os.environ.get('DATABASE_URL', 'postgresql://localhost:5432/cihui')
+    batch_size = 100
+    if len(sys.argv) > 1:
+        batch_size = int(sys.argv[1])
+
+    list_db = wordlist.WordListData(db_url)
+    tornado.ioloop.IOLoop.instance().run_sync(
+        functools.partial(backfill, list_db, batch_size))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Export a list of words as CSV and TSV one word at a time and with the
+# bulk formatter, and print the cost per word of each.
+#
+# Usage: python scripts/benchmark_formatter.py [words] [repeats]
+
+from cihui import formatter
+
+import sys
+import timeit
+
+
+def make_words(count):
+    return [['字%d' % n, 'zi%d' % n, ['word %d' % n, 'a "quoted", longer definition']]
+            for n in range(count)]
+
+
+def per_word(words, format_word):
+    return ('\n'.join(map(format_word, words)) + '\n').encode('utf-8')
+
+
+def bulk(words, dialect):
+    return b''.join(formatter.format_words(words, dialect))
+
+
+if __name__ == '__main__':
+    word_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    words = make_words(word_count)
+    for name, format_word, dialect in [('csv', formatter.format_word_as_csv, formatter.CSVDialect),
+                                       ('tsv', formatter.format_word_as_tsv, formatter.TSVDialect)]:
+        if per_word(words, format_word) != bulk(words, dialect):
+            sys.exit('Bulk %s output differs from per word' % name)
+
+        for path, run in [('per word', lambda: per_word(words, format_word)),
+                          ('bulk', lambda: bulk(words, dialect))]:
+            seconds = min(timeit.repeat(run, number=1, repeat=repeats))
+            print('%s %-8s %8.1fms, %5.2fus per word' % (
+                name, path, seconds * 1000, seconds * 1000000 / max(1, word_count)))
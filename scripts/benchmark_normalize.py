@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Normalize a CEDICT shaped list of words one word at a time, as uploads
+# used to be, and with WordNormalizer, and print the cost per word and
+# the memory held by the parsed and normalized list for each.
+#
+# Usage: python scripts/benchmark_normalize.py [words] [repeats]
+
+from cihui import upload
+
+import gc
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+import unicodedata
+
+HANZI = [chr(code) for code in range(0x4e00, 0x4e00 + 3000)]
+SYLLABLES = ['mā', 'hǎo', 'xué', 'shēng', 'lǜ', 'zhōng', 'guó', 'rén', 'dà', 'xiǎo']
+DEFINITIONS = ['big', 'small', 'person', 'to study', 'student', 'China', 'good', 'mother',
+               'green', 'middle', 'country', 'CL:個|个[ge4]', 'variant of 學|学[xue2]',
+               'surname Zhang', 'to go', 'to come', 'water', 'fire', 'abbr. for China']
+
+
+def make_words(count, decomposed=0.05):
+    "Words of 1-4 hanzi with tone marked pinyin and common definitions"
+    generator = random.Random(count)
+    words = []
+    for _ in range(count):
+        length = generator.choice([1, 2, 2, 2, 3, 4])
+        pinyin = ' '.join(generator.choice(SYLLABLES) for _ in range(length))
+        if generator.random() < decomposed:
+            pinyin = unicodedata.normalize('NFD', pinyin)
+        words.append([''.join(generator.choice(HANZI) for _ in range(length)), pinyin,
+                      generator.sample(DEFINITIONS, generator.choice([1, 1, 2, 3]))])
+    return words
+
+
+def per_word(words):
+    normalize = unicodedata.normalize
+    return [[normalize('NFC', zi), normalize('NFC', pinyin),
+             [normalize('NFC', definition) for definition in definitions]]
+            for zi, pinyin, definitions in words]
+
+
+def batch(words):
+    return upload.WordNormalizer().words(words)
+
+
+def memory(body, normalize):
+    "Bytes held by the normalized words of a JSON body"
+    gc.collect()
+    tracemalloc.start()
+    words = normalize(json.loads(body))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+if __name__ == '__main__':
+    word_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    # As uploaded, so repeated definitions are separate strings
+    body = json.dumps(make_words(word_count))
+    words = json.loads(body)
+    if per_word(words) != batch(words):
+        sys.exit('Batch normalization differs from per word')
+
+    for path, normalize in [('per word', per_word), ('batch', batch)]:
+        seconds = min(timeit.repeat(lambda: normalize(words), number=1, repeat=repeats))
+        print('%-8s %8.1fms, %5.2fus per word, %5.1fMB held' % (
+            path, seconds * 1000, seconds * 1000000 / max(1, word_count),
+            memory(body, normalize) / 1000000))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Render the words of a list page with a WordEntry module per word and
+# with a single WordList module, check the output is the same and print
+# the cost per word of each.
+#
+# Usage: python scripts/benchmark_templates.py [words] [repeats]
+
+from cihui import formatter
+from cihui import uimodules
+
+import os
+import sys
+import timeit
+import tornado.httpserver
+import tornado.template
+import tornado.web
+
+PER_WORD = '''
+{% for word_entry in words %}
+  {% module WordEntry(word_entry[0], word_entry[1], word_entry[3]) %}
+{% end %}
+'''
+
+BULK = '''
+{% module WordList(words) %}'''
+
+
+def make_words(count):
+    words = []
+    for n in range(count):
+        definitions = ['word %d' % n, '<b>&"quoted"</b>']
+        words.append(['字%d' % n, 'zi%d' % n, definitions,
+                      formatter.format_description(definitions)])
+    return words
+
+
+def make_handler():
+    template_path = os.path.join(os.path.dirname(__file__), '../templates')
+    application = tornado.web.Application(template_path=template_path,
+                                          ui_modules=uimodules)
+    request = tornado.httpserver.HTTPRequest('GET', '/list/1')
+    return tornado.web.RequestHandler(application, request)
+
+
+def render(handler, source, words):
+    "Render source like a template file of the handler's"
+    template = tornado.template.Template(source, name='benchmark.html')
+    namespace = handler.get_template_namespace()
+    namespace['words'] = words
+    return template.generate(**namespace)
+
+
+if __name__ == '__main__':
+    word_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    handler = make_handler()
+    words = make_words(word_count)
+
+    if render(handler, PER_WORD, words) != render(handler, BULK, words):
+        sys.exit('WordList output differs from WordEntry')
+
+    for name, source in [('WordEntry per word', PER_WORD), ('WordList', BULK)]:
+        seconds = min(timeit.repeat(lambda: render(handler, source, words),
+                                    number=1, repeat=repeats))
+        print('%-20s %8.2fms per page, %6.2fus per word' % (
+            name, seconds * 1000, seconds * 1000000 / max(1, word_count)))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Run EXPLAIN ANALYZE on every query issued by WordListData and
+# AccountData, to check which indexes they use. Statements that change
+# data are rolled back.
+#
+# Usage: python scripts/explain_queries.py [--seed LISTS]
+#
+# --seed adds LISTS lists of 20 words each, spread over LISTS / 10
+# accounts, and commits them. Only use it on a scratch database.
+
+from cihui.data import account
+from cihui.data import database_url
+from cihui.data import wordlist
+
+import datetime
+import os
+import psycopg2
+import sys
+
+
+class RecordingDatabase(object):
+    "Stands in for momoko.Pool and keeps each statement instead of running it"
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None, callback=None):
+        self.statements.append((sql, params))
+
+
+def connect(db_url):
+    settings = database_url.build_settings_from_dburl(db_url)
+    return psycopg2.connect(database=settings['database'],
+                            user=settings['user'] or None,
+                            password=settings['password'] or None,
+                            host=settings['host'] or None,
+                            port=settings['port'] or None)
+
+
+def seed(conn, list_count):
+    cursor = conn.cursor()
+    # Numbered after the existing accounts, so seeding again does not
+    # repeat an email
+    cursor.execute('''INSERT INTO account (email, name)
+                      SELECT 'Seed' || n || '@example.com', 'Seed ' || n
+                      FROM generate_series((SELECT coalesce(max(id), 0) FROM account) + 1,
+                                           (SELECT coalesce(max(id), 0) FROM account) + %s) n
+                      RETURNING id''',
+                   (max(list_count // 10, 1),))
+    account_ids = [row[0] for row in cursor]
+
+    cursor.execute('''INSERT INTO list (title, stub, public, account_id, word_count, modified_at)
+                      SELECT 'Seed list ' || n, 'seed-list-' || n, n %% 4 <> 0,
+                             (%s::int[])[1 + n %% %s], 20,
+                             timezone('UTC', NOW()) - n * interval '1 minute'
+                      FROM generate_series(1, %s) n
+                      RETURNING id''',
+                   (account_ids, len(account_ids), list_count))
+    list_ids = [row[0] for row in cursor]
+    cursor.execute('''INSERT INTO list_word (list_id, position, zi, pinyin, definitions)
+                      SELECT l, p, '字', 'zi4', '["character"]'
+                      FROM unnest(%s::int[]) l, generate_series(0, 19) p''',
+                   (list_ids,))
+    cursor.execute('ANALYZE')
+    conn.commit()
+
+
+def sample_values(conn):
+    cursor = conn.cursor()
+    cursor.execute('''SELECT l.id, l.title, l.modified_at, a.id, a.email
+                      FROM list l JOIN account a ON a.id = l.account_id
+                      ORDER BY l.modified_at DESC
+                      LIMIT 1''')
+    row = cursor.fetchone()
+    if row is None:
+        sys.exit('No lists found; use --seed on a scratch database')
+
+    return dict(zip(['list_id', 'title', 'modified_at', 'account_id', 'email'], row))
+
+
+def record_queries(values):
+    "Call each data layer method, returning (name, sql, params) for its statements"
+    list_db = wordlist.WordListData('', RecordingDatabase())
+    account_db = account.AccountData('', RecordingDatabase())
+    before = (values['modified_at'], values['list_id'])
+    words = [['字', 'zi4', ['character']]] * 20
+
+    calls = [
+        ('get_lists', list_db.get_lists, (), {}),
+        ('get_lists (next page)', list_db.get_lists, (), {'before': before}),
+        ('get_user_lists', list_db.get_user_lists, (values['account_id'],), {}),
+        ('get_user_lists (next page)', list_db.get_user_lists, (values['account_id'],), {'before': before}),
+        ('get_word_list', list_db.get_word_list, (values['list_id'],), {}),
+        ('get_list_info', list_db.get_list_info, (values['list_id'],), {}),
+        ('get_list_words', list_db.get_list_words, (values['list_id'],), {}),
+        ('get_lists_by_id', list_db.get_lists_by_id, ([values['list_id']],),
+         {'account_id': values['account_id']}),
+        ('get_lists_by_id (words)', list_db.get_lists_by_id, ([values['list_id']],),
+         {'account_id': values['account_id'], 'words': True}),
+        ('list_exists_for_account', list_db.list_exists_for_account,
+         (values['title'], values['account_id']), {}),
+        ('create_list (insert)', list_db.create_list, ('Explain list', words),
+         {'account_id': values['account_id']}),
+        ('create_list (update)', list_db.create_list, (values['title'], words),
+         {'list_id': values['list_id'], 'account_id': values['account_id']}),
+        ('upsert_list', list_db.upsert_list, (values['title'], words, values['account_id']), {}),
+        ('patch_list', list_db.patch_list,
+         (values['list_id'], values['account_id'], [('append', words[:1]), ('remove', 0)]), {}),
+        ('backfill_list_words', list_db.backfill_list_words, (100,), {}),
+        ('queue_skritter_push', list_db.queue_skritter_push,
+         (values['list_id'], values['account_id']), {}),
+        ('get_skritter_push', list_db.get_skritter_push, (1,), {}),
+        ('claim_skritter_push', list_db.claim_skritter_push,
+         (datetime.datetime.utcnow() - datetime.timedelta(minutes=5),), {}),
+        ('save_skritter_push_batch', list_db.save_skritter_push_batch,
+         (1, 'skritter', 19, 20, [(n, '字', 'added') for n in range(20)]), {}),
+        ('finish_skritter_push', list_db.finish_skritter_push, (1, 'done'), {}),
+        ('get_skritter_push_words', list_db.get_skritter_push_words, (1,), {}),
+        ('get_account', account_db.get_account, (values['email'].upper(),), {}),
+        ('get_account_by_id', account_db.get_account_by_id, (values['account_id'],), {}),
+        ('get_accounts', account_db.get_accounts, (),
+         {'emails': [values['email']], 'account_ids': [values['account_id']]}),
+        ('get_expiring_skritter_accounts', account_db.get_expiring_skritter_accounts,
+         (datetime.datetime.utcnow(),), {}),
+        ('authenticate_web_user', account_db.authenticate_web_user,
+         (values['email'], 'password', '/'), {}),
+        ('update_account', account_db.update_account,
+         (values['account_id'], values['email'], 'Name', None), {}),
+        ('store_skritter_token', account_db.store_skritter_token,
+         (values['account_id'], 'user', 'access', 'refresh', datetime.datetime.now()), {}),
+    ]
+
+    queries = []
+    for name, method, args, kwargs in calls:
+        db = method.__self__.db
+        del db.statements[:]
+        method(*(args + (None,)), **kwargs)
+        for sql, params in db.statements:
+            for statement, statement_params in split_statements(sql, params):
+                queries.append((name, statement, statement_params))
+
+    return queries
+
+
+def split_statements(sql, params):
+    "Split a batch of statements joined by ';\\n', giving each its own params"
+    params = list(params or [])
+    for statement in sql.split(';\n'):
+        count = statement.count('%s')
+        yield statement, params[:count]
+        params = params[count:]
+
+
+def explain(conn, name, sql, params):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql.strip().rstrip(';'), params)
+        plan = [row[0] for row in cursor]
+    finally:
+        conn.rollback()
+
+    seq_scans = [line.strip() for line in plan if 'Seq Scan' in line]
+    print('== %s%s' % (name, ' [SEQ SCAN]' if seq_scans else ''))
+    for line in plan:
+        print('   ' + line)
+    print('')
+
+    return seq_scans
+
+
+if __name__ == '__main__':
+    db_url = os.environ.get('DATABASE_URL', 'postgresql://localhost:5432/cihui')
+    conn = connect(db_url)
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--seed':
+        seed(conn, int(sys.argv[2]))
+
+    flagged = []
+    for name, sql, params in record_queries(sample_values(conn)):
+        if explain(conn, name, sql, params):
+            flagged.append(name)
+
+    print('Queries with sequential scans: %s' % (', '.join(sorted(set(flagged))) or 'none'))
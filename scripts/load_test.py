@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Run the app in-process against the fake database and request a set of
+# pages with a fixed number of requests in flight, then print throughput,
+# latency percentiles and the data layer stats. Needs no Postgres.
+#
+# Usage: python scripts/load_test.py [requests] [concurrency] [fake url]
+#
+# eg. python scripts/load_test.py 2000 20 'fake://?lists=500&words=200&latency_ms=2'
+#
+# Wrap it in python -m cProfile -s cumtime to profile the Python side.
+
+from cihui import app
+from cihui.data import account
+from cihui.data import wordlist
+from tornado import gen
+
+import functools
+import json
+import sys
+import time
+import tornado.httpclient
+import tornado.ioloop
+import tornado.testing
+
+PATHS = ['/', '/atom.xml', '/list/1', '/list/2.csv', '/list/3.tsv']
+
+
+@gen.coroutine
+def load(base_url, request_count, concurrency):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    latencies = []
+    errors = []
+    paths = iter(PATHS[n % len(PATHS)] for n in range(request_count))
+
+    @gen.coroutine
+    def worker():
+        for path in paths:
+            started = time.time()
+            try:
+                yield client.fetch(base_url + path, follow_redirects=False)
+            except tornado.httpclient.HTTPError as e:
+                errors.append((path, e.code))
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - started
+
+    latencies.sort()
+    print('%d requests in %.2fs: %.1f req/s, %d errors' % (
+        len(latencies), elapsed, len(latencies) / elapsed, len(errors)))
+    for percentile in [50, 90, 99]:
+        index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+        print('  p%d %.1fms' % (percentile, latencies[index] * 1000))
+
+
+if __name__ == '__main__':
+    request_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    db_url = sys.argv[3] if len(sys.argv) > 3 else 'fake://?lists=200&words=100&latency_ms=1'
+
+    account_db = account.AccountData(db_url)
+    list_db = wordlist.WordListData(db_url)
+    application = app.CiHuiApplication(account_db, list_db)
+
+    port = tornado.testing.get_unused_port()
+    application.listen(port, address='127.0.0.1')
+
+    tornado.ioloop.IOLoop.instance().run_sync(
+        functools.partial(load, 'http://127.0.0.1:%d' % port, request_count, concurrency))
+    print(json.dumps({'account_db': account_db.stats(), 'list_db': list_db.stats(),
+                      'page_cache': application.page_cache.stats()},
+                     indent=2, default=str))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Push queued lists into Skritter, as users ask for them from the list
+# page or the API. Runs until stopped. A push left running by a stopped
+# copy is resumed after a few minutes.
+#
+# Usage: python scripts/push_skritter_lists.py [requests per second]
+#
+# SKRITTER_API_URL and SKRITTER_TOKEN_URL point it at another Skritter,
+# eg. a local stand-in.
+
+from cihui import outbound
+from cihui import skritter
+from cihui.data import account
+from cihui.data import wordlist
+
+import logging
+import os
+import sys
+import tornado.ioloop
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    db_url = os.environ.get('DATABASE_URL', 'postgresql://localhost:5432/cihui')
+    rate = float(os.environ.get('SKRITTER_PUSH_RATE', skritter.PUSH_RATE))
+    if len(sys.argv) > 1:
+        rate = float(sys.argv[1])
+
+    account_db = account.AccountData(db_url)
+    list_db = wordlist.WordListData(db_url)
+    http_client = outbound.Client('skritter', rate=rate)
+    tokens = skritter.TokenManager(account_db,
+                                   os.environ.get('SKRITTER_OAUTH_CLIENT_ID'),
+                                   os.environ.get('SKRITTER_OAUTH_CLIENT_SECRET'),
+                                   http_client,
+                                   token_url=os.environ.get('SKRITTER_TOKEN_URL',
+                                                            skritter.TOKEN_URL))
+    pusher = skritter.ListPusher(list_db, account_db, tokens, http_client,
+                                 api_url=os.environ.get('SKRITTER_API_URL', skritter.API_URL))
+    pusher.start()
+
+    tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+# Refresh Skritter tokens before they expire, so requests for them find a
+# fresh token. Runs until stopped; run a single copy of it.
+#
+# Usage: python scripts/refresh_skritter_tokens.py [interval seconds]
+#
+# SKRITTER_TOKEN_URL points it at another token endpoint, eg. a local fake.
+
+from cihui import skritter
+from cihui.data import account
+
+import logging
+import os
+import sys
+import tornado.ioloop
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    db_url = os.environ.get('DATABASE_URL', 'postgresql://localhost:5432/cihui')
+    interval = skritter.REFRESH_INTERVAL
+    if len(sys.argv) > 1:
+        interval = float(sys.argv[1])
+
+    account_db = account.AccountData(db_url)
+    tokens = skritter.TokenManager(account_db,
+                                   os.environ.get('SKRITTER_OAUTH_CLIENT_ID'),
+                                   os.environ.get('SKRITTER_OAUTH_CLIENT_SECRET'),
+                                   token_url=os.environ.get('SKRITTER_TOKEN_URL',
+                                                            skritter.TOKEN_URL))
+    scheduler = skritter.RefreshScheduler(account_db, tokens, interval=interval)
+    scheduler.start()
+
+    tornado.ioloop.IOLoop.instance().start()
@@ -12,9 +12,12 @@ class AccountData:
 
 
 class ListData:
-    def get_lists(self, callback):
+    def get_lists(self, callback, before=None, limit=None):
         callback([{'id': 123, 'title': 'list123', 'stub': 'test-stub'}])
 
+    def get_lists_version(self, callback):
+        callback({'modified_at': None, 'count': 1})
+
 
 class DisplayWordListsTest(AsyncHTTPTestCase):
     def get_app(self):
@@ -41,7 +44,10 @@ class DisplayWordListsTest(AsyncHTTPTestCase):
 
 
 class NoListData:
-    def get_lists(self, callback):
+    def get_lists(self, callback, before=None, limit=None):
+        callback(None)
+
+    def get_lists_version(self, callback):
         callback(None)
 
 
@@ -4,6 +4,7 @@
 from cihui import atom_formatter
 from xml.etree import ElementTree
 
+import datetime
 import unittest
 
 
@@ -30,6 +31,16 @@ class TestAtomFormatter(unittest.TestCase):
         link_elem = entry_elem.find('{http://www.w3.org/2005/Atom}link')
         self.assertEqual('/link/', link_elem.get('href'))
 
+    def test_escaped(self):
+        atom_xml = atom_formatter.format_atom(title='<&>',
+                                              entries=[{'title': 'a "b" & c', 'link': '/x?a=1&b=2'}])
+        root_elem = ElementTree.fromstring(atom_xml)
+        entry_elem = root_elem.find('{http://www.w3.org/2005/Atom}entry')
+
+        self.assertEqual('<&>', root_elem.find('{http://www.w3.org/2005/Atom}title').text)
+        self.assertEqual('a "b" & c', entry_elem.find('{http://www.w3.org/2005/Atom}title').text)
+        self.assertEqual('/x?a=1&b=2', entry_elem.find('{http://www.w3.org/2005/Atom}link').get('href'))
+
     def test_multiple_items(self):
         entry_list = [{'title': 'First'}, {'title': 'Second'}]
         atom_xml = atom_formatter.format_atom(entries=entry_list)
@@ -38,3 +49,37 @@ class TestAtomFormatter(unittest.TestCase):
         entries = root_elem.findall('{http://www.w3.org/2005/Atom}entry')
 
         self.assertEqual(2, len(entries))
+
+
+class TestAtomWriter(unittest.TestCase):
+    def setUp(self):
+        self.pieces = []
+
+    def test_writes_as_it_goes(self):
+        writer = atom_formatter.AtomWriter(self.pieces.append, title='Feed')
+        written = len(self.pieces)
+
+        writer.add_entry({'title': 'First'})
+        self.assertGreater(len(self.pieces), written)
+        self.assertIn(b'First', self.pieces[-1])
+
+    def test_max_entries(self):
+        writer = atom_formatter.AtomWriter(self.pieces.append, max_entries=2)
+        self.assertEqual([True, True, False],
+                         [writer.add_entry({'title': str(n)}) for n in range(3)])
+        writer.close()
+
+        root_elem = ElementTree.fromstring(b''.join(self.pieces))
+        self.assertEqual(2, len(root_elem.findall('{http://www.w3.org/2005/Atom}entry')))
+
+    def test_updated(self):
+        writer = atom_formatter.AtomWriter(self.pieces.append, feed_id='urn:feed',
+                                           updated=datetime.datetime(2014, 8, 1, 12, 30, 5, 10))
+        writer.add_entry({'id': 'urn:entry', 'updated': datetime.datetime(2014, 8, 1)})
+        writer.close()
+
+        root_elem = ElementTree.fromstring(b''.join(self.pieces))
+        self.assertEqual('2014-08-01T12:30:05Z', root_elem.find('{http://www.w3.org/2005/Atom}updated').text)
+        self.assertEqual('urn:feed', root_elem.find('{http://www.w3.org/2005/Atom}id').text)
+        entry_elem = root_elem.find('{http://www.w3.org/2005/Atom}entry')
+        self.assertEqual('2014-08-01T00:00:00Z', entry_elem.find('{http://www.w3.org/2005/Atom}updated').text)
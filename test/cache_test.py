@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+from cihui import cache
+import unittest
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.LRUCache(30, sizeof=len)
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(1, self.cache.misses)
+
+    def test_hit(self):
+        self.cache.put(1, 'a' * 10, 'v1')
+        self.assertEqual('a' * 10, self.cache.get(1, 'v1'))
+        self.assertEqual(1, self.cache.hits)
+
+    def test_stale_version(self):
+        self.cache.put(1, 'a' * 10, 'v1')
+        self.assertIsNone(self.cache.get(1, 'v2'))
+        self.assertNotIn(1, self.cache)
+        self.assertEqual(0, self.cache.bytes)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put(1, 'a' * 10)
+        self.cache.put(2, 'b' * 10)
+        self.cache.get(1)
+        self.cache.put(3, 'c' * 15)
+
+        self.assertIn(1, self.cache)
+        self.assertNotIn(2, self.cache)
+        self.assertIn(3, self.cache)
+        self.assertEqual(25, self.cache.bytes)
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_replace_entry(self):
+        self.cache.put(1, 'a' * 10)
+        self.cache.put(1, 'a' * 20)
+        self.assertEqual(20, self.cache.bytes)
+        self.assertEqual(1, len(self.cache))
+
+    def test_too_large_for_cache(self):
+        self.cache.put(1, 'a' * 31)
+        self.assertNotIn(1, self.cache)
+
+    def test_invalidate(self):
+        self.cache.put(1, 'a' * 10)
+        self.cache.invalidate(1)
+        self.cache.invalidate(2)
+        self.assertEqual({'entries': 0, 'bytes': 0, 'max_bytes': 30, 'hits': 0,
+                          'misses': 0, 'hit_rate': None, 'evictions': 0, 'invalidations': 1},
+                         self.cache.stats())
+
+
+class TestApproximateSize(unittest.TestCase):
+    def test_nested_values_count(self):
+        word = ['大', 'da4', ['big']]
+        self.assertGreater(cache.approximate_size([word, word]),
+                           cache.approximate_size([word]))
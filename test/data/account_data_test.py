@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import datetime
 import mock
 import unittest
 
@@ -27,6 +28,64 @@ class DigestTest(unittest.TestCase):
 
         self.assertNotEqual(d1, d2)
 
+    def test_pbkdf2_digest(self):
+        digest = account.build_pbkdf2_digest('password', 'salt', 1000)
+
+        self.assertTrue(digest.startswith('pbkdf2_sha256$1000$'))
+        self.assertEqual(digest, account.build_pbkdf2_digest('password', 'salt', 1000))
+        self.assertNotEqual(digest, account.build_pbkdf2_digest('password', 'salt', 1001))
+
+
+class VerifyPasswordTest(unittest.TestCase):
+    def test_current_digest(self):
+        digest, salt = account.new_password_digest('secret')
+
+        self.assertEqual((True, False), account.verify_password('secret', salt, digest))
+        self.assertEqual((False, False), account.verify_password('wrong', salt, digest))
+
+    def test_legacy_digest_needs_rehash(self):
+        digest = account.build_password_digest('secret', 'salt').decode()
+
+        self.assertEqual((True, True), account.verify_password('secret', 'salt', digest))
+        self.assertEqual((False, False), account.verify_password('wrong', 'salt', digest))
+
+    def test_fewer_iterations_need_rehash(self):
+        digest = account.build_pbkdf2_digest('secret', 'salt', 1000)
+        self.assertEqual((True, True), account.verify_password('secret', 'salt', digest))
+
+    def test_no_password_set(self):
+        self.assertEqual((False, False), account.verify_password('secret', None, None))
+
+
+class PasswordHasherTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return mock.Mock()
+
+    def test_runs_off_ioloop(self):
+        hasher = account.PasswordHasher(workers=1)
+        hasher.submit(self.stop, sum, [1, 2])
+
+        self.assertEqual(1, hasher.pending)
+        self.assertEqual(3, self.wait())
+        self.assertEqual(0, hasher.pending)
+        self.assertEqual(1, hasher.completed)
+
+    def test_error_returns_none(self):
+        hasher = account.PasswordHasher(workers=1)
+        hasher.submit(self.stop, int, 'x')
+
+        self.assertIsNone(self.wait())
+
+    def test_queue_limit(self):
+        hasher = account.PasswordHasher(workers=1, queue_limit=0)
+        callback = mock.Mock()
+        hasher.submit(callback, sum, [1, 2])
+
+        result, error = callback.call_args[0]
+        self.assertIsNone(result)
+        self.assertIsInstance(error, account.PasswordQueueFullError)
+        self.assertEqual(1, hasher.stats()['rejected'])
+
 
 class AccountDataTest(AsyncHTTPTestCase):
     def get_app(self):
@@ -53,68 +112,106 @@ class AuthenticateAccountTest(AccountDataTest):
         self.accountdata.authenticate_web_user('user', 'secret', '/next',
                                                self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.accountdata.callbacks['0|user'], self.callback)
+        self.assertEqual(self.accountdata.callbacks.get(0), (self.callback, 'user'))
 
     def test_auth_web_user_response_empty(self):
         cursor = mock.MagicMock(side_effects=[])
 
-        self.accountdata.callbacks['0|user'] = self.callback
-        self.accountdata._on_authenticate_web_user('secret', '/next', '0|user', cursor)
+        cb_id = self.accountdata.add_callback(self.callback, 'user')
+        self.accountdata._on_authenticate_web_user('secret', '/next', cb_id, cursor)
 
         self.callback.assert_called_once_with()
 
     def test_auth_web_user_response_error(self):
         cursor = mock.MagicMock(side_effects=[])
 
-        self.accountdata.callbacks['0|user'] = self.callback
-        self.accountdata._on_authenticate_web_user('secret', '/next', '0|user', cursor, 'Error')
+        cb_id = self.accountdata.add_callback(self.callback, 'user')
+        self.accountdata._on_authenticate_web_user('secret', '/next', cb_id, cursor, 'Error')
 
         self.callback.assert_called_once_with()
 
-    def test_auth_web_user_response_invalid_password(self):
+    def authenticate(self, passwd_hash, passwd_salt):
         cursor = mock.MagicMock(side_effects=[])
-        passwd_hash = ''
-        passwd_salt = ''
         cursor.rowcount = 1
-        cursor.fetchone.return_value = tuple([1, 'test@exmaple.com', passwd_hash, passwd_salt])
+        cursor.fetchone.return_value = tuple([1, 'test@example.com', passwd_hash, passwd_salt])
+
+        self.callback.side_effect = lambda *args, **kwargs: self.stop()
+        cb_id = self.accountdata.add_callback(self.callback, 'user')
+        self.accountdata._on_authenticate_web_user('secret', '/next', cb_id, cursor)
+        self.wait()
 
-        self.accountdata.callbacks['0|user'] = self.callback
-        self.accountdata._on_authenticate_web_user('secret', '/next', '0|user', cursor)
+    def test_auth_web_user_response_invalid_password(self):
+        self.authenticate('', '')
 
         self.callback.assert_called_once_with()
 
     def test_auth_web_user_response_valid_password(self):
+        passwd_hash, passwd_salt = account.new_password_digest('secret')
+        self.authenticate(passwd_hash, passwd_salt)
+
+        self.callback.assert_called_once_with(1, '/next', 'test@example.com')
+        self.assertFalse(self.db.execute.called)
+
+    def test_auth_web_user_legacy_password_rehashed(self):
         passwd_salt = 'testsalt'
         passwd_hash = account.build_password_digest('secret', passwd_salt).decode()
 
-        cursor = mock.MagicMock(side_effects=[])
-        cursor.rowcount = 1
-        cursor.fetchone.return_value = tuple([1, 'test@example.com', passwd_hash, passwd_salt])
+        self.db.execute.side_effect = lambda *args, **kwargs: self.stop()
+        self.authenticate(passwd_hash, passwd_salt)
+        self.callback.assert_called_once_with(1, '/next', 'test@example.com')
 
-        self.accountdata.callbacks['0|user'] = self.callback
-        self.accountdata._on_authenticate_web_user('secret', '/next', '0|user', cursor)
+        self.wait()
+        new_hash, new_salt, account_id, old_hash = self.db.execute.call_args[0][1]
+        self.assertTrue(new_hash.startswith('pbkdf2_sha256$'))
+        self.assertEqual((True, False), account.verify_password('secret', new_salt, new_hash))
+        self.assertEqual((1, passwd_hash), (account_id, old_hash))
 
-        self.callback.assert_called_once_with(1, '/next', 'test@example.com')
+    def test_auth_web_user_password_queue_full(self):
+        self.accountdata.hasher = account.PasswordHasher(workers=1, queue_limit=0)
+        passwd_hash, passwd_salt = account.new_password_digest('secret')
+        self.authenticate(passwd_hash, passwd_salt)
+
+        self.assertIsInstance(self.callback.call_args[1]['error'], account.PasswordQueueFullError)
+
+    def test_stats(self):
+        self.assertEqual(0, self.accountdata.stats()['passwords']['pending'])
+
+
+class CreateAccountTest(AccountDataTest):
+    def test_create_account_digest(self):
+        self.db.execute.side_effect = lambda *args, **kwargs: self.stop()
+        self.accountdata.create_account('user@example.com', 'secret', self.callback)
+        self.wait()
+
+        email, passwd_hash, passwd_salt = self.db.execute.call_args[0][1]
+        self.assertEqual('user@example.com', email)
+        self.assertEqual((True, False), account.verify_password('secret', passwd_salt, passwd_hash))
 
 
 class GetAccountTest(AccountDataTest):
     def test_get_account_sql(self):
         self.accountdata.get_account('user@example.com', self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.accountdata.callbacks['0|user@example.com'], self.callback)
+        self.assertEqual(self.accountdata.callbacks.get(0), (self.callback, 'user@example.com'))
+
+    def test_get_account_ignores_email_case(self):
+        self.accountdata.get_account('User@Example.com', self.callback)
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('lower(email) = lower(%s) ORDER BY email = %s DESC', sql)
+        self.assertEqual(('User@Example.com', 'User@Example.com'), params)
 
     def test_get_account_by_id_sql(self):
         self.accountdata.get_account_by_id(1, self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.accountdata.callbacks['0|1'], self.callback)
+        self.assertEqual(self.accountdata.callbacks.get(0), (self.callback, 1))
 
     def test_get_account_result(self):
         cursor = mock.MagicMock(side_effects=[])
         cursor.rowcount = 1
         cursor.fetchone.return_value = tuple([1, 'test@example.com', 'Test User', None, None, None, None, None, None])
 
-        self.accountdata.callbacks['0|user'] = self.callback
-        self.accountdata._on_get_account_response('0|user', cursor)
+        cb_id = self.accountdata.add_callback(self.callback, 'user')
+        self.accountdata._on_get_account_response(cb_id, cursor)
 
         expected_result = {
             'account_id': 1,
@@ -132,27 +229,61 @@ class GetAccountTest(AccountDataTest):
 
     # TODO(gmwils): test for when no account found
 
+    def test_get_accounts_sql(self):
+        self.accountdata.get_accounts(self.callback, emails=['User@Example.com'], account_ids=(2, 3))
+
+        self.db.execute.assert_called_once()
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('lower(email) = ANY(%s) OR id = ANY(%s)', sql)
+        self.assertEqual((['user@example.com'], [2, 3]), params)
+
+    def test_get_accounts_result(self):
+        cursor = [(1, 'one@example.com', 'One', None, None, None, None, None, None),
+                  (2, 'two@example.com', None, None, None, 'sk', None, None, None)]
+
+        cb_id = self.accountdata.add_callback(self.callback)
+        self.accountdata._on_get_accounts_response(cb_id, cursor)
+
+        accounts, = self.callback.call_args[0]
+        self.assertEqual([1, 2], [result['account_id'] for result in accounts])
+        self.assertEqual('sk', accounts[1]['skritter_user'])
+
+    def test_get_expiring_skritter_accounts_sql(self):
+        expires_before = datetime.datetime(2014, 9, 1)
+        self.accountdata.get_expiring_skritter_accounts(expires_before, self.callback, limit=10)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('skritter_refresh_token IS NOT NULL', sql)
+        self.assertIn('id <> ALL(%s)', sql)
+        self.assertEqual((expires_before, [], 10), params)
+
+    def test_get_accounts_error(self):
+        cb_id = self.accountdata.add_callback(self.callback)
+        self.accountdata._on_get_accounts_response(cb_id, None, 'Error')
+
+        self.callback.assert_called_once_with(None)
+
 
 class UpdateAccountTest(AccountDataTest):
     def test_update_account(self):
         self.accountdata.update_account(17, 'u@e.com', 'user', 'pass', self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.accountdata.callbacks['0|17'], self.callback)
+        self.assertEqual(self.accountdata.callbacks.get(0), (self.callback, 17))
 
     def test_update_account_result(self):
         cursor = mock.MagicMock(side_effects=[])
         cursor.rowcount = 1
         cursor.fetchone.return_value = tuple([1])
 
-        self.accountdata.callbacks['0|1'] = self.callback
-        self.accountdata._on_update_account_response('0|1', cursor)
+        cb_id = self.accountdata.add_callback(self.callback, 1)
+        self.accountdata._on_update_account_response(cb_id, cursor)
 
         self.callback.assert_called_once_with(None)
 
     def test_update_account_result_failed(self):
         cursor = None
 
-        self.accountdata.callbacks['0|1'] = self.callback
-        self.accountdata._on_update_account_response('0|1', cursor)
+        cb_id = self.accountdata.add_callback(self.callback, 1)
+        self.accountdata._on_update_account_response(cb_id, cursor)
 
         self.callback.assert_called_once_with('Unknown error updating account id: 1')
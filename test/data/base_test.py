@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import datetime
+import functools
+import mock
+import momoko
+import tornado.concurrent
+
+from tornado.testing import AsyncTestCase
+from cihui.data import account
+from cihui.data import base
+from cihui.data import wordlist
+
+
+class CallbackRegistryTest(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.callback = mock.Mock()
+        self.registry = base.CallbackRegistry(limit=3, timeout=60)
+
+    def test_add_and_pop(self):
+        cb_id = self.registry.add(self.callback, 'rock')
+
+        self.assertEqual((self.callback, 'rock'), self.registry.pop(cb_id))
+        self.assertNotIn(cb_id, self.registry)
+        self.assertEqual({'outstanding': 0, 'expired': 0, 'completed': 1},
+                         self.registry.stats())
+
+    def test_pop_unknown_id(self):
+        self.assertEqual((None, None), self.registry.pop(42))
+        self.assertEqual(0, self.registry.stats()['completed'])
+
+    def test_limit_expires_oldest(self):
+        ids = [self.registry.add(self.callback, i) for i in range(4)]
+
+        self.assertEqual(3, len(self.registry))
+        self.assertNotIn(ids[0], self.registry)
+        self.assertIn(ids[3], self.registry)
+        self.assertEqual(1, self.registry.stats()['expired'])
+
+    def test_sweep_expires_timed_out_entries(self):
+        self.registry.timeout = 0
+        self.registry.add(self.callback)
+        self.registry.add(self.callback)
+
+        self.registry.sweep()
+
+        self.assertEqual({'outstanding': 0, 'expired': 2, 'completed': 0},
+                         self.registry.stats())
+
+    def test_sweep_keeps_live_entries(self):
+        cb_id = self.registry.add(self.callback)
+        self.registry.sweep()
+
+        self.assertIn(cb_id, self.registry)
+
+    def test_expiry_handler_called(self):
+        self.registry.timeout = 0
+        cb_id = self.registry.add(self.callback, 'rock')
+        self.registry.set_expiry(cb_id, lambda: self.registry.pop(cb_id)[0](None))
+
+        self.registry.sweep()
+
+        self.callback.assert_called_once_with(None)
+        self.assertEqual({'outstanding': 0, 'expired': 1, 'completed': 0},
+                         self.registry.stats())
+
+    def test_limit_calls_expiry_handler(self):
+        expired = mock.Mock(side_effect=ValueError('handler failed'))
+        cb_id = self.registry.add(self.callback)
+        self.registry.set_expiry(cb_id, expired)
+
+        for i in range(3):
+            self.registry.add(self.callback)
+
+        expired.assert_called_once_with()
+        self.assertNotIn(cb_id, self.registry)
+        self.assertEqual(3, len(self.registry))
+
+
+class BaseDatabaseTest(AsyncTestCase):
+    def test_expired_callback_is_discarded(self):
+        database = base.BaseDatabase(callback_timeout=0)
+        callback = mock.Mock()
+        cb_id = database.add_callback(callback, 'rock')
+        database.callbacks.sweep()
+
+        late_callback, rock = database.get_callback(cb_id)
+        late_callback('result')
+
+        self.assertIsNone(rock)
+        self.assertFalse(callback.called)
+        self.assertEqual(1, database.callback_stats()['expired'])
+
+
+class ExpiredQueryTest(AsyncTestCase):
+    "Each data method still calls back, with a failure, when its query expires"
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.db = mock.Mock()
+        self.list_db = wordlist.WordListData('', self.db)
+        self.account_db = account.AccountData('', self.db)
+        self.results = []
+
+    def callback(self, *args, **kwargs):
+        self.results.append(args)
+
+    def expire(self, database):
+        database.callbacks.timeout = 0
+        return database.callbacks
+
+    def test_list_queries(self):
+        now = datetime.datetime.utcnow()
+        words = [['大', 'da', ['big']]]
+        calls = [(self.list_db.get_lists, ()),
+                 (self.list_db.get_lists_version, ()),
+                 (self.list_db.get_user_lists, (1,)),
+                 (self.list_db.get_word_list, (1,)),
+                 (self.list_db.get_list_info, (1,)),
+                 (self.list_db.get_list_words, (1,)),
+                 (self.list_db.get_lists_by_id, ([1],)),
+                 (functools.partial(self.list_db.get_lists_by_id, words=True), ([1],)),
+                 (self.list_db.backfill_list_words, (10,)),
+                 (self.list_db.patch_list, (1, 1, [('remove', 0)])),
+                 (self.list_db.queue_skritter_push, (1, 1)),
+                 (self.list_db.get_skritter_push, (1,)),
+                 (self.list_db.claim_skritter_push, (now,)),
+                 (self.list_db.save_skritter_push_batch, (1, 'sk', 0, 1, [])),
+                 (self.list_db.finish_skritter_push, (1, 'done')),
+                 (self.list_db.get_skritter_push_words, (1,)),
+                 (self.list_db.list_exists, ('Title',)),
+                 (self.list_db.list_exists_for_account, ('Title', 1)),
+                 (self.list_db.upsert_list, ('Title', words, 1)),
+                 (self.list_db.create_list, ('Title', words)),
+                 (functools.partial(self.list_db.create_list, list_id=1), ('Title', words))]
+
+        registry = self.expire(self.list_db)
+        for method, args in calls:
+            del self.results[:]
+            method(*(args + (self.callback,)))
+            registry.sweep()
+
+            self.assertEqual(1, len(self.results), method)
+        self.assertEqual(len(calls), registry.stats()['expired'])
+
+    def test_account_queries(self):
+        now = datetime.datetime.utcnow()
+        calls = [(self.account_db.authenticate_web_user, ('user', 'secret', '/')),
+                 (self.account_db.get_account, ('user@example.com',)),
+                 (self.account_db.get_account_by_id, (1,)),
+                 (functools.partial(self.account_db.get_accounts, account_ids=[1]), ()),
+                 (self.account_db.get_expiring_skritter_accounts, (now,)),
+                 (self.account_db.update_account, (1, 'user@example.com', 'User', None)),
+                 (self.account_db.store_skritter_token, (1, 'user', 'access', 'refresh', now))]
+
+        registry = self.expire(self.account_db)
+        for method, args in calls:
+            del self.results[:]
+            method(*(args + (self.callback,)))
+            registry.sweep()
+
+            self.assertEqual(1, len(self.results), method)
+
+    def test_late_result_discarded(self):
+        self.expire(self.list_db)
+        self.list_db.get_list_info(1, self.callback)
+        self.list_db.callbacks.sweep()
+
+        self.db.execute.call_args[1]['callback'](mock.Mock(rowcount=0), None)
+        self.assertEqual([(None,)], self.results)
+
+
+class PoolStatsTest(AsyncTestCase):
+    def build_pool(self):
+        pool = momoko.Pool.__new__(momoko.Pool)
+        pool.size = 1
+        pool.max_size = 4
+        pool._conns = momoko.Pool.Connections(0.5, self.io_loop)
+        return pool
+
+    def test_pool_occupancy(self):
+        pool = self.build_pool()
+        pool._conns.free.add(mock.Mock())
+        pool._conns.busy.update([mock.Mock(), mock.Mock()])
+
+        stats = base.pool_stats(pool)
+
+        self.assertEqual({'size': 1, 'max_size': 4, 'idle': 1, 'busy': 2,
+                          'waiting': 0, 'pending': 0, 'dead': 0}, stats)
+
+    def test_not_a_pool(self):
+        self.assertEqual({}, base.pool_stats(mock.Mock()))
+
+    def test_recycle_old_connections(self):
+        database = base.AsyncDatabase('', self.build_pool())
+        database.conn_lifetime = 60
+        conn = mock.Mock()
+        database.db._conns.free.add(conn)
+        database.connection_opened[conn] = 0
+
+        database.recycle_connections()
+
+        conn.close.assert_called_once_with()
+        self.assertEqual(set([conn]), database.db._conns.dead)
+        self.assertEqual(set(), database.db._conns.free)
+
+
+class QueryStatsTest(AsyncTestCase):
+    def test_record(self):
+        query_stats = base.QueryStats()
+        query_stats.record('get_lists', 0.004, 0.001, 3, None)
+        query_stats.record('get_lists', 0.030, 0, 0, 'error')
+
+        stats = query_stats.stats()['get_lists']
+        self.assertEqual(2, stats['calls'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(3, stats['rows'])
+        self.assertAlmostEqual(34.0, stats['total_ms'])
+        self.assertAlmostEqual(30.0, stats['max_ms'])
+        self.assertAlmostEqual(1.0, stats['pool_wait_ms'])
+        self.assertEqual(1, stats['histogram']['le_5'])
+        self.assertEqual(1, stats['histogram']['le_50'])
+        self.assertEqual(0, stats['histogram']['inf'])
+
+    def test_slow_query_logged(self):
+        query_stats = base.QueryStats(slow_query_ms=100)
+        with mock.patch('logging.warning') as warning:
+            query_stats.record('get_lists', 0.05, 0, 1, None, ['true', 50])
+            self.assertFalse(warning.called)
+
+            query_stats.record('get_lists', 0.2, 0, 1, None, ['true', 50])
+            self.assertEqual(('get_lists', '(str, int)'), warning.call_args[0][1:3])
+
+    def test_params_shape(self):
+        self.assertEqual('(int, list[3], NoneType)', base.params_shape([1, [1, 2, 3], None]))
+        self.assertEqual('()', base.params_shape(None))
+
+
+class ExecuteTest(AsyncTestCase):
+    def test_execute_records_statement(self):
+        db = mock.Mock()
+        database = base.AsyncDatabase('', db)
+        callback = mock.Mock()
+        cursor = mock.Mock(rowcount=2)
+
+        database.execute('get_lists', 'SELECT 1', [], callback)
+        sql, params = db.execute.call_args[0]
+        db.execute.call_args[1]['callback'](cursor, None)
+
+        self.assertEqual('/* get_lists */ SELECT 1', sql)
+        callback.assert_called_once_with(cursor, None)
+        self.assertEqual(2, database.stats()['queries']['get_lists']['rows'])
+
+    def test_execute_records_pool_wait(self):
+        pool = PoolStatsTest.build_pool(self)
+        database = base.AsyncDatabase('', pool)
+        database.query_stats.slow_query_ms = None
+        waiting = tornado.concurrent.Future()
+        callbacks = []
+
+        def execute(sql, params, callback):
+            # No free connection: the pool queues the request
+            pool._conns.waiting_queue.appendleft(waiting)
+            callbacks.append(callback)
+        pool.execute = execute
+
+        with mock.patch('time.time', side_effect=[100.0, 100.25, 100.5]):
+            database.execute('get_lists', 'SELECT 1', [], mock.Mock())
+            waiting.set_result(mock.Mock())
+            callbacks[0](mock.Mock(rowcount=1), None)
+
+        stats = database.query_stats.stats()['get_lists']
+        self.assertAlmostEqual(500.0, stats['total_ms'])
+        self.assertAlmostEqual(250.0, stats['pool_wait_ms'])
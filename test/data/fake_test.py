@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import datetime
+
+from tornado.testing import AsyncTestCase
+from cihui.data import account
+from cihui.data import fake
+from cihui.data import wordlist
+
+
+class FakeDatabaseTest(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.db = fake.FakeDatabase(seed=1)
+        self.db.seed(accounts=2, lists=3, words=4)
+        self.listdata = wordlist.WordListData('', self.db)
+        self.accountdata = account.AccountData('', self.db)
+
+    def call(self, method, *args, **kwargs):
+        method(*args, callback=lambda *result, **named: self.stop(result + tuple(named.values())),
+               **kwargs)
+        return self.wait()
+
+
+class FakeListTest(FakeDatabaseTest):
+    def test_get_lists(self):
+        word_lists, = self.call(self.listdata.get_lists)
+        self.assertEqual([3, 2, 1], [word_list['id'] for word_list in word_lists])
+
+        before = (word_lists[0]['modified_at'], word_lists[0]['id'])
+        word_lists, = self.call(self.listdata.get_lists, before=before, limit=1)
+        self.assertEqual([2], [word_list['id'] for word_list in word_lists])
+
+    def test_get_lists_version(self):
+        version, = self.call(self.listdata.get_lists_version)
+        word_lists, = self.call(self.listdata.get_lists)
+
+        self.assertEqual(3, version['count'])
+        self.assertEqual(word_lists[0]['modified_at'], version['modified_at'])
+
+    def test_get_user_lists(self):
+        word_lists, = self.call(self.listdata.get_user_lists, 1)
+        self.assertEqual([3, 1], [word_list['id'] for word_list in word_lists])
+
+    def test_get_word_list(self):
+        word_list, = self.call(self.listdata.get_word_list, 1)
+
+        self.assertEqual('List 1', word_list['title'])
+        self.assertEqual(['字0', 'zi0', ['word 0']], word_list['words'][0])
+        self.assertEqual(4, word_list['word_count'])
+
+    def test_missing_list(self):
+        self.assertEqual((None,), self.call(self.listdata.get_word_list, 99))
+
+    def test_get_list_words(self):
+        page, = self.call(self.listdata.get_list_words, 1, after_position=0, limit=2)
+
+        self.assertEqual(['字1', '字2'], [word[0] for word in page['words']])
+        self.assertEqual(2, page['next_position'])
+
+    def test_get_lists_by_id(self):
+        private_id = self.db.add_list('Private', [], 2, public=False)
+
+        word_lists, = self.call(self.listdata.get_lists_by_id, [private_id, 2, 99])
+        self.assertEqual([2], [word_list['id'] for word_list in word_lists])
+
+        word_lists, = self.call(self.listdata.get_lists_by_id, [private_id, 2], account_id=2)
+        self.assertEqual([2, private_id], [word_list['id'] for word_list in word_lists])
+
+    def test_get_lists_by_id_words(self):
+        word_lists, = self.call(self.listdata.get_lists_by_id, [1, 2], words=True,
+                                after_position=1, limit=2)
+
+        self.assertEqual([['字2', '字3'], ['字2', '字3']],
+                         [[word[0] for word in word_list['words']] for word_list in word_lists])
+        self.assertEqual([3, 3], [word_list['next_position'] for word_list in word_lists])
+
+    def test_upsert_list(self):
+        list_id, created = self.call(self.listdata.upsert_list, 'New', [['大', 'da', ['big']]], 2)
+        self.assertTrue(created)
+
+        self.assertEqual((list_id, False),
+                         self.call(self.listdata.upsert_list, 'New', [['小', 'xiao', []]], 2))
+        word_list, = self.call(self.listdata.get_word_list, list_id)
+        self.assertEqual([['小', 'xiao', []]], word_list['words'])
+
+    def test_upsert_unknown_account(self):
+        self.assertEqual((None, None),
+                         self.call(self.listdata.upsert_list, 'New', [['大', 'da', ['big']]], 99))
+
+    def test_patch_list(self):
+        word_count, = self.call(self.listdata.patch_list, 1, 1,
+                                [('append', [['大', 'da', ['big']]]),
+                                 ('remove', 0),
+                                 ('replace', 0, ['小', 'xiao', []])])
+        self.assertEqual(4, word_count)
+
+        word_list, = self.call(self.listdata.get_word_list, 1)
+        self.assertEqual(['小', '字2', '字3', '大'], [word[0] for word in word_list['words']])
+
+    def test_patch_missing_word(self):
+        result = self.call(self.listdata.patch_list, 1, 1,
+                           [('remove', 0), ('replace', 3, ['小', 'xiao', []])])
+        self.assertEqual((None, 'Operation 1: no word at position 3'), result)
+
+        word_list, = self.call(self.listdata.get_word_list, 1)
+        self.assertEqual(['字0', '字1', '字2', '字3'], [word[0] for word in word_list['words']])
+
+    def test_patch_other_account(self):
+        self.assertEqual((None,), self.call(self.listdata.patch_list, 1, 2, [('remove', 0)]))
+
+    def test_create_list(self):
+        success, _ = self.call(self.listdata.create_list, 'Created', [['大', 'da', ['big']]],
+                               email_address='USER1@example.com')
+        self.assertTrue(success)
+
+        word_lists, = self.call(self.listdata.get_user_lists, 1)
+        self.assertEqual('Created', word_lists[0]['title'])
+
+
+class FakeSkritterPushTest(FakeDatabaseTest):
+    def test_push_resumed_after_failure(self):
+        push, = self.call(self.listdata.queue_skritter_push, 2, 1)
+        self.assertEqual(('queued', 'List 2', 4), (push['status'], push['title'], push['word_count']))
+        self.assertEqual(push['id'], self.call(self.listdata.queue_skritter_push, 2, 1)[0]['id'])
+
+        stale_before = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        claimed, = self.call(self.listdata.claim_skritter_push, stale_before)
+        self.assertEqual((push['id'], 'running'), (claimed['id'], claimed['status']))
+        self.assertEqual((None,), self.call(self.listdata.claim_skritter_push, stale_before))
+
+        self.assertEqual((True,), self.call(self.listdata.save_skritter_push_batch, push['id'],
+                                            'sk', 1, 2, [(0, '字0', 'added'), (1, '字1', 'not_found')]))
+        self.assertEqual((True,), self.call(self.listdata.finish_skritter_push, push['id'], 'failed',
+                                            error='Skritter down'))
+
+        resumed, = self.call(self.listdata.queue_skritter_push, 2, 1)
+        self.assertEqual((push['id'], 'queued', None, 1, 2),
+                         (resumed['id'], resumed['status'], resumed['error'],
+                          resumed['position'], resumed['pushed']))
+
+        results, = self.call(self.listdata.get_skritter_push_words, push['id'], after=0)
+        self.assertEqual({'words': [{'word': 1, 'zi': '字1', 'result': 'not_found'}],
+                          'next_word': None}, results)
+
+    def test_stale_push_claimed(self):
+        push, = self.call(self.listdata.queue_skritter_push, 1, 1)
+        self.call(self.listdata.claim_skritter_push, datetime.datetime.utcnow())
+
+        claimed, = self.call(self.listdata.claim_skritter_push,
+                             datetime.datetime.utcnow() + datetime.timedelta(seconds=1))
+        self.assertEqual(push['id'], claimed['id'])
+
+    def test_finished_push_not_saved(self):
+        push, = self.call(self.listdata.queue_skritter_push, 1, 1)
+        self.assertEqual((False,), self.call(self.listdata.save_skritter_push_batch, push['id'],
+                                             'sk', 0, 1, [(0, '字0', 'added')]))
+
+    def test_private_list(self):
+        self.db.lists[1]['public'] = False
+        self.assertEqual((None,), self.call(self.listdata.queue_skritter_push, 1, 2))
+
+
+class FakeAccountTest(FakeDatabaseTest):
+    def test_authenticate(self):
+        result = self.call(self.accountdata.authenticate_web_user,
+                           'user1@example.com', fake.SEED_PASSWORD, '/next')
+        self.assertEqual((1, '/next', 'user1@example.com'), result)
+
+        self.assertEqual((), self.call(self.accountdata.authenticate_web_user,
+                                       'user1@example.com', 'wrong', '/next'))
+
+    def test_create_and_get_account(self):
+        account_id, = self.call(self.accountdata.create_account, 'new@example.com', 'secret')
+        result, = self.call(self.accountdata.get_account, 'NEW@example.com')
+
+        self.assertEqual(account_id, result['account_id'])
+        self.assertEqual((None,), self.call(self.accountdata.create_account, 'new@example.com', 'secret'))
+
+    def test_exact_email_preferred(self):
+        variant_id = self.db.add_account('User1@example.com')
+
+        self.assertEqual(variant_id, self.call(self.accountdata.get_account,
+                                               'User1@example.com')[0]['account_id'])
+        self.assertEqual(1, self.call(self.accountdata.get_account,
+                                      'user1@example.com')[0]['account_id'])
+        self.assertEqual((None,), self.call(self.accountdata.create_account,
+                                            'USER1@example.com', 'secret'))
+
+        success, list_id = self.call(self.listdata.create_list, 'Mine', [['大', 'da', ['big']]],
+                                     email_address='User1@example.com')
+        self.assertTrue(success)
+        self.assertEqual(variant_id, self.db.lists[list_id]['account_id'])
+
+    def test_get_accounts(self):
+        accounts, = self.call(self.accountdata.get_accounts,
+                              emails=['USER1@example.com', 'nobody@example.com'], account_ids=[2, 99])
+
+        self.assertEqual([1, 2], sorted(result['account_id'] for result in accounts))
+
+    def test_get_expiring_skritter_accounts(self):
+        now = datetime.datetime(2014, 9, 1)
+        for account_id, hours in [(1, 2), (2, 1)]:
+            self.call(self.accountdata.store_skritter_token, account_id, 'skritter', 'access',
+                      'refresh', now + datetime.timedelta(hours=hours))
+
+        accounts, = self.call(self.accountdata.get_expiring_skritter_accounts,
+                              now + datetime.timedelta(hours=3))
+        self.assertEqual([2, 1], [result['account_id'] for result in accounts])
+
+        accounts, = self.call(self.accountdata.get_expiring_skritter_accounts,
+                              now + datetime.timedelta(hours=3), limit=1)
+        self.assertEqual([2], [result['account_id'] for result in accounts])
+
+    def test_store_skritter_token(self):
+        expiry = datetime.datetime(2014, 9, 1)
+        self.assertEqual((None,), self.call(self.accountdata.store_skritter_token,
+                                            1, 'skritter', 'access', 'refresh', expiry))
+
+        result, = self.call(self.accountdata.get_account_by_id, 1)
+        self.assertEqual('access', result['skritter_access_token'])
+        self.assertEqual(expiry, result['skritter_token_expiry'])
+
+
+class FakeBehaviourTest(FakeDatabaseTest):
+    def test_failure_injection(self):
+        self.db.fail_statements.add('get_list_info')
+
+        self.assertEqual((None,), self.call(self.listdata.get_list_info, 1))
+        self.assertEqual(1, self.db.failures['get_list_info'])
+        self.assertEqual(1, self.listdata.stats()['queries']['get_list_info']['errors'])
+
+    def test_latency(self):
+        self.db.latency_ms = 50
+        started = self.io_loop.time()
+        self.call(self.listdata.get_list_info, 1)
+
+        self.assertGreaterEqual(self.io_loop.time() - started, 0.05)
+
+    def test_unnamed_statement(self):
+        self.assertRaises(ValueError, self.db.execute, 'SELECT 1', [])
+
+    def test_for_url(self):
+        db_url = 'fake://?lists=5&words=2&latency_ms=1'
+        database = wordlist.WordListData(db_url)
+
+        self.assertIs(database.db, account.AccountData(db_url).db)
+        self.assertEqual(5, len(database.db.lists))
+        self.assertEqual(1, database.db.latency_ms)
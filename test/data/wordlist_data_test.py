@@ -3,6 +3,7 @@
 
 import datetime
 import mock
+import unittest
 
 from tornado.testing import AsyncHTTPTestCase
 from cihui.data import wordlist
@@ -24,28 +25,58 @@ class GetManyListsTest(WordListDataTest):
     def test_get_lists_sql(self):
         self.listdata.get_lists(self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.listdata.callbacks['0|'], self.callback)
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, ''))
 
     def test_got_lists(self):
         cursor = mock.MagicMock(side_effect=[])
 
-        self.listdata.callbacks['0|'] = self.callback
-        self.listdata._on_get_lists_response('0|', cursor)
+        cb_id = self.listdata.add_callback(self.callback)
+        self.listdata._on_get_lists_response(cb_id, cursor)
 
         self.callback.assert_called_once_with([])
 
+    def test_get_lists_page_sql(self):
+        before = (datetime.datetime(2014, 8, 1, 12, 30), 42)
+        self.listdata.get_lists(self.callback, before=before, limit=10)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('(modified_at, id) < (%s, %s)', sql)
+        self.assertIn('ORDER BY modified_at DESC, id DESC LIMIT %s', sql)
+        self.assertEqual(['true', before[0], 42, 10], params)
+
+    def test_get_user_lists_sql(self):
+        self.listdata.get_user_lists(3, self.callback, limit=10)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertNotIn('(modified_at, id) <', sql)
+        self.assertEqual([3, 10], params)
+
+
+class ListCursorTest(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        modified_at = datetime.datetime(2014, 8, 1, 12, 30, 5, 1234)
+        cursor = wordlist.make_list_cursor({'id': 42, 'modified_at': modified_at})
+
+        self.assertEqual('2014-08-01T12:30:05.001234_42', cursor)
+        self.assertEqual((modified_at, 42), wordlist.parse_list_cursor(cursor))
+
+    def test_invalid_cursor(self):
+        for cursor in ['', '42', '2014-08-01_42', '2014-08-01T12:30:05.001234_x']:
+            self.assertRaises(ValueError, wordlist.parse_list_cursor, cursor)
+
 
 class GetWordListTest(WordListDataTest):
     def test_get_basic_list(self):
         self.listdata.get_word_list(12, self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.listdata.callbacks['0|12'], self.callback)
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, 12))
 
     def test_got_no_word_list(self):
         cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 0
 
-        self.listdata.callbacks['0|'] = self.callback
-        self.listdata._on_get_word_list_response('0|', cursor)
+        cb_id = self.listdata.add_callback(self.callback)
+        self.listdata._on_get_word_list_response(cb_id, cursor)
 
         self.callback.assert_called_once_with(None)
 
@@ -53,33 +84,288 @@ class GetWordListTest(WordListDataTest):
         sample_date = datetime.datetime(1997, 11, 21, 16, 30)
         cursor = mock.MagicMock(side_effect=[])
         cursor.rowcount = 1
-        cursor.fetchone.return_value = tuple([1, 'Test', None, sample_date, True, 1])
+        cursor.fetchall.return_value = [tuple([1, 'Test', None, sample_date, True, 1, None, None, None, None])]
 
-        self.listdata.callbacks['0|1'] = self.callback
-        self.listdata._on_get_word_list_response('0|1', cursor)
+        cb_id = self.listdata.add_callback(self.callback, 1)
+        self.listdata._on_get_word_list_response(cb_id, cursor)
 
         self.callback.assert_called_once_with({'id': 1,
                                                'title': 'Test',
                                                'words': None,
                                                'modified_at': sample_date,
                                                'public': True,
-                                               'account_id': 1})
+                                               'account_id': 1,
+                                               'word_count': None})
 
     def test_got_one_word_list_with_words(self):
         sample_date = datetime.datetime(1997, 11, 21, 16, 30)
         cursor = mock.MagicMock(side_effect=[])
         cursor.rowcount = 1
-        cursor.fetchone.return_value = tuple([1, 'Test', '{"key": "value"}', sample_date, True, 1])
+        cursor.fetchall.return_value = [tuple([1, 'Test', '{"key": "value"}', sample_date, True, 1,
+                                               None, None, None, None])]
 
-        self.listdata.callbacks['0|1'] = self.callback
-        self.listdata._on_get_word_list_response('0|1', cursor)
+        cb_id = self.listdata.add_callback(self.callback, 1)
+        self.listdata._on_get_word_list_response(cb_id, cursor)
 
         self.callback.assert_called_once_with({'id': 1,
                                                'title': 'Test',
                                                'words': {'key': 'value'},
                                                'modified_at': sample_date,
                                                'public': True,
-                                               'account_id': 1})
+                                               'account_id': 1,
+                                               'word_count': None})
+
+    def test_got_word_list_from_list_word(self):
+        sample_date = datetime.datetime(1997, 11, 21, 16, 30)
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 2
+        cursor.fetchall.return_value = [(1, 'Test', None, sample_date, True, 1, 2, '大', 'da', '["big"]'),
+                                        (1, 'Test', None, sample_date, True, 1, 2, '小', 'xiao', '[]')]
+
+        cb_id = self.listdata.add_callback(self.callback, 1)
+        self.listdata._on_get_word_list_response(cb_id, cursor)
+
+        word_list = self.callback.call_args[0][0]
+        self.assertEqual([['大', 'da', ['big']], ['小', 'xiao', []]], word_list['words'])
+        self.assertEqual(2, word_list['word_count'])
+
+    def test_got_empty_word_list_from_list_word(self):
+        sample_date = datetime.datetime(1997, 11, 21, 16, 30)
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 1
+        cursor.fetchall.return_value = [(1, 'Test', None, sample_date, True, 1, 0, None, None, None)]
+
+        cb_id = self.listdata.add_callback(self.callback, 1)
+        self.listdata._on_get_word_list_response(cb_id, cursor)
+
+        self.assertEqual([], self.callback.call_args[0][0]['words'])
+
+
+class CachedWordListTest(WordListDataTest):
+    def setUp(self):
+        WordListDataTest.setUp(self)
+        self.sample_date = datetime.datetime(1997, 11, 21, 16, 30)
+        self.list_info = {'id': 1, 'title': 'Test', 'modified_at': self.sample_date,
+                          'public': True, 'account_id': 2, 'word_count': 1}
+
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 1
+        cursor.fetchall.return_value = [(1, 'Test', None, self.sample_date, True, 2, 1, '大', 'da', '["big"]')]
+        cb_id = self.listdata.add_callback(mock.Mock(), 1)
+        self.listdata._on_get_word_list_response(cb_id, cursor)
+        self.db.reset_mock()
+
+    def test_cached_list_is_checked(self):
+        self.listdata.get_word_list(1, self.callback)
+
+        self.assertNotIn('list_word', self.db.execute.call_args[0][0])
+        self.assertFalse(self.callback.called)
+
+    def test_cached_list_used_when_current(self):
+        self.listdata._on_check_cached_list(1, self.callback, self.list_info)
+
+        word_list = self.callback.call_args[0][0]
+        self.assertEqual([['大', 'da', ['big']]], word_list['words'])
+        self.assertEqual(1, self.listdata.list_cache.hits)
+        self.assertFalse(self.db.execute.called)
+
+    def test_list_info_from_caller_not_checked_again(self):
+        self.listdata.get_word_list(1, self.callback, list_info=self.list_info)
+
+        self.assertFalse(self.db.execute.called)
+        self.assertEqual('Test', self.callback.call_args[0][0]['title'])
+
+    def test_permissions_come_from_database(self):
+        self.list_info['public'] = False
+        self.listdata._on_check_cached_list(1, self.callback, self.list_info)
+
+        self.assertFalse(self.callback.call_args[0][0]['public'])
+
+    def test_cached_list_copied(self):
+        self.listdata._on_check_cached_list(1, self.callback, self.list_info)
+        self.callback.call_args[0][0]['words'].append(['小', 'xiao', []])
+
+        self.listdata._on_check_cached_list(1, self.callback, self.list_info)
+        self.assertEqual(1, len(self.callback.call_args[0][0]['words']))
+
+    def test_stale_list_refetched(self):
+        self.list_info['modified_at'] = datetime.datetime(2014, 1, 1)
+        self.listdata._on_check_cached_list(1, self.callback, self.list_info)
+
+        self.assertIn('list_word', self.db.execute.call_args[0][0])
+        self.assertEqual(1, self.listdata.list_cache.misses)
+
+    def test_deleted_list(self):
+        self.listdata._on_check_cached_list(1, self.callback, None)
+
+        self.callback.assert_called_once_with(None)
+        self.assertNotIn(1, self.listdata.list_cache)
+
+    def test_update_invalidates(self):
+        self.listdata.create_list('Test', [], self.callback, list_id=1, account_id=2)
+        self.assertNotIn(1, self.listdata.list_cache)
+
+    def test_patch_invalidates(self):
+        self.listdata.patch_list(1, 2, [('remove', 0)], self.callback)
+        self.assertNotIn(1, self.listdata.list_cache)
+
+    def test_stats(self):
+        self.assertEqual(1, self.listdata.stats()['list_cache']['entries'])
+
+
+class GetListsVersionTest(WordListDataTest):
+    def test_get_lists_version_sql(self):
+        self.listdata.get_lists_version(self.callback)
+        self.db.execute.assert_called_once()
+        self.assertIn('max(modified_at)', self.db.execute.call_args[0][0])
+
+    def test_got_lists_version(self):
+        sample_date = datetime.datetime(1997, 11, 21, 16, 30)
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 1
+        cursor.fetchone.return_value = (sample_date, 3)
+
+        cb_id = self.listdata.add_callback(self.callback)
+        self.listdata._on_get_lists_version_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with({'modified_at': sample_date, 'count': 3})
+
+    def test_lists_version_error(self):
+        cb_id = self.listdata.add_callback(self.callback)
+        self.listdata._on_get_lists_version_response(cb_id, None, 'error')
+
+        self.callback.assert_called_once_with(None)
+
+
+class GetListInfoTest(WordListDataTest):
+    def test_get_list_info_sql(self):
+        self.listdata.get_list_info(12, self.callback)
+        self.db.execute.assert_called_once()
+        self.assertNotIn('words', self.db.execute.call_args[0][0])
+
+    def test_got_list_info(self):
+        sample_date = datetime.datetime(1997, 11, 21, 16, 30)
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 1
+        cursor.fetchone.return_value = (1, 'Test', sample_date, True, 2, 40)
+
+        cb_id = self.listdata.add_callback(self.callback, 1)
+        self.listdata._on_get_list_info_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with({'id': 1,
+                                               'title': 'Test',
+                                               'modified_at': sample_date,
+                                               'public': True,
+                                               'account_id': 2,
+                                               'word_count': 40})
+
+
+class GetListWordsTest(WordListDataTest):
+    def test_get_list_words_sql(self):
+        self.listdata.get_list_words(12, self.callback, after_position=99, limit=50)
+        self.db.execute.assert_called_once()
+        self.assertEqual((12, 99, 50), self.db.execute.call_args[0][1])
+
+    def test_got_full_page(self):
+        cursor = [(3, '大', 'da', '["big"]'), (7, '小', 'xiao', '["small"]')]
+
+        cb_id = self.listdata.add_callback(self.callback, 2)
+        self.listdata._on_get_list_words_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with({'words': [['大', 'da', ['big']], ['小', 'xiao', ['small']]],
+                                               'next_position': 7})
+
+    def test_got_last_page(self):
+        cursor = [(3, '大', 'da', '["big"]')]
+
+        cb_id = self.listdata.add_callback(self.callback, 2)
+        self.listdata._on_get_list_words_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with({'words': [['大', 'da', ['big']]],
+                                               'next_position': None})
+
+
+class GetListsByIdTest(WordListDataTest):
+    modified_at = datetime.datetime(2014, 8, 1, 12, 30)
+
+    def test_get_lists_by_id_sql(self):
+        self.listdata.get_lists_by_id((3, 1), self.callback, account_id=7)
+
+        self.db.execute.assert_called_once()
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('= ANY(%s)', sql)
+        self.assertNotIn('list_word', sql)
+        self.assertEqual([[3, 1], 7], params)
+
+    def test_get_words_sql(self):
+        self.listdata.get_lists_by_id([3, 1], self.callback, words=True, after_position=9, limit=50)
+
+        self.db.execute.assert_called_once()
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('LATERAL', sql)
+        self.assertEqual([9, 50, 9, 50, [3, 1], None], params)
+
+    def test_got_lists(self):
+        cursor = [(1, 'One', 'one', True, 7, self.modified_at, 2),
+                  (3, 'Three', 'three', False, 7, self.modified_at, 0)]
+
+        cb_id = self.listdata.add_callback(self.callback, None)
+        self.listdata._on_get_lists_by_id_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with(
+            [{'id': 1, 'title': 'One', 'stub': 'one', 'public': True, 'account_id': 7,
+              'modified_at': self.modified_at, 'word_count': 2},
+             {'id': 3, 'title': 'Three', 'stub': 'three', 'public': False, 'account_id': 7,
+              'modified_at': self.modified_at, 'word_count': 0}])
+
+    def test_got_words(self):
+        one = (1, 'One', 'one', True, 7, self.modified_at, 3)
+        cursor = [one + (0, '大', 'da', '["big"]'),
+                  one + (4, '小', 'xiao', '[]'),
+                  (2, 'Two', 'two', True, 7, self.modified_at, 1, 0, '中', 'zhong', '[]'),
+                  (3, 'Three', 'three', True, 7, self.modified_at, 0, None, None, None, None)]
+
+        cb_id = self.listdata.add_callback(self.callback, 2)
+        self.listdata._on_get_lists_by_id_response(cb_id, cursor)
+
+        word_lists, = self.callback.call_args[0]
+        self.assertEqual([[['大', 'da', ['big']], ['小', 'xiao', []]], [['中', 'zhong', []]], []],
+                         [word_list['words'] for word_list in word_lists])
+        self.assertEqual([4, None, None], [word_list['next_position'] for word_list in word_lists])
+
+    def test_error(self):
+        cb_id = self.listdata.add_callback(self.callback, None)
+        self.listdata._on_get_lists_by_id_response(cb_id, None, 'Error')
+
+        self.callback.assert_called_once_with(None)
+
+
+class BackfillListWordsTest(WordListDataTest):
+    def test_backfill_sql(self):
+        self.listdata.backfill_list_words(100, self.callback)
+        self.db.execute.assert_called_once()
+        self.assertIn('SKIP LOCKED', self.db.execute.call_args[0][0])
+        self.assertEqual((100,), self.db.execute.call_args[0][1])
+
+    def test_backfilled(self):
+        cb_id = self.listdata.add_callback(self.callback, 100)
+        self.listdata._on_backfill_list_words_response(cb_id, [(4,), (9,)])
+
+        self.callback.assert_called_once_with([4, 9])
+
+    def test_backfill_error(self):
+        cb_id = self.listdata.add_callback(self.callback, 100)
+        self.listdata._on_backfill_list_words_response(cb_id, None, 'Error')
+
+        self.callback.assert_called_once_with(None)
+
+
+class WordColumnsTest(unittest.TestCase):
+    def test_word_columns(self):
+        columns = wordlist.word_columns([['大', 'da', ['big', 'large']], ['小', 'xiao']])
+
+        self.assertEqual([[0, 1], ['大', '小'], ['da', 'xiao'], ['["big", "large"]', '[]']],
+                         columns)
 
 
 class CreateListTest(WordListDataTest):
@@ -88,42 +374,70 @@ class CreateListTest(WordListDataTest):
         self.db.execute.assert_called_once()
         self.assertIn('INSERT', str(self.db.execute.call_args))
         self.assertIn('test-list', str(self.db.execute.call_args))
-        self.assertEqual(self.listdata.callbacks['0|None'], self.callback)
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, None))
 
     def test_create_word_list_sql(self):
         self.listdata.create_list('Word List', [['大', 'da', ['big']], ], self.callback)
         self.db.execute.assert_called_once()
         self.assertIn('INSERT', str(self.db.execute.call_args))
-        self.assertEqual(self.listdata.callbacks['0|None'], self.callback)
+        self.assertIn('list_word', str(self.db.execute.call_args))
+        self.assertIn(['大'], self.db.execute.call_args[0][1])
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, None))
 
     def test_update_existing_list(self):
         self.listdata.create_list('Test List', [], self.callback, 1)
         self.db.execute.assert_called_once()
         self.assertIn('UPDATE', str(self.db.execute.call_args))
         self.assertIn('test-list', str(self.db.execute.call_args))
-        self.assertEqual(self.listdata.callbacks['0|1'], self.callback)
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, 1))
 
     def test_created_list(self):
         cursor = mock.Mock()
 
-        self.listdata.callbacks['0|42'] = self.callback
-        self.listdata._on_create_list_response('0|42', cursor)
+        cb_id = self.listdata.add_callback(self.callback, 42)
+        self.listdata._on_create_list_response(cb_id, cursor)
 
         self.callback.assert_called_once_with(True, list_id=42)
 
 
 class ListExistsTest(WordListDataTest):
+    def test_upsert_list_sql(self):
+        self.listdata.upsert_list('Word List', [['大', 'da', ['big']], ], 2, self.callback)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('ON CONFLICT (account_id, title) DO UPDATE', sql)
+        self.assertEqual([2, 'Word List', 'Word List', 'word-list', 1, 2], params[:6])
+        self.assertEqual([[0], ['大'], ['da'], ['["big"]']], params[7:])
+
+    def test_upserted_list(self):
+        self.listdata.list_cache.put(3, {'id': 3})
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 1
+        cursor.fetchone.return_value = (3, False)
+
+        cb_id = self.listdata.add_callback(self.callback, 'Word List')
+        self.listdata._on_upsert_list_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with(3, False)
+        self.assertNotIn(3, self.listdata.list_cache)
+
+    def test_upsert_list_error(self):
+        cb_id = self.listdata.add_callback(self.callback, 'Word List')
+        self.listdata._on_upsert_list_response(cb_id, None, error='no account')
+
+        self.callback.assert_called_once_with(None, None)
+
     def test_list_exists(self):
         self.listdata.list_exists('list name', self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.listdata.callbacks['0|list name'], self.callback)
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, 'list name'))
 
     def test_on_list_exists(self):
         cursor = mock.MagicMock(side_effect=[])
         cursor.fetchone.return_value = tuple([1])
 
-        self.listdata.callbacks['0|testlist'] = self.callback
-        self.listdata._on_list_exists('0|testlist', cursor)
+        cb_id = self.listdata.add_callback(self.callback, 'testlist')
+        self.listdata._on_list_exists(cb_id, cursor)
 
         self.callback.assert_called_once_with(True)
 
@@ -131,12 +445,147 @@ class ListExistsTest(WordListDataTest):
         cursor = mock.MagicMock(side_effect=[])
         cursor.fetchone.return_value = tuple([0])
 
-        self.listdata.callbacks['0|testlist'] = self.callback
-        self.listdata._on_list_exists('0|testlist', cursor)
+        cb_id = self.listdata.add_callback(self.callback, 'testlist')
+        self.listdata._on_list_exists(cb_id, cursor)
 
         self.callback.assert_called_once_with(False)
 
     def test_list_exists_for_account(self):
         self.listdata.list_exists_for_account('list name', 1, self.callback)
         self.db.execute.assert_called_once()
-        self.assertEqual(self.listdata.callbacks['0|list name,1'], self.callback)
+        self.assertEqual(self.listdata.callbacks.get(0), (self.callback, ('list name', 1)))
+
+
+class PatchListTest(WordListDataTest):
+    def test_patch_list_sql(self):
+        self.listdata.patch_list(12, 1, [('append', [['大', 'da', ['big']]]),
+                                         ('remove', 3),
+                                         ('replace', 0, ['小', 'xiao', ['small']])],
+                                 self.callback)
+
+        self.db.execute.assert_called_once()
+        sql, params = self.db.execute.call_args[0]
+        statements = sql.split(';\n')
+        self.assertEqual(6, len(statements))
+        self.assertIn('FOR UPDATE', statements[0])
+        self.assertIn('INSERT INTO list_word', statements[2])
+        self.assertIn('DELETE FROM list_word', statements[3])
+        self.assertIn('UPDATE list_word', statements[4])
+        self.assertIn('RETURNING word_count', statements[5])
+        self.assertEqual(sql.count('%s'), len(params))
+        self.assertIn('["small"]', params)
+        self.assertIn('require_list_word', statements[3])
+        self.assertIn('require_list_word', statements[4])
+
+    def test_unknown_operation(self):
+        self.assertRaises(ValueError, self.listdata.patch_list, 12, 1, [('shuffle',)], self.callback)
+
+    def test_patched_list(self):
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 1
+        cursor.fetchone.return_value = (5,)
+
+        cb_id = self.listdata.add_callback(self.callback, 12)
+        self.listdata._on_patch_list_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with(5)
+
+    def test_patch_missing_list(self):
+        cursor = mock.MagicMock(side_effect=[])
+        cursor.rowcount = 0
+
+        cb_id = self.listdata.add_callback(self.callback, 12)
+        self.listdata._on_patch_list_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with(None)
+
+    def test_patch_missing_word(self):
+        error = mock.Mock(pgcode=wordlist.MISSING_WORD_SQLSTATE)
+        error.__str__ = mock.Mock(return_value='Operation 1: no word at position 9\nCONTEXT: ...')
+
+        cb_id = self.listdata.add_callback(self.callback, 12)
+        self.listdata._on_patch_list_response(cb_id, None, error)
+
+        self.callback.assert_called_once_with(None, 'Operation 1: no word at position 9')
+
+
+class SkritterPushTest(WordListDataTest):
+    def push_row(self, status='queued'):
+        modified_at = datetime.datetime(2014, 9, 1)
+        return (5, 7, 12, status, None, -1, 0, None, modified_at, modified_at, 'List', 30)
+
+    def test_queue_push_sql(self):
+        self.listdata.queue_skritter_push(12, 7, self.callback)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('ON CONFLICT', sql)
+        self.assertEqual(sql.count('%s'), len(params))
+        self.assertEqual((7, 12, 7), (params[0], params[3], params[4]))
+
+    def test_queued_push(self):
+        cursor = mock.MagicMock()
+        cursor.rowcount = 1
+        cursor.fetchone.return_value = self.push_row()
+
+        cb_id = self.listdata.add_callback(self.callback, 12)
+        self.listdata._on_skritter_push_response(cb_id, cursor)
+
+        push, = self.callback.call_args[0]
+        self.assertEqual({'id': 5, 'account_id': 7, 'list_id': 12, 'status': 'queued',
+                          'position': -1, 'pushed': 0, 'title': 'List', 'word_count': 30},
+                         dict((key, push[key]) for key in ['id', 'account_id', 'list_id',
+                                                           'status', 'position', 'pushed',
+                                                           'title', 'word_count']))
+
+    def test_no_push(self):
+        cursor = mock.MagicMock()
+        cursor.rowcount = 0
+
+        cb_id = self.listdata.add_callback(self.callback, 12)
+        self.listdata._on_skritter_push_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with(None)
+
+    def test_claim_push_sql(self):
+        stale_before = datetime.datetime(2014, 9, 1)
+        self.listdata.claim_skritter_push(stale_before, self.callback)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertIn('SKIP LOCKED', sql)
+        self.assertEqual(stale_before, params[1])
+
+    def test_save_batch_sql(self):
+        self.listdata.save_skritter_push_batch(5, 'sk', 9, 10, [(8, '大', 'added'),
+                                                                (9, '小', 'not_found')],
+                                               self.callback)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertEqual(sql.count('%s'), len(params))
+        self.assertEqual([[8, 9], ['大', '小'], ['added', 'not_found'], 5, 'sk', 9, 10],
+                         params[:7])
+
+    def test_save_empty_batch_sql(self):
+        self.listdata.save_skritter_push_batch(5, 'sk', -1, 0, [], self.callback)
+
+        sql, params = self.db.execute.call_args[0]
+        self.assertEqual([[], [], []], params[:3])
+
+    def test_push_not_saved(self):
+        cursor = mock.MagicMock()
+        cursor.rowcount = 0
+
+        cb_id = self.listdata.add_callback(self.callback, 5)
+        self.listdata._on_skritter_push_saved(cb_id, cursor)
+
+        self.callback.assert_called_once_with(False)
+
+    def test_got_push_words(self):
+        cursor = [(0, '大', 'added'), (1, '小', 'not_found')]
+
+        cb_id = self.listdata.add_callback(self.callback, 2)
+        self.listdata._on_get_skritter_push_words_response(cb_id, cursor)
+
+        self.callback.assert_called_once_with(
+            {'words': [{'word': 0, 'zi': '大', 'result': 'added'},
+                       {'word': 1, 'zi': '小', 'result': 'not_found'}],
+             'next_word': 1})
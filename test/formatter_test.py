@@ -27,6 +27,10 @@ class TestCSVWordFormatter(unittest.TestCase):
         word = ['大', 'da']
         self.assertEqual('"大","da",""', formatter.format_word_as_csv(word))
 
+    def test_quotes_doubled(self):
+        word = ['大', 'da', ['"big"', 'large, huge']]
+        self.assertEqual('"大","da","""big""; large, huge"', formatter.format_word_as_csv(word))
+
 
 class TestTabWordFormmater(unittest.TestCase):
     def test_basic_formatting(self):
@@ -36,3 +40,40 @@ class TestTabWordFormmater(unittest.TestCase):
     def test_word_without_description(self):
         word = ['大', 'da']
         self.assertEqual('大\t\tda', formatter.format_word_as_tsv(word))
+
+    def test_tabs_replaced(self):
+        word = ['大', 'da', ['big\tlarge', 'line\nbreak']]
+        self.assertEqual('大\tbig large; line break\tda', formatter.format_word_as_tsv(word))
+
+
+class TestFormatWords(unittest.TestCase):
+    def setUp(self):
+        self.words = [['大', 'da', ['big', 'say "hi"']],
+                      ['小', 'xiao', ['a\tb']],
+                      ['中', 'zhong']]
+
+    def format(self, dialect, **kwargs):
+        return b''.join(formatter.format_words(self.words, dialect, **kwargs)).decode('utf-8')
+
+    def test_same_as_per_word(self):
+        self.assertEqual(''.join(formatter.format_word_as_csv(word) + '\n' for word in self.words),
+                         self.format(formatter.CSVDialect))
+        self.assertEqual(''.join(formatter.format_word_as_tsv(word) + '\n' for word in self.words),
+                         self.format(formatter.TSVDialect))
+
+    def test_chunks(self):
+        chunks = list(formatter.format_words(self.words, chunk_words=2))
+
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(b'"\xe4\xb8\xad","zhong",""\n', chunks[1])
+
+    def test_no_words(self):
+        self.assertEqual([], list(formatter.format_words([])))
+
+    def test_pleco(self):
+        self.assertEqual('大\tda\tbig; say "hi"\n小\txiao\ta b\n中\tzhong\t\n',
+                         self.format(formatter.PlecoDialect))
+
+    def test_anki(self):
+        self.assertEqual('大\tda\t"big; say ""hi"""\n小\txiao\t"a\tb"\n中\tzhong\t\n',
+                         self.format(formatter.DIALECTS['anki']))
@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import datetime
 import json
+import mock
+import tornado.httpserver
+import tornado.web
+import unittest
 import urllib.error
 import urllib.parse
 import urllib.request
 
+from cihui import cache
+from cihui import outbound
+from cihui import skritter
 from cihui import support
+from cihui import upload
 from cihui.handler import api
+from tornado.httputil import HTTPHeaders
 from tornado.testing import AsyncHTTPTestCase
 
 
@@ -64,6 +74,35 @@ class AuthTest(APITestBase):
         self.assertNotIn(b'Hello', response.body)
 
 
+class StatsTest(APITestBase):
+    def get_handlers(self):
+        class Data:
+            def authenticate_api_user(self, user, passwd):
+                return True
+
+            def stats(self):
+                return {'callbacks': {'outstanding': 0}}
+
+        self.data_layer = Data()
+        return [(r'/api/stats', api.APIStatsHandler,
+                 dict(account_db=self.data_layer, list_db=self.data_layer,
+                      page_cache=cache.LRUCache(100),
+                      token_manager=skritter.TokenManager(self.data_layer, 'id', 'secret'),
+                      skritter_http=outbound.Client('skritter')))]
+
+    def test_stats(self):
+        self.http_client.fetch(self.get_url('/api/stats'), self.stop,
+                               auth_username='user', auth_password='secret')
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        result = json.loads(response.body.decode('utf-8'))
+        self.assertEqual({'outstanding': 0}, result['list_db']['callbacks'])
+        self.assertEqual(0, result['page_cache']['entries'])
+        self.assertEqual(0, result['skritter_tokens']['refreshes'])
+        self.assertEqual('closed', result['skritter_http']['breaker'])
+
+
 class AccountTest(APITestBase):
     def get_handlers(self):
         class Data:
@@ -72,6 +111,22 @@ class AccountTest(APITestBase):
                           'skritter_user': 'skuser',
                           'skritter_access_token': '98765'})
 
+            def get_accounts(self, callback, emails, account_ids):
+                self.lookups = (emails, account_ids)
+                if 'error@example.com' in emails:
+                    callback(None)
+                    return
+
+                accounts = [{'account_email': 'one@example.com', 'account_id': 1,
+                             'skritter_user': 'skuser', 'skritter_access_token': '98765',
+                             'skritter_token_expiry': datetime.datetime(2014, 9, 1)},
+                            {'account_email': 'two@example.com', 'account_id': 2},
+                            {'account_email': 'Two@example.com', 'account_id': 3},
+                            {'account_email': 'One@example.com', 'account_id': 4}]
+                callback([account for account in accounts
+                          if account['account_email'].lower() in [email.lower() for email in emails] or
+                          account['account_id'] in account_ids])
+
             def authenticate_api_user(self, user, passwd):
                 return True
 
@@ -98,6 +153,112 @@ class AccountTest(APITestBase):
         self.assertEqual(result['skritter_user'], 'skuser')
         self.assertEqual(result['skritter_access_token'], '98765')
 
+    def fetch_json(self, path, **kwargs):
+        self.http_client.fetch(self.get_url(path), self.stop,
+                               auth_username='user', auth_password='secret', **kwargs)
+        response = self.wait()
+        return response.code, json.loads(response.body.decode('utf-8'))
+
+    def test_find_accounts(self):
+        code, result = self.fetch_json('/api/account?emails=ONE@example.com,nobody@example.com'
+                                       '&account_ids=2,5')
+
+        self.assertEqual(200, code)
+        self.assertEqual(['ONE@example.com', 'nobody@example.com'],
+                         self.account_data_layer.lookups[0])
+        self.assertEqual(1, result['emails']['ONE@example.com']['account_id'])
+        self.assertTrue(result['emails']['ONE@example.com']['found'])
+        self.assertEqual('2014-09-01T00:00:00',
+                         result['emails']['ONE@example.com']['skritter_token_expiry'])
+        self.assertEqual({'found': False}, result['emails']['nobody@example.com'])
+        self.assertEqual('two@example.com', result['account_ids']['2']['account_email'])
+        self.assertEqual({'found': False}, result['account_ids']['5'])
+
+    def test_find_accounts_differing_in_case(self):
+        code, result = self.fetch_json('/api/account?emails=Two@example.com,TWO@example.com,'
+                                       'One@example.com')
+
+        self.assertEqual(3, result['emails']['Two@example.com']['account_id'])
+        self.assertEqual(2, result['emails']['TWO@example.com']['account_id'])
+        self.assertEqual(4, result['emails']['One@example.com']['account_id'])
+
+    def test_find_accounts_post(self):
+        body = json.dumps({'emails': ['one@example.com', 'one@example.com'], 'account_ids': [2]})
+        code, result = self.fetch_json('/api/account', method='POST', body=body)
+
+        self.assertEqual(200, code)
+        self.assertEqual((['one@example.com'], [2]), self.account_data_layer.lookups)
+        self.assertEqual(['one@example.com'], list(result['emails']))
+        self.assertEqual(['2'], list(result['account_ids']))
+
+    def test_find_accounts_invalid(self):
+        for path, kwargs, error in [
+                ('/api/account?account_ids=one', {}, 'account_ids must be integers'),
+                ('/api/account?emails=', {}, 'No emails or account_ids'),
+                ('/api/account', {'method': 'POST', 'body': '{"emails": "one@example.com"}'},
+                 'emails must be a list'),
+                ('/api/account', {'method': 'POST', 'body': '{"account_ids": ["1"]}'},
+                 'account_ids must be a list'),
+                ('/api/account', {'method': 'POST',
+                                  'body': json.dumps({'account_ids': list(range(1001))})},
+                 'At most 1000')]:
+            code, result = self.fetch_json(path, **kwargs)
+
+            self.assertEqual(400, code)
+            self.assertIn(error, result['error'])
+
+    def test_find_accounts_failed(self):
+        code, result = self.fetch_json('/api/account?emails=error@example.com')
+
+        self.assertEqual(500, code)
+
+
+class AccountSkritterTest(APITestBase):
+    def get_handlers(self):
+        class Data:
+            def get_account(self, email, callback):
+                callback({'account_id': 1} if email == 'user@example.com' else None)
+
+            def authenticate_api_user(self, user, passwd):
+                return True
+
+        class Tokens:
+            def get_token(self, account, callback):
+                self.account = account
+                callback(self.token)
+
+        self.token_manager = Tokens()
+        return [(r'/api/account/skritter$', api.APIAccountSkritterHandler,
+                 dict(account_db=Data(), client_id='id', client_secret='secret',
+                      redirect_uri=None, token_manager=self.token_manager))]
+
+    def post(self, email):
+        self.http_client.fetch(self.get_url('/api/account/skritter'), self.stop, method='POST',
+                               body=urllib.parse.urlencode({'email': email}),
+                               auth_username='user', auth_password='secret')
+        return self.wait()
+
+    def test_token(self):
+        self.token_manager.token = {'access_token': 'abc',
+                                    'expiry': datetime.datetime(2014, 9, 1)}
+        response = self.post('user@example.com')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual({'skritter_access_token': 'abc',
+                          'skritter_token_expiry': '2014-09-01T00:00:00'},
+                         json.loads(response.body.decode('utf-8')))
+        self.assertEqual({'account_id': 1}, self.token_manager.account)
+
+    def test_refresh_failed(self):
+        self.token_manager.token = None
+        self.assertEqual(502, self.post('user@example.com').code)
+
+    def test_unknown_account(self):
+        response = self.post('nobody@example.com')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual(b'{}', response.body)
+
 
 class ListTest(APITestBase):
     def get_handlers(self):
@@ -106,17 +267,13 @@ class ListTest(APITestBase):
                 return True
 
         class ListData:
-            def create_list(self, list_name, words, callback, exists=False, account_id=None, email_address=None):
+            def upsert_list(self, list_name, words, account_id, callback):
                 self.words = words
                 self.account_id = account_id
-                self.email_address = email_address
-                callback(True)
-
-            def list_exists(self, list_name, callback):
-                callback(True)
-
-            def list_exists_for_account(self, list_name, account_id, callback):
-                callback(True)
+                if account_id == 404:
+                    callback(None, None)
+                else:
+                    callback(12, list_name != 'Existing List')
 
         self.account_data_layer = AccountData()
         self.list_data_layer = ListData()
@@ -138,6 +295,8 @@ class ListTest(APITestBase):
         response = self.wait()
 
         self.assertEqual(201, response.code)
+        self.assertEqual({'list_id': 12, 'list_path': '/list/12.html', 'created': True},
+                         json.loads(response.body.decode('utf-8')))
         self.assertIn('很', self.list_data_layer.words[0])
         self.assertEqual('hén', self.list_data_layer.words[0][1])
         self.assertEqual(self.list_data_layer.account_id, 1)
@@ -155,8 +314,32 @@ class ListTest(APITestBase):
         self.assertEqual(500, response.code)
 
     def test_update_existing_list(self):
-        # TODO(gmwils): fill in the test
-        pass
+        data = self.json_encode_data({'title': 'Existing List',
+                                      'words': [['很', 'hěn', ['very']], ],
+                                      'account_id': 1,
+                                      })
+
+        self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST',
+                               headers=None, body=data,
+                               auth_username='user', auth_password='secret')
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertFalse(json.loads(response.body.decode('utf-8'))['created'])
+
+    def test_fail_on_save_error(self):
+        data = self.json_encode_data({'title': 'Test List',
+                                      'words': [['很', 'hěn', ['very']], ],
+                                      'account_id': 404,
+                                      })
+
+        self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST',
+                               headers=None, body=data,
+                               auth_username='user', auth_password='secret')
+        response = self.wait()
+
+        self.assertEqual(500, response.code)
+        self.assertIn(b'Failed to create list', response.body)
 
     def test_fail_on_create_empty_list(self):
         data = self.json_encode_data({'title': 'Test List', 'words': ''})
@@ -177,6 +360,41 @@ class ListTest(APITestBase):
 
         self.assertEqual(500, response.code)
 
+    def test_invalid_words(self):
+        data = self.json_encode_data({'title': 'Test List',
+                                      'words': [['很', 'hěn', 'very'], ['大'], ['小', 5, []]],
+                                      'account_id': 1})
+        self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST',
+                               headers=None, body=data,
+                               auth_username='user', auth_password='secret')
+        response = self.wait()
+
+        self.assertEqual(400, response.code)
+        errors = json.loads(response.body.decode('utf-8'))['errors']
+        self.assertEqual([(1, 'word'), (2, 'pinyin')],
+                         [(error['word'], error['field']) for error in errors])
+
+    def test_invalid_json_body(self):
+        for body in ['{"title": ', '["Test List"]']:
+            self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST',
+                                   headers=None, body=body,
+                                   auth_username='user', auth_password='secret')
+            response = self.wait()
+
+            self.assertEqual(400, response.code)
+            self.assertIn(b'Invalid JSON body', response.body)
+
+    def test_words_not_a_list(self):
+        for words in [5, {'很': 'hěn'}]:
+            data = self.json_encode_data({'title': 'Test List', 'words': words, 'account_id': 1})
+            self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST',
+                                   headers=None, body=data,
+                                   auth_username='user', auth_password='secret')
+            response = self.wait()
+
+            self.assertEqual(400, response.code)
+            self.assertIn(b'must be a list', response.body)
+
     def test_fail_on_missing_title(self):
         data = self.json_encode_data({})
         self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST',
@@ -186,3 +404,356 @@ class ListTest(APITestBase):
 
         self.assertEqual(500, response.code)
         self.assertIn(b'Missing title', response.body)
+
+
+class ListPrepareTest(unittest.TestCase):
+    def test_invalid_content_length(self):
+        # HTTPServer refuses these itself, but not every server in front does
+        request = tornado.httpserver.HTTPRequest('POST', '/api/list',
+                                                 connection=mock.Mock(xheaders=False),
+                                                 headers=HTTPHeaders({'Content-Length': 'ten'}))
+        handler = api.APIListHandler(tornado.web.Application(), request,
+                                     account_db=None, list_db=None)
+        with mock.patch.object(handler, 'failed_upload') as failed_upload:
+            handler.prepare()
+
+        error, = failed_upload.call_args[0]
+        self.assertEqual(400, error.status)
+
+
+class ListUploadTest(ListTest):
+    def post(self, body, content_type='application/json', title='Upload', account_id='1'):
+        query = urllib.parse.urlencode({'title': title, 'account_id': account_id})
+        self.http_client.fetch(self.get_url('/api/list?' + query), self.stop, method='POST',
+                               headers={'Content-Type': content_type}, body=body,
+                               auth_username='user', auth_password='secret')
+        return self.wait()
+
+    def test_json_array(self):
+        response = self.post(json.dumps([['很', 'he\u0301n', ['very']], ['大', 'dà', []]]))
+
+        self.assertEqual(201, response.code)
+        self.assertEqual([['很', 'hén', ['very']], ['大', 'dà', []]], self.list_data_layer.words)
+        self.assertEqual(1, self.list_data_layer.account_id)
+
+    def test_ndjson(self):
+        body = '["很", "hěn", ["very"]]\n\n["大", "dà", ["big"]]\n'
+        response = self.post(body, content_type='application/x-ndjson')
+
+        self.assertEqual(201, response.code)
+        self.assertEqual(['大', 'dà', ['big']], self.list_data_layer.words[1])
+
+    def test_large_upload_in_slices(self):
+        words = [['字%d' % n, 'zì', ['character %d' % n]] for n in range(5000)]
+        body = json.dumps(words, ensure_ascii=False).encode('utf-8')
+        self.assertGreater(len(body), 2 * api.UPLOAD_CHUNK_BYTES)
+
+        self.assertEqual(201, self.post(body).code)
+        self.assertEqual(words, self.list_data_layer.words)
+
+    def test_malformed_word(self):
+        response = self.post(json.dumps([['很', 'hěn', ['very']], ['大', 'dà', [1]]]))
+
+        self.assertEqual(400, response.code)
+        result = json.loads(response.body.decode('utf-8'))
+        self.assertIn('Word 1', result['error'])
+        self.assertEqual([{'word': 1, 'field': 'definitions', 'error': 'must be a list of strings'}],
+                         result['errors'])
+        self.assertFalse(hasattr(self.list_data_layer, 'words'))
+
+    def test_malformed_line(self):
+        response = self.post('["很", "hěn", ["very"]]\n["大", "dà"\n',
+                             content_type='application/x-ndjson')
+
+        self.assertEqual(400, response.code)
+        self.assertIn(b'Line 2', response.body)
+
+    def test_too_large(self):
+        with mock.patch.object(upload, 'MAX_UPLOAD_BYTES', 10):
+            response = self.post(json.dumps([['很', 'hěn', ['very']]]))
+
+        self.assertEqual(413, response.code)
+        self.assertFalse(hasattr(self.list_data_layer, 'words'))
+
+    def test_too_large_json_body(self):
+        body = self.json_encode_data({'title': 'Upload', 'words': [['很', 'hěn', ['very']]],
+                                      'account_id': 1})
+        with mock.patch.object(upload, 'MAX_UPLOAD_BYTES', 10):
+            self.http_client.fetch(self.get_url('/api/list'), self.stop, method='POST', body=body,
+                                   auth_username='user', auth_password='secret')
+            response = self.wait()
+
+        self.assertEqual(413, response.code)
+        self.assertIn(b'larger than 10 bytes', response.body)
+
+    def test_account_required(self):
+        response = self.post('[]', account_id='me')
+        self.assertEqual(400, response.code)
+
+    def test_no_words(self):
+        response = self.post('[]')
+
+        self.assertEqual(400, response.code)
+        self.assertIn(b'No word list', response.body)
+
+
+class ListGetTest(APITestBase):
+    def get_handlers(self):
+        class AccountData:
+            def authenticate_api_user(self, user, passwd):
+                return True
+
+        class ListData:
+            def get_lists_by_id(self, list_ids, callback, **kwargs):
+                self.list_ids = list_ids
+                self.kwargs = kwargs
+                if list_ids == [500]:
+                    callback(None)
+                    return
+
+                word_lists = [{'id': list_id, 'title': 'List %d' % list_id, 'stub': None,
+                               'public': True, 'account_id': 1, 'word_count': 1,
+                               'modified_at': datetime.datetime(2014, 8, 1, 12, 30)}
+                              for list_id in list_ids if list_id < 10]
+                if kwargs['words']:
+                    for word_list in word_lists:
+                        word_list.update(words=[['大', 'dà', ['big']]], next_position=None)
+                callback(word_lists)
+
+        self.list_data_layer = ListData()
+
+        return [(r'/api/list',
+                 api.APIListHandler,
+                 dict(account_db=AccountData(),
+                      list_db=self.list_data_layer))]
+
+    def get(self, query):
+        self.http_client.fetch(self.get_url('/api/list?' + query), self.stop,
+                               auth_username='user', auth_password='secret')
+        return self.wait()
+
+    def test_get_lists(self):
+        response = self.get('ids=2,1,12,2&account_id=1')
+
+        self.assertEqual(200, response.code)
+        result = json.loads(response.body.decode('utf-8'))
+        self.assertEqual([2, 1], [word_list['id'] for word_list in result['lists']])
+        self.assertEqual([12], result['missing'])
+        self.assertEqual([['大', 'dà', ['big']]], result['lists'][0]['words'])
+        self.assertEqual('2014-08-01T12:30:00', result['lists'][0]['modified_at'])
+        self.assertEqual('/list/2.html', result['lists'][0]['list_path'])
+
+        self.assertEqual([2, 1, 12], self.list_data_layer.list_ids)
+        self.assertEqual({'account_id': 1, 'words': True, 'after_position': -1, 'limit': 1000},
+                         self.list_data_layer.kwargs)
+
+    def test_get_metadata(self):
+        response = self.get('ids=1&fields=metadata')
+
+        self.assertEqual(200, response.code)
+        word_list, = json.loads(response.body.decode('utf-8'))['lists']
+        self.assertNotIn('words', word_list)
+        self.assertFalse(self.list_data_layer.kwargs['words'])
+
+    def test_get_words_page(self):
+        self.get('ids=1&after=99&limit=10')
+
+        self.assertEqual(99, self.list_data_layer.kwargs['after_position'])
+        self.assertEqual(10, self.list_data_layer.kwargs['limit'])
+
+    def test_invalid_arguments(self):
+        for query, error in [('', b'No list ids'),
+                             ('ids=1,x', b'ids must be integers'),
+                             ('ids=' + ','.join(map(str, range(101))), b'At most 100'),
+                             ('ids=1&fields=all', b'fields must be'),
+                             ('ids=1&limit=1001', b'limit must be'),
+                             ('ids=1&after=first', b'after must be an integer')]:
+            response = self.get(query)
+
+            self.assertEqual(400, response.code)
+            self.assertIn(error, response.body)
+
+    def test_get_failed(self):
+        self.assertEqual(500, self.get('ids=500').code)
+
+
+class ListSkritterTest(APITestBase):
+    def get_handlers(self):
+        class AccountData:
+            def authenticate_api_user(self, user, passwd):
+                return True
+
+        def make_push(push_id, list_id, account_id):
+            return {'id': push_id, 'account_id': account_id, 'list_id': list_id,
+                    'status': 'queued', 'skritter_list_id': None, 'position': -1, 'pushed': 0,
+                    'error': None, 'title': 'List', 'word_count': 2,
+                    'created_at': datetime.datetime(2014, 9, 6, 9, 30),
+                    'modified_at': datetime.datetime(2014, 9, 6, 9, 30)}
+
+        class ListData:
+            def queue_skritter_push(self, list_id, account_id, callback):
+                callback(make_push(7, list_id, account_id) if list_id < 10 else None)
+
+            def get_skritter_push(self, push_id, callback):
+                callback(make_push(push_id, 1, 1) if push_id < 10 else None)
+
+            def get_skritter_push_words(self, push_id, callback, after, limit):
+                self.page = (after, limit)
+                callback({'words': [{'word': 0, 'zi': '大', 'result': 'added'}],
+                          'next_word': None})
+
+        self.list_data_layer = ListData()
+
+        handler_args = dict(account_db=AccountData(), list_db=self.list_data_layer)
+        return [(r'/api/list/([0-9]+)/skritter$', api.APIListSkritterHandler, handler_args),
+                (r'/api/list/([0-9]+)/skritter/([0-9]+)$', api.APIListSkritterHandler,
+                 handler_args)]
+
+    def fetch_json(self, path, **kwargs):
+        self.http_client.fetch(self.get_url(path), self.stop,
+                               auth_username='user', auth_password='secret', **kwargs)
+        response = self.wait()
+        return response.code, json.loads(response.body.decode('utf-8') or 'null')
+
+    def test_queue_push(self):
+        code, push = self.fetch_json('/api/list/1/skritter', method='POST',
+                                     body=self.json_encode_data({'account_id': 2}))
+
+        self.assertEqual(202, code)
+        self.assertEqual((7, 2, 'queued'), (push['id'], push['account_id'], push['status']))
+        self.assertEqual('2014-09-06T09:30:00', push['created_at'])
+        self.assertEqual('/api/list/1/skritter/7', push['push_path'])
+
+    def test_queue_push_invalid(self):
+        for body in ['', '[]', '{"account_id": "2"}']:
+            code, result = self.fetch_json('/api/list/1/skritter', method='POST', body=body)
+
+            self.assertEqual(400, code)
+            self.assertIn('Error', result['error'])
+
+    def test_queue_push_missing_list(self):
+        code, _ = self.fetch_json('/api/list/99/skritter', method='POST',
+                                  body=self.json_encode_data({'account_id': 2}))
+        self.assertEqual(404, code)
+
+    def test_get_push(self):
+        code, push = self.fetch_json('/api/list/1/skritter/3?after=4&limit=10')
+
+        self.assertEqual(200, code)
+        self.assertEqual(3, push['id'])
+        self.assertEqual([{'word': 0, 'zi': '大', 'result': 'added'}], push['words'])
+        self.assertIsNone(push['next_word'])
+        self.assertEqual((4, 10), self.list_data_layer.page)
+
+    def test_get_push_of_other_list(self):
+        self.assertEqual(404, self.fetch_json('/api/list/2/skritter/3')[0])
+        self.assertEqual(404, self.fetch_json('/api/list/1/skritter/99')[0])
+
+    def test_get_push_invalid(self):
+        self.assertEqual(400, self.fetch_json('/api/list/1/skritter/3?limit=1001')[0])
+
+
+class ListOperationsTest(unittest.TestCase):
+    def test_parse_operations(self):
+        operations = [{'op': 'append', 'words': [['很', 'hén', ['very']]]},
+                      {'op': 'remove', 'position': 3},
+                      {'op': 'replace', 'position': 0, 'word': ['大', 'dà', ['big']]}]
+
+        self.assertEqual([('append', [['很', 'hén', ['very']]]),
+                          ('remove', 3),
+                          ('replace', 0, ['大', 'dà', ['big']])],
+                         api.parse_list_operations(operations))
+
+    def test_no_operations(self):
+        self.assertRaises(ValueError, api.parse_list_operations, [])
+        self.assertRaises(ValueError, api.parse_list_operations, None)
+
+    def test_invalid_operations(self):
+        invalid = [{'op': 'append', 'words': []},
+                   {'op': 'remove'},
+                   {'op': 'remove', 'position': -1},
+                   {'op': 'replace', 'position': 1},
+                   {'op': 'replace', 'position': 1, 'word': ['大']},
+                   {'op': 'shuffle'},
+                   'remove']
+
+        for operation in invalid:
+            self.assertRaises(ValueError, api.parse_list_operations, [operation])
+
+    def test_error_names_operation(self):
+        operations = [{'op': 'remove', 'position': 1}, {'op': 'remove', 'position': 'x'}]
+
+        with self.assertRaisesRegex(ValueError, 'Operation 1'):
+            api.parse_list_operations(operations)
+
+
+class ListUpdateTest(APITestBase):
+    def get_handlers(self):
+        class AccountData:
+            def authenticate_api_user(self, user, passwd):
+                return True
+
+        class ListData:
+            def patch_list(self, list_id, account_id, operations, callback):
+                self.operations = operations
+                if operations[0][1:] == (99,):
+                    callback(None, 'Operation 0: no word at position 99')
+                elif account_id == 1:
+                    callback(7)
+                else:
+                    callback(None)
+
+        self.list_data_layer = ListData()
+
+        return [(r'/api/list/([0-9]+)$',
+                 api.APIListUpdateHandler,
+                 dict(account_db=AccountData(),
+                      list_db=self.list_data_layer))]
+
+    def patch(self, data):
+        self.http_client.fetch(self.get_url('/api/list/12'), self.stop, method='PATCH',
+                               body=self.json_encode_data(data),
+                               auth_username='user', auth_password='secret')
+        return self.wait()
+
+    def test_patch_list(self):
+        response = self.patch({'account_id': 1,
+                               'operations': [{'op': 'remove', 'position': 0}]})
+
+        self.assertEqual(200, response.code)
+        self.assertEqual({'list_id': 12, 'word_count': 7},
+                         json.loads(response.body.decode('utf-8')))
+        self.assertEqual([('remove', 0)], self.list_data_layer.operations)
+
+    def test_patch_other_account(self):
+        response = self.patch({'account_id': 2,
+                               'operations': [{'op': 'remove', 'position': 0}]})
+
+        self.assertEqual(404, response.code)
+
+    def test_patch_requires_account(self):
+        response = self.patch({'operations': [{'op': 'remove', 'position': 0}]})
+
+        self.assertEqual(400, response.code)
+        self.assertIn(b'Account id required', response.body)
+
+    def test_patch_account_must_be_integer(self):
+        for account_id in ['1', 1.5]:
+            response = self.patch({'account_id': account_id,
+                                   'operations': [{'op': 'remove', 'position': 0}]})
+
+            self.assertEqual(400, response.code)
+            self.assertIn(b'Account id required', response.body)
+
+    def test_patch_missing_word(self):
+        response = self.patch({'account_id': 1,
+                               'operations': [{'op': 'remove', 'position': 99}]})
+
+        self.assertEqual(409, response.code)
+        self.assertIn(b'no word at position 99', response.body)
+
+    def test_patch_invalid_operation(self):
+        response = self.patch({'account_id': 1, 'operations': [{'op': 'shuffle'}]})
+
+        self.assertEqual(400, response.code)
+        self.assertIn(b'Operation 0', response.body)
@@ -4,6 +4,7 @@
 import tornado
 import urllib.parse
 
+from cihui.data import account
 from cihui.handler import auth
 from cihui import support
 
@@ -16,6 +17,8 @@ class LoginTest(support.UITestCase):
 
                 if password == 'bad':
                     cb()
+                elif password == 'busy':
+                    cb(error=account.PasswordQueueFullError())
                 else:
                     cb(account_id, next_url, 'test_username')
 
@@ -67,6 +70,19 @@ class LoginTest(support.UITestCase):
         self.assertEqual(302, response.code)
         self.assertEqual('/login?error=Error%3A+Incorrect+login', response.headers['Location'])
 
+    def test_password_queue_full(self):
+        params = {'user': 'john', 'password': 'busy', 'next': '/example'}
+        body = urllib.parse.urlencode(params)
+        self.http_client.fetch(self.get_url('/login'), self.stop,
+                               method='POST',
+                               headers=None,
+                               body=body,
+                               follow_redirects=False)
+        response = self.wait()
+
+        self.assertEqual(503, response.code)
+        self.assertNotIn('Set-Cookie', response.headers)
+
     def test_logout(self):
         self.http_client.fetch(self.get_url('/logout'), self.stop, follow_redirects=False)
         response = self.wait()
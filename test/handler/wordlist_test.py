@@ -1,17 +1,52 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2012 Geoff Wilson <gmwils@gmail.com>
 
+import datetime
+import gzip
 import mock
+import socket
+import tornado.iostream
+import unittest
 
+from xml.etree import ElementTree
+
+from cihui import cache
+from cihui.data import wordlist as data
 from cihui.handler import wordlist
 from cihui import support
 
 
+def build_lists(count, public=True):
+    modified_at = datetime.datetime(2014, 8, 1, 12, 30)
+    return [{'id': list_id, 'title': 'List %d' % list_id, 'stub': 'list-%d' % list_id,
+             'public': public, 'modified_at': modified_at}
+            for list_id in range(count, 0, -1)]
+
+
+class PagedListData:
+    def __init__(self, count):
+        self.count = count
+
+    def get_lists_version(self, callback):
+        callback({'modified_at': datetime.datetime(2014, 8, 1, 12, 30), 'count': self.count})
+
+    def get_lists(self, callback, before=None, limit=None):
+        self.before = before
+        callback(build_lists(self.count)[:limit])
+
+    def get_user_lists(self, user_id, callback, before=None, limit=None):
+        self.before = before
+        callback(build_lists(self.count, public=False)[:limit])
+
+
 class AtomFeedTest(support.HandlerTestCase):
     def setUp(self):
         class ListData:
-            def get_lists(self, callback):
+            def get_lists(self, callback, before=None, limit=None):
                 callback([{'title': 'Test Item'}])
+
+            def get_lists_version(self, callback):
+                callback(None)
         self.list_db = ListData()
         super(AtomFeedTest, self).setUp()
 
@@ -26,23 +61,148 @@ class AtomFeedTest(support.HandlerTestCase):
 
         self.assertEqual(200, response.code)
         self.assertIn(b'Test Item', response.body)
+        self.assertNotIn(b'rel="next"', response.body)
+
+
+class PagedAtomFeedTest(support.HandlerTestCase):
+    def setUp(self):
+        self.list_db = PagedListData(data.LIST_PAGE_SIZE + 5)
+        super(PagedAtomFeedTest, self).setUp()
+
+    def get_handlers(self):
+        return [(r'/atom.xml',
+                 wordlist.AtomHandler,
+                 dict(list_db=self.list_db))]
+
+    def test_next_page_link(self):
+        self.http_client.fetch(self.get_url('/atom.xml'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual(data.LIST_PAGE_SIZE, response.body.count(b'<entry>'))
+        self.assertIn(b'href="/atom.xml?before=2014-08-01T12:30:00.000000_6"', response.body)
+
+    def test_fetch_next_page(self):
+        self.http_client.fetch(self.get_url('/atom.xml?before=2014-08-01T12:30:00.000000_6'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual((datetime.datetime(2014, 8, 1, 12, 30), 6), self.list_db.before)
+
+    def test_invalid_cursor(self):
+        self.http_client.fetch(self.get_url('/atom.xml?before=yesterday'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(400, response.code)
+
+
+class CachedAtomFeedTest(support.HandlerTestCase):
+    def setUp(self):
+        self.list_db = PagedListData(5)
+        self.list_db.get_lists = mock.Mock(wraps=self.list_db.get_lists)
+        self.page_cache = cache.LRUCache(1024 * 1024, sizeof=len)
+        super(CachedAtomFeedTest, self).setUp()
+
+    def get_handlers(self):
+        return [(r'/atom.xml',
+                 wordlist.AtomHandler,
+                 dict(list_db=self.list_db, page_cache=self.page_cache, max_entries=3))]
+
+    def fetch(self, path):
+        self.http_client.fetch(self.get_url(path), self.stop)
+        return self.wait()
+
+    def test_entries(self):
+        response = self.fetch('/atom.xml')
+
+        self.assertIn('application/atom+xml', response.headers['Content-Type'])
+        root_elem = ElementTree.fromstring(response.body)
+        entries = root_elem.findall('{http://www.w3.org/2005/Atom}entry')
+        self.assertEqual(3, len(entries))
+        self.assertEqual(self.get_url('/list/5'),
+                         entries[0].find('{http://www.w3.org/2005/Atom}id').text)
+        self.assertEqual('2014-08-01T12:30:00Z',
+                         entries[0].find('{http://www.w3.org/2005/Atom}updated').text)
+        self.assertIn(b'href="/atom.xml?before=2014-08-01T12:30:00.000000_3"', response.body)
+
+    def test_entries_flushed(self):
+        with mock.patch.object(wordlist.AtomHandler, 'flush', autospec=True,
+                               side_effect=wordlist.AtomHandler.flush) as flush:
+            response = self.fetch('/atom.xml')
+
+        self.assertEqual('chunked', response.headers.get('Transfer-Encoding'))
+        # One per entry, and one from finish()
+        self.assertEqual(4, flush.call_count)
+
+    def test_cached_until_lists_change(self):
+        first = self.fetch('/atom.xml')
+        second = self.fetch('/atom.xml')
+
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(1, self.list_db.get_lists.call_count)
+
+        self.list_db.count = 4
+        self.fetch('/atom.xml')
+        self.assertEqual(2, self.list_db.get_lists.call_count)
+
+    def test_pages_cached_separately(self):
+        self.fetch('/atom.xml')
+        response = self.fetch('/atom.xml?before=2014-08-01T12:30:00.000000_3')
+
+        self.assertEqual(2, self.list_db.get_lists.call_count)
+        self.assertEqual(200, response.code)
+
+
+class PagedIndexTest(support.UITestCase):
+    def setUp(self):
+        self.list_db = PagedListData(data.LIST_PAGE_SIZE)
+        super(PagedIndexTest, self).setUp()
+
+    def get_handlers(self):
+        return [(r'/', wordlist.IndexHandler, dict(list_db=self.list_db)),
+                (r'/home', wordlist.HomeHandler, dict(list_db=self.list_db))]
+
+    def test_index_next_page_link(self):
+        self.http_client.fetch(self.get_url('/'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertIn(b"href='/?before=2014-08-01T12:30:00.000000_1'", response.body)
+
+    def test_index_last_page(self):
+        self.list_db.count = 3
+        self.http_client.fetch(self.get_url('/'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertIn(b'List 3', response.body)
+        self.assertNotIn(b'before=', response.body)
 
 
 class DisplayWordListTest(support.UITestCase):
     def setUp(self):
         class ListData:
-            def get_word_list(self, list_id, callback):
-                if list_id not in [404]:
+            def get_word_list(self, list_id, callback, list_info=None):
+                # List 104 is deleted between reading its info and its words
+                if list_id != 404 and not (list_id == 104 and list_info is not None):
                     words = [['大', 'da', ['big']], ]
                     callback({'id': list_id,
                               'title': 'list_%d' % list_id,
                               'words': words,
-                              'modified_at': mock.Mock(),
+                              'modified_at': datetime.datetime(2014, 8, 1, 12, 30),
                               'public': True,
-                              'account_id': 1})
+                              'account_id': 1,
+                              'word_count': 1 if list_id not in [103, 104] else None})
                 else:
                     callback(None)
 
+            def get_list_info(self, list_id, callback):
+                self.get_word_list(list_id, callback)
+
+            def get_list_words(self, list_id, callback, after_position=-1, limit=None):
+                callback({'words': [['大', 'da', ['big']], ['小', 'xiao', ['small']]],
+                          'next_position': None})
+
         self.list_db = ListData()
 
         super(DisplayWordListTest, self).setUp()
@@ -79,6 +239,26 @@ class DisplayWordListTest(support.UITestCase):
         self.assertIn('text/csv', response.headers['Content-Type'])
         self.assertIn(b'big', response.body)
 
+    def test_csv_output_all_pages(self):
+        self.http_client.fetch(self.get_url('/list/102.csv'), self.stop)
+        response = self.wait()
+
+        self.assertEqual('"大","da","big"\n"小","xiao","small"\n',
+                         response.body.decode('utf-8'))
+
+    def test_csv_output_before_backfill(self):
+        self.http_client.fetch(self.get_url('/list/103.csv'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('"大","da","big"\n', response.body.decode('utf-8'))
+
+    def test_csv_output_list_deleted(self):
+        self.http_client.fetch(self.get_url('/list/104.csv'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(404, response.code)
+
     def test_tsv_output(self):
         self.http_client.fetch(self.get_url('/list/102.tsv'), self.stop)
         response = self.wait()
@@ -86,3 +266,325 @@ class DisplayWordListTest(support.UITestCase):
         self.assertEqual(200, response.code)
         self.assertIn('text/tsv', response.headers['Content-Type'])
         self.assertIn(b'big', response.body)
+
+    def test_pleco_output(self):
+        self.http_client.fetch(self.get_url('/list/102.pleco'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertIn('text/plain', response.headers['Content-Type'])
+        self.assertEqual('大\tda\tbig\n小\txiao\tsmall\n', response.body.decode('utf-8'))
+
+    def test_anki_output(self):
+        self.http_client.fetch(self.get_url('/list/102.anki'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('大\tda\tbig\n小\txiao\tsmall\n', response.body.decode('utf-8'))
+
+    def test_export_links(self):
+        self.http_client.fetch(self.get_url('/list/101'), self.stop)
+        response = self.wait()
+
+        self.assertIn(b"href='/list/101.pleco'", response.body)
+        self.assertIn(b"href='/list/101.anki'", response.body)
+
+
+class StreamedExportTest(support.HandlerTestCase):
+    def setUp(self):
+        class ListData:
+            pages = 0
+            page_count = 3
+            failed_page = None
+
+            def get_list_info(self, list_id, callback):
+                callback({'id': list_id, 'public': True, 'word_count': 3000,
+                          'modified_at': datetime.datetime(2014, 8, 1, 12, 30)})
+
+            def get_list_words(self, list_id, callback, after_position=-1, limit=None):
+                self.pages += 1
+                if self.pages == self.failed_page:
+                    io_loop.add_callback(callback, None)
+                    return
+                words = [['字%d' % i, 'zi', ['word']] for i in range(after_position + 1,
+                                                                    after_position + 1 + limit)]
+                next_position = after_position + limit
+                if self.pages >= self.page_count:
+                    next_position = None
+                io_loop.add_callback(callback, {'words': words, 'next_position': next_position})
+
+        self.list_db = ListData()
+        self.page_cache = cache.LRUCache(1024 * 1024, sizeof=len)
+        super(StreamedExportTest, self).setUp()
+        io_loop = self.io_loop
+
+    def get_handlers(self):
+        return [(r'/list/([0-9]+)[^\.]*(\.?\w*)',
+                 wordlist.WordListHandler,
+                 dict(list_db=self.list_db, page_cache=self.page_cache))]
+
+    def test_all_pages_streamed(self):
+        self.http_client.fetch(self.get_url('/list/1.csv'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('chunked', response.headers.get('Transfer-Encoding'))
+        lines = response.body.decode('utf-8').splitlines()
+        self.assertEqual(3 * wordlist.EXPORT_CHUNK_WORDS, len(lines))
+        self.assertEqual('"字2999","zi","word"', lines[-1])
+
+    def test_failed_first_page(self):
+        self.list_db.failed_page = 1
+        self.http_client.fetch(self.get_url('/list/1.csv'), self.stop)
+        response = self.wait()
+
+        self.assertEqual(500, response.code)
+        self.assertEqual(0, len(self.page_cache))
+
+    def test_failed_page_cuts_off_export(self):
+        self.list_db.failed_page = 2
+        self.http_client.fetch(self.get_url('/list/1.csv'), self.stop)
+        response = self.wait()
+
+        self.assertNotEqual(200, response.code)
+        self.assertEqual(0, len(self.page_cache))
+
+    def test_stops_when_client_disconnects(self):
+        self.list_db.page_count = 1000
+        stream = tornado.iostream.IOStream(socket.socket())
+        stream.connect(('127.0.0.1', self.get_http_port()), self.stop)
+        self.wait()
+
+        stream.write(b'GET /list/1.csv HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        stream.read_until(b'\r\n\r\n', self.stop)
+        self.wait()
+        stream.close()
+
+        self.io_loop.add_timeout(self.io_loop.time() + 0.2, self.stop)
+        self.wait()
+        self.assertLess(self.list_db.pages, 1000)
+
+
+class ConditionalExportTest(support.HandlerTestCase):
+    def setUp(self):
+        class ListData:
+            modified_at = datetime.datetime(2014, 8, 1, 12, 30, 15, 500)
+            public = True
+            pages = 0
+
+            def get_list_info(self, list_id, callback):
+                callback({'id': list_id, 'public': self.public, 'account_id': 1,
+                          'modified_at': self.modified_at, 'word_count': 1})
+
+            def get_list_words(self, list_id, callback, after_position=-1, limit=None):
+                self.pages += 1
+                callback({'words': [['大', 'da', ['big']]], 'next_position': None})
+
+        self.list_db = ListData()
+        super(ConditionalExportTest, self).setUp()
+
+    def get_handlers(self):
+        return [(r'/list/([0-9]+)[^\.]*(\.?\w*)',
+                 wordlist.WordListHandler,
+                 dict(list_db=self.list_db))]
+
+    def fetch(self, path, **headers):
+        self.http_client.fetch(self.get_url(path), self.stop, headers=headers)
+        return self.wait()
+
+    def test_validators(self):
+        response = self.fetch('/list/1.csv')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('Fri, 01 Aug 2014 12:30:15 GMT', response.headers['Last-Modified'])
+        self.assertNotEqual(response.headers['Etag'], self.fetch('/list/1.tsv').headers['Etag'])
+        self.assertNotEqual(response.headers['Etag'], self.fetch('/list/2.csv').headers['Etag'])
+
+    def test_etag_matches(self):
+        etag = self.fetch('/list/1.csv').headers['Etag']
+        response = self.fetch('/list/1.csv', **{'If-None-Match': 'W/"other", ' + etag})
+
+        self.assertEqual(304, response.code)
+        self.assertEqual(etag, response.headers['Etag'])
+        self.assertEqual(1, self.list_db.pages)
+
+    def test_etag_changes_with_list(self):
+        etag = self.fetch('/list/1.csv').headers['Etag']
+        self.list_db.modified_at += datetime.timedelta(microseconds=1)
+
+        self.assertEqual(200, self.fetch('/list/1.csv', **{'If-None-Match': etag}).code)
+
+    def test_etag_takes_precedence(self):
+        response = self.fetch('/list/1.csv', **{'If-None-Match': '"other"',
+                                                'If-Modified-Since': 'Fri, 01 Aug 2014 12:30:15 GMT'})
+        self.assertEqual(200, response.code)
+
+    def test_not_modified_since(self):
+        response = self.fetch('/list/1.csv', **{'If-Modified-Since': 'Fri, 01 Aug 2014 12:30:15 GMT'})
+        self.assertEqual(304, response.code)
+        self.assertEqual(0, self.list_db.pages)
+
+    def test_modified_since(self):
+        response = self.fetch('/list/1.csv', **{'If-Modified-Since': 'Fri, 01 Aug 2014 12:30:14 GMT'})
+        self.assertEqual(200, response.code)
+
+    def test_private_list_not_shared(self):
+        self.list_db.public = False
+        with mock.patch.object(wordlist.WordListHandler, 'get_current_user', return_value='1'):
+            response = self.fetch('/list/1.csv')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual('private', response.headers['Cache-Control'])
+
+
+class ConditionalFeedTest(support.UITestCase):
+    def setUp(self):
+        self.list_db = PagedListData(3)
+        self.list_db.get_lists = mock.Mock(wraps=self.list_db.get_lists)
+        super(ConditionalFeedTest, self).setUp()
+
+    def get_handlers(self):
+        return [(r'/', wordlist.IndexHandler, dict(list_db=self.list_db)),
+                (r'/atom.xml', wordlist.AtomHandler, dict(list_db=self.list_db))]
+
+    def fetch(self, path, **headers):
+        self.http_client.fetch(self.get_url(path), self.stop, headers=headers)
+        return self.wait()
+
+    def test_atom_not_modified(self):
+        etag = self.fetch('/atom.xml').headers['Etag']
+        response = self.fetch('/atom.xml', **{'If-None-Match': etag})
+
+        self.assertEqual(304, response.code)
+        self.assertEqual(1, self.list_db.get_lists.call_count)
+
+    def test_atom_pages_differ(self):
+        etag = self.fetch('/atom.xml').headers['Etag']
+        response = self.fetch('/atom.xml?before=2014-08-01T12:30:00.000000_2',
+                              **{'If-None-Match': etag})
+        self.assertEqual(200, response.code)
+
+    def test_atom_changes_when_list_removed(self):
+        etag = self.fetch('/atom.xml').headers['Etag']
+        self.list_db.count = 2
+
+        self.assertEqual(200, self.fetch('/atom.xml', **{'If-None-Match': etag}).code)
+
+    def test_index_not_modified(self):
+        etag = self.fetch('/').headers['Etag']
+        self.assertNotEqual(etag, self.fetch('/atom.xml').headers['Etag'])
+
+        response = self.fetch('/', **{'If-Modified-Since': 'Fri, 01 Aug 2014 12:30:00 GMT'})
+        self.assertEqual(304, response.code)
+
+
+class PageCacheTest(support.UITestCase):
+    def setUp(self):
+        class ListData:
+            modified_at = datetime.datetime(2014, 8, 1, 12, 30)
+            calls = 0
+
+            def get_list_info(self, list_id, callback):
+                callback({'id': list_id, 'title': 'list_%d' % list_id, 'public': True,
+                          'account_id': 1, 'modified_at': self.modified_at, 'word_count': 2})
+
+            def get_word_list(self, list_id, callback, list_info=None):
+                self.calls += 1
+                callback(dict(list_info, words=[['大', 'da', ['big']]]))
+
+            def get_list_words(self, list_id, callback, after_position=-1, limit=None):
+                self.calls += 1
+                callback({'words': [['大', 'da', ['big']], ['小', 'xiao', ['small']]],
+                          'next_position': None})
+
+        self.list_db = ListData()
+        self.page_cache = cache.LRUCache(1024 * 1024, sizeof=len)
+        super(PageCacheTest, self).setUp()
+
+    def get_handlers(self):
+        return [(r'/list/([0-9]+)[^\.]*(\.?\w*)',
+                 wordlist.WordListHandler,
+                 dict(list_db=self.list_db, page_cache=self.page_cache))]
+
+    def fetch(self, path, **kwargs):
+        self.http_client.fetch(self.get_url(path), self.stop, **kwargs)
+        return self.wait()
+
+    def test_export_cached(self):
+        first = self.fetch('/list/1.csv')
+        second = self.fetch('/list/1.csv')
+
+        self.assertEqual(1, self.list_db.calls)
+        self.assertEqual('"大","da","big"\n"小","xiao","small"\n', second.body.decode('utf-8'))
+        self.assertEqual(first.body, second.body)
+        self.assertIn('text/csv', second.headers['Content-Type'])
+        self.assertEqual(1, self.page_cache.stats()['hits'])
+
+    def test_gzip_sent_when_accepted(self):
+        for _ in range(2):
+            response = self.fetch('/list/1.csv', use_gzip=False,
+                                  headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual('gzip', response.headers['Content-Encoding'])
+            self.assertEqual(b'"\xe5\xa4\xa7","da","big"\n"\xe5\xb0\x8f","xiao","small"\n',
+                             gzip.decompress(response.body))
+
+    def test_plain_from_cache(self):
+        self.fetch('/list/1.tsv')
+        response = self.fetch('/list/1.tsv', use_gzip=False)
+
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'xiao', response.body)
+        self.assertEqual(1, self.list_db.calls)
+
+    def test_etag_differs_by_encoding(self):
+        plain = self.fetch('/list/1.csv', use_gzip=False)
+        gzipped = self.fetch('/list/1.csv')
+
+        self.assertNotEqual(plain.headers['Etag'], gzipped.headers['Etag'])
+
+    def test_modified_list_not_from_cache(self):
+        self.fetch('/list/1.csv')
+        self.list_db.modified_at += datetime.timedelta(seconds=1)
+        self.fetch('/list/1.csv')
+
+        self.assertEqual(2, self.list_db.calls)
+
+    def test_large_page_not_cached(self):
+        with mock.patch.object(wordlist, 'PAGE_CACHE_MAX_ENTRY_BYTES', 10):
+            response = self.fetch('/list/1.csv')
+
+        self.assertIn(b'xiao', response.body)
+        self.assertEqual(0, len(self.page_cache))
+
+    def test_anonymous_page_cached(self):
+        first = self.fetch('/list/1')
+        second = self.fetch('/list/1')
+
+        self.assertEqual(1, self.list_db.calls)
+        self.assertIn(b'list_1', second.body)
+        self.assertEqual(first.body, second.body)
+
+    def test_page_cached_per_path(self):
+        self.fetch('/list/1')
+        response = self.fetch('/list/1-stub')
+
+        self.assertEqual(2, self.list_db.calls)
+        self.assertIn(b"'/list/1-stub.csv'", response.body)
+        self.assertNotIn(b"'/list/1.csv'", response.body)
+
+    def test_logged_in_page_not_cached(self):
+        with mock.patch.object(wordlist.WordListHandler, 'get_current_user', return_value='1'):
+            self.fetch('/list/1')
+            response = self.fetch('/list/1', use_gzip=False, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(2, self.list_db.calls)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(0, len(self.page_cache))
+
+
+class AddDescriptionTest(unittest.TestCase):
+    def test_word_not_modified(self):
+        word = ['大', 'da', ['big', 'large']]
+        self.assertEqual(['大', 'da', ['big', 'large'], 'big; large'],
+                         wordlist.add_description(word))
+        self.assertEqual(3, len(word))
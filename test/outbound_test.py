@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import tornado.ioloop
+import tornado.web
+import unittest
+
+from cihui import outbound
+from tornado.testing import AsyncHTTPTestCase
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = outbound.CircuitBreaker(threshold=3, reset_timeout=30, clock=self.clock)
+
+    def test_opens_after_failures_in_a_row(self):
+        for failed in [True, True, False, True, True]:
+            self.breaker.record(failed)
+        self.assertEqual('closed', self.breaker.state)
+
+        self.breaker.record(True)
+        self.assertEqual('open', self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(1, self.breaker.opened)
+
+    def test_trial_request_after_reset_timeout(self):
+        for _ in range(3):
+            self.breaker.record(True)
+
+        self.clock.now += 30
+        self.assertEqual('half-open', self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(False)
+        self.assertEqual('closed', self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_opens_again(self):
+        for _ in range(3):
+            self.breaker.record(True)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record(True)
+        self.assertEqual('open', self.breaker.state)
+        self.assertEqual(2, self.breaker.opened)
+
+
+class FlakyHandler(tornado.web.RequestHandler):
+    "Fails the first failures requests with a 503"
+    def initialize(self, server):
+        self.server = server
+
+    def get(self):
+        self.server.hits += 1
+        if self.server.hits <= self.server.failures:
+            self.set_status(503)
+        self.write('hit %d' % self.server.hits)
+
+    post = get
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    @tornado.web.asynchronous
+    def get(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.add_timeout(io_loop.time() + 0.5, self.finish)
+
+
+class TestClient(AsyncHTTPTestCase):
+    def get_app(self):
+        self.hits = 0
+        self.failures = 0
+        return tornado.web.Application([(r'/flaky', FlakyHandler, dict(server=self)),
+                                        (r'/slow', SlowHandler)])
+
+    def setUp(self):
+        AsyncHTTPTestCase.setUp(self)
+        self.clock = Clock()
+        self.client = outbound.Client('test', retries=2, backoff=0.01, io_loop=self.io_loop,
+                                      breaker=outbound.CircuitBreaker(3, 30, clock=self.clock))
+
+    def fetch(self, path, **kwargs):
+        self.client.fetch(self.get_url(path), self.stop, **kwargs)
+        return self.wait()
+
+    def test_fetch(self):
+        response = self.fetch('/flaky')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual(b'hit 1', response.body)
+        stats = self.client.stats()
+        self.assertEqual(1, stats['requests'])
+        self.assertEqual(1, stats['latency']['samples'])
+        self.assertGreater(stats['latency']['p95_ms'], 0)
+
+    def test_retries_idempotent_request(self):
+        self.failures = 2
+        response = self.fetch('/flaky')
+
+        self.assertEqual(200, response.code)
+        self.assertEqual(3, self.hits)
+        self.assertEqual(2, self.client.stats()['retried'])
+
+    def test_gives_up_after_retries(self):
+        self.failures = 5
+        response = self.fetch('/flaky')
+
+        self.assertEqual(503, response.code)
+        self.assertEqual(3, self.hits)
+
+    def test_does_not_retry_post(self):
+        self.failures = 1
+        response = self.fetch('/flaky', method='POST', body='')
+
+        self.assertEqual(503, response.code)
+        self.assertEqual(1, self.hits)
+
+    def test_does_not_retry_when_not_idempotent(self):
+        self.failures = 1
+        response = self.fetch('/flaky', idempotent=False)
+
+        self.assertEqual(503, response.code)
+        self.assertEqual(1, self.hits)
+
+    def test_request_timeout(self):
+        self.client.retries = 0
+        response = self.fetch('/slow', request_timeout=0.05)
+
+        self.assertEqual(599, response.code)
+        self.assertEqual(1, self.client.stats()['failures'])
+
+    def test_default_timeouts(self):
+        self.client.request_timeout = 0.05
+        self.client.retries = 0
+
+        self.assertEqual(599, self.fetch('/slow').code)
+
+    def test_breaker_fails_fast(self):
+        self.failures = 100
+        self.fetch('/flaky')
+        self.assertEqual('open', self.client.stats()['breaker'])
+        self.assertEqual(3, self.hits)
+
+        response = self.fetch('/flaky')
+        self.assertEqual(599, response.code)
+        self.assertIsInstance(response.error, outbound.CircuitOpenError)
+        self.assertEqual(3, self.hits)
+        self.assertEqual(1, self.client.stats()['rejected'])
+
+        self.failures = 0
+        self.clock.now += 30
+        self.assertEqual(200, self.fetch('/flaky').code)
+        self.assertEqual('closed', self.client.stats()['breaker'])
+
+    def test_rate_spaces_requests(self):
+        self.client.rate = 20
+        responses = []
+
+        def got_response(response):
+            responses.append(response)
+            if len(responses) == 3:
+                self.stop()
+
+        started = self.io_loop.time()
+        for _ in range(3):
+            self.client.fetch(self.get_url('/flaky'), got_response)
+        self.wait()
+
+        self.assertEqual([200] * 3, [response.code for response in responses])
+        self.assertGreaterEqual(self.io_loop.time() - started, 0.1)
+        self.assertEqual(2, self.client.stats()['delayed'])
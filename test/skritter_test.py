@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import datetime
+import json
+import mock
+import tornado.ioloop
+import tornado.web
+import unittest
+import urllib.parse
+
+from cihui import outbound
+from cihui import skritter
+from cihui.data import account
+from cihui.data import fake
+from cihui.data import wordlist
+from tornado.httpclient import HTTPError
+from tornado.testing import AsyncHTTPTestCase
+
+
+class FakeHTTPClient(object):
+    def __init__(self):
+        self.requests = []
+
+    def fetch(self, request, callback, idempotent=True):
+        self.requests.append((request, callback))
+        self.idempotent = idempotent
+
+    def respond(self, code=200, body=None):
+        for request, callback in self.requests:
+            response = mock.Mock(code=code, error=None if code == 200 else HTTPError(code),
+                                 body=json.dumps(body).encode('utf-8'))
+            callback(response)
+        self.requests = []
+
+
+def make_account(expires_in=None, access_token='old', refresh_token='refresh'):
+    expiry = None
+    if expires_in is not None:
+        expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
+
+    return {'account_id': 1, 'skritter_user': 'skuser', 'skritter_access_token': access_token,
+            'skritter_refresh_token': refresh_token, 'skritter_token_expiry': expiry}
+
+
+class TestTokenRequest(unittest.TestCase):
+    def test_token_request(self):
+        request = skritter.token_request('id', 'secret', {'grant_type': 'refresh_token'})
+        url, _, query = request.url.partition('?')
+
+        self.assertEqual(skritter.TOKEN_URL, url)
+        self.assertEqual({'grant_type': ['refresh_token'], 'client_id': ['id'],
+                          'client_secret': ['secret']},
+                         urllib.parse.parse_qs(query))
+        self.assertEqual(b'basic aWQ6c2VjcmV0', request.headers['AUTHORIZATION'])
+
+    def test_authorize_url(self):
+        url, _, query = skritter.authorize_url('id', 'http://example.com/auth').partition('?')
+
+        self.assertEqual(skritter.AUTHORIZE_URL, url)
+        self.assertEqual({'response_type': ['code'], 'client_id': ['id'],
+                          'redirect_uri': ['http://example.com/auth']},
+                         urllib.parse.parse_qs(query))
+
+    def test_parse_token_response(self):
+        token = skritter.parse_token_response(
+            b'{"user_id": "skuser", "access_token": "new", "expires_in": 3600}', 'refresh')
+
+        self.assertEqual('new', token['access_token'])
+        self.assertEqual('refresh', token['refresh_token'])
+        self.assertAlmostEqual(3600, (token['expiry'] - datetime.datetime.utcnow()).total_seconds(),
+                               delta=5)
+
+
+class TestTokenManager(unittest.TestCase):
+    def setUp(self):
+        self.account_db = mock.Mock()
+        self.account_db.store_skritter_token.side_effect = lambda *args: args[-1](None)
+        self.http_client = FakeHTTPClient()
+        self.tokens = skritter.TokenManager(self.account_db, 'id', 'secret', self.http_client)
+        self.callback = mock.Mock()
+
+    def test_valid_token_not_refreshed(self):
+        self.tokens.get_token(make_account(expires_in=3600), self.callback)
+
+        self.assertEqual([], self.http_client.requests)
+        self.assertEqual('old', self.callback.call_args[0][0]['access_token'])
+
+    def test_expiring_token_refreshed(self):
+        self.tokens.get_token(make_account(expires_in=60), self.callback)
+        self.assertEqual(1, len(self.http_client.requests))
+        self.assertIn('refresh_token=refresh', self.http_client.requests[0][0].url)
+        self.assertFalse(self.http_client.idempotent)
+
+        self.http_client.respond(body={'user_id': 'skuser', 'access_token': 'new',
+                                       'refresh_token': 'refresh2', 'expires_in': 3600})
+
+        token = self.callback.call_args[0][0]
+        self.assertEqual('new', token['access_token'])
+        args = self.account_db.store_skritter_token.call_args[0]
+        self.assertEqual((1, 'skuser', 'new', 'refresh2', token['expiry']), args[:5])
+
+    def test_concurrent_refreshes_shared(self):
+        callbacks = [mock.Mock() for _ in range(3)]
+        for callback in callbacks:
+            self.tokens.get_token(make_account(), callback)
+
+        self.assertEqual(1, len(self.http_client.requests))
+        self.http_client.respond(body={'access_token': 'new', 'expires_in': 3600})
+
+        for callback in callbacks:
+            self.assertEqual('new', callback.call_args[0][0]['access_token'])
+        self.assertEqual(1, self.account_db.store_skritter_token.call_count)
+        self.assertEqual({'refreshes': 1, 'coalesced': 2, 'failures': 0, 'pending': 0},
+                         dict((key, value) for key, value in self.tokens.stats().items()
+                              if key != 'tokens'))
+
+    def test_cached_token_used(self):
+        self.tokens.get_token(make_account(expires_in=60), self.callback)
+        self.http_client.respond(body={'access_token': 'new', 'expires_in': 3600})
+
+        # The account is stale, as if it were read before the refresh was stored
+        self.tokens.get_token(make_account(expires_in=60), self.callback)
+
+        self.assertEqual([], self.http_client.requests)
+        self.assertEqual('new', self.callback.call_args[0][0]['access_token'])
+
+    def test_newer_stored_token_used(self):
+        self.tokens.get_token(make_account(expires_in=60), self.callback)
+        self.http_client.respond(body={'access_token': 'new', 'expires_in': 600})
+
+        self.tokens.get_token(make_account(expires_in=7200, access_token='reauthorized'),
+                              self.callback)
+
+        self.assertEqual('reauthorized', self.callback.call_args[0][0]['access_token'])
+
+    def test_refresh_failed(self):
+        callbacks = [mock.Mock(), mock.Mock()]
+        for callback in callbacks:
+            self.tokens.get_token(make_account(), callback)
+        self.http_client.respond(code=401, body={})
+
+        for callback in callbacks:
+            callback.assert_called_once_with(None)
+        self.assertFalse(self.account_db.store_skritter_token.called)
+        self.assertEqual(1, self.tokens.stats()['failures'])
+
+        self.tokens.get_token(make_account(), self.callback)
+        self.assertEqual(1, len(self.http_client.requests))
+
+    def test_no_refresh_token(self):
+        self.tokens.get_token(make_account(refresh_token=None), self.callback)
+
+        self.callback.assert_called_once_with(None)
+        self.assertEqual([], self.http_client.requests)
+
+    def test_token_not_stored(self):
+        self.account_db.store_skritter_token.side_effect = lambda *args: args[-1]('Error')
+
+        self.tokens.get_token(make_account(), self.callback)
+        self.http_client.respond(body={'access_token': 'new', 'expires_in': 3600})
+
+        self.assertEqual('new', self.callback.call_args[0][0]['access_token'])
+
+    def test_authorize(self):
+        self.tokens.authorize(1, 'code', 'http://example.com/skritter/auth', self.callback)
+
+        url = self.http_client.requests[0][0].url
+        self.assertIn('grant_type=authorization_code', url)
+        self.assertIn('code=code', url)
+        self.assertFalse(self.http_client.idempotent)
+
+        self.http_client.respond(body={'user_id': 'skuser', 'access_token': 'new',
+                                       'refresh_token': 'refresh', 'expires_in': 3600})
+
+        self.assertEqual('new', self.callback.call_args[0][0]['access_token'])
+        self.assertEqual((1, 'skuser', 'new', 'refresh'),
+                         self.account_db.store_skritter_token.call_args[0][:4])
+
+    def test_authorize_not_stored(self):
+        self.account_db.store_skritter_token.side_effect = lambda *args: args[-1]('Error')
+
+        self.tokens.authorize(1, 'code', None, self.callback)
+        self.http_client.respond(body={'access_token': 'new', 'expires_in': 3600})
+
+        self.callback.assert_called_once_with(None)
+
+    def test_authorize_failed(self):
+        self.tokens.authorize(1, 'code', None, self.callback)
+        self.http_client.respond(code=400, body={})
+
+        self.callback.assert_called_once_with(None)
+        self.assertFalse(self.account_db.store_skritter_token.called)
+
+
+class FakeTokenHandler(tornado.web.RequestHandler):
+    "Skritter's token endpoint, answering after a short delay"
+    def initialize(self, endpoint):
+        self.endpoint = endpoint
+
+    @tornado.web.asynchronous
+    def get(self):
+        refresh_token = self.get_argument('refresh_token')
+        self.endpoint.requests.append(refresh_token)
+        self.endpoint.active += 1
+        self.endpoint.max_active = max(self.endpoint.max_active, self.endpoint.active)
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.add_timeout(io_loop.time() + 0.01, lambda: self.respond(refresh_token))
+
+    def respond(self, refresh_token):
+        self.endpoint.active -= 1
+        if refresh_token.startswith('revoked'):
+            self.set_status(401)
+        else:
+            self.write({'access_token': 'new ' + refresh_token, 'expires_in': 86400})
+        self.finish()
+
+
+class TestRefreshScheduler(AsyncHTTPTestCase):
+    def get_app(self):
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        return tornado.web.Application([(r'/oauth2/token', FakeTokenHandler,
+                                         dict(endpoint=self))])
+
+    def setUp(self):
+        AsyncHTTPTestCase.setUp(self)
+        self.db = fake.FakeDatabase(ioloop=self.io_loop)
+        self.account_db = account.AccountData('', self.db)
+        self.tokens = skritter.TokenManager(self.account_db, 'id', 'secret',
+                                            outbound.Client('skritter', io_loop=self.io_loop),
+                                            token_url=self.get_url('/oauth2/token'))
+        self.scheduler = skritter.RefreshScheduler(self.account_db, self.tokens, interval=0.05,
+                                                   concurrency=3, io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        AsyncHTTPTestCase.tearDown(self)
+
+    def add_account(self, refresh_token, expires_in):
+        account_id = self.db.add_account('%s@example.com' % refresh_token.replace(' ', '.'))
+        self.db.accounts[account_id].update(
+            skritter_access_token='old', skritter_refresh_token=refresh_token,
+            skritter_token_expiry=datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in))
+        return account_id
+
+    def wait_for_checks(self, checks):
+        def poll():
+            if self.scheduler.checks >= checks and self.scheduler.active == 0:
+                self.stop()
+            else:
+                self.io_loop.add_timeout(self.io_loop.time() + 0.01, poll)
+
+        poll()
+        self.wait(timeout=5)
+
+    def test_refreshes_expiring_tokens(self):
+        expiring = [self.add_account('refresh %d' % n, 600) for n in range(8)]
+        fresh = self.add_account('fresh', 86400)
+
+        self.scheduler.start()
+        self.wait_for_checks(3)
+
+        for account_id in expiring:
+            row = self.db.accounts[account_id]
+            self.assertEqual('new ' + row['skritter_refresh_token'], row['skritter_access_token'])
+        self.assertEqual('old', self.db.accounts[fresh]['skritter_access_token'])
+
+        self.assertEqual(8, len(self.requests))
+        self.assertLessEqual(self.max_active, 3)
+        self.assertGreater(self.max_active, 1)
+        self.assertEqual(8, self.scheduler.stats()['refreshed'])
+
+    def test_failed_refresh_not_retried_at_once(self):
+        revoked = self.add_account('revoked', 600)
+
+        self.scheduler.start()
+        self.wait_for_checks(3)
+
+        self.assertEqual(['revoked'], self.requests)
+        self.assertEqual('old', self.db.accounts[revoked]['skritter_access_token'])
+        self.assertEqual(1, self.scheduler.stats()['failed'])
+        self.assertEqual(1, self.scheduler.stats()['retrying'])
+
+    def test_failing_accounts_do_not_block_others(self):
+        self.scheduler.batch_size = 2
+        revoked = [self.add_account('revoked %d' % n, -600) for n in range(3)]
+        expiring = self.add_account('expiring', 600)
+
+        self.scheduler.start()
+        self.wait_for_checks(3)
+
+        self.assertEqual('new expiring', self.db.accounts[expiring]['skritter_access_token'])
+        self.assertEqual(3, self.scheduler.stats()['retrying'])
+        self.assertEqual(len(revoked) + 1, len(self.requests))
+
+    def test_stop(self):
+        self.scheduler.start()
+        self.scheduler.stop()
+
+        self.io_loop.add_timeout(self.io_loop.time() + 0.1, self.stop)
+        self.wait()
+        self.assertEqual(0, self.scheduler.checks)
+
+
+class FakeSkritterHandler(tornado.web.RequestHandler):
+    "Stands in for the Skritter vocab list API"
+    def initialize(self, server):
+        self.server = server
+
+    def prepare(self):
+        self.server.requests.append((self.request.method, self.request.path))
+        self.server.authorization.add(self.request.headers.get('Authorization'))
+
+    def get(self):
+        ids = self.get_argument('ids').split('|')
+        self.write({'Vocabs': [{'id': vocab_id} for vocab_id in ids
+                               if vocab_id not in self.server.missing]})
+
+    def post(self, list_id=None):
+        if list_id is None:
+            self.write({'VocabList': {'id': 'sk1'}})
+            return
+
+        if len(self.server.sections) + 1 == self.server.fail_section:
+            self.server.fail_section = None
+            self.set_status(500)
+            return
+
+        section = json.loads(self.request.body.decode('utf-8'))
+        self.server.sections.append((list_id, section['name'],
+                                     [row['vocabId'] for row in section['rows']]))
+        self.write({'VocabListSection': {'id': len(self.server.sections)}})
+
+
+class TestListPusher(AsyncHTTPTestCase):
+    def get_app(self):
+        self.requests = []
+        self.authorization = set()
+        self.sections = []
+        self.missing = {'zh-字3-0'}
+        self.fail_section = None
+        return tornado.web.Application([(r'/vocablists', FakeSkritterHandler, dict(server=self)),
+                                        (r'/vocablists/(\w+)/sections', FakeSkritterHandler,
+                                         dict(server=self)),
+                                        (r'/vocabs', FakeSkritterHandler, dict(server=self))])
+
+    def setUp(self):
+        AsyncHTTPTestCase.setUp(self)
+        self.db = fake.FakeDatabase(ioloop=self.io_loop)
+        self.account_id = self.db.add_account('user@example.com')
+        self.db.accounts[self.account_id].update(
+            skritter_access_token='access', skritter_refresh_token='refresh',
+            skritter_token_expiry=datetime.datetime.utcnow() + datetime.timedelta(days=1))
+        self.list_id = self.db.add_list('Words', [['字%d' % n, 'zi', []] for n in range(5)],
+                                        self.account_id)
+
+        self.list_db = wordlist.WordListData('', self.db)
+        self.account_db = account.AccountData('', self.db)
+        self.skritter_http = outbound.Client('skritter', rate=50, io_loop=self.io_loop)
+        self.tokens = skritter.TokenManager(self.account_db, 'id', 'secret', self.skritter_http)
+        self.pusher = skritter.ListPusher(self.list_db, self.account_db, self.tokens,
+                                          self.skritter_http, api_url=self.get_url(''),
+                                          interval=0.05, batch_size=2, io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.pusher.stop()
+        AsyncHTTPTestCase.tearDown(self)
+
+    def push(self):
+        self.list_db.queue_skritter_push(self.list_id, self.account_id, self.stop)
+        push_id = self.wait()['id']
+
+        def poll():
+            if (self.db.skritter_pushes[push_id]['status'] in ('done', 'failed') and
+                    self.pusher.stats()['pushing'] is None):
+                self.stop()
+            else:
+                self.io_loop.add_timeout(self.io_loop.time() + 0.01, poll)
+
+        self.pusher.start()
+        poll()
+        self.wait(timeout=5)
+        self.pusher.stop()
+        return self.db.skritter_pushes[push_id]
+
+    def test_pushes_list_in_batches(self):
+        push = self.push()
+
+        self.assertEqual(('done', 'sk1', 5), (push['status'], push['skritter_list_id'],
+                                              push['pushed']))
+        self.assertEqual([('sk1', 'Words 1-2', ['zh-字0-0', 'zh-字1-0']),
+                          ('sk1', 'Words 3-4', ['zh-字2-0']),
+                          ('sk1', 'Words 5-5', ['zh-字4-0'])], self.sections)
+        self.assertEqual([('字%d' % n, 'not_found' if n == 3 else 'added') for n in range(5)],
+                         [self.db.skritter_push_words[push['id']][n] for n in range(5)])
+        self.assertEqual({'bearer access'}, self.authorization)
+
+        self.assertEqual(1, self.pusher.stats()['pushed'])
+        self.assertEqual(5, self.pusher.stats()['words'])
+        self.assertGreater(self.skritter_http.stats()['delayed'], 0)
+
+    def test_resumes_failed_push(self):
+        self.fail_section = 2
+        push = self.push()
+
+        self.assertEqual(('failed', 1, 2), (push['status'], push['position'], push['pushed']))
+        self.assertIn('/sections', push['error'])
+
+        del self.requests[:]
+        push = self.push()
+
+        self.assertEqual(('done', 5), (push['status'], push['pushed']))
+        self.assertNotIn(('POST', '/vocablists'), self.requests)
+        self.assertEqual(['Words 1-2', 'Words 3-4', 'Words 5-5'],
+                         [section[1] for section in self.sections])
+
+    def test_last_batch_saved_with_push_done(self):
+        self.list_db.finish_skritter_push = mock.Mock()
+        push = self.push()
+
+        self.assertEqual(('done', 5), (push['status'], push['pushed']))
+        self.assertFalse(self.list_db.finish_skritter_push.called)
+        self.assertEqual(1, self.pusher.stats()['pushed'])
+
+    def test_exception_fails_push(self):
+        self.account_db.get_accounts = mock.Mock(side_effect=RuntimeError('boom'))
+        push = self.push()
+
+        self.assertEqual(('failed', 'Internal error: boom'), (push['status'], push['error']))
+        self.assertIsNone(self.pusher.stats()['pushing'])
+
+        del self.account_db.get_accounts
+        push = self.push()
+        self.assertEqual(('done', 5), (push['status'], push['pushed']))
+
+    def test_fails_without_token(self):
+        self.db.accounts[self.account_id].update(skritter_access_token=None,
+                                                 skritter_refresh_token=None)
+        push = self.push()
+
+        self.assertEqual(('failed', 'No Skritter token'), (push['status'], push['error']))
+        self.assertEqual([], self.requests)
+        self.assertEqual(1, self.pusher.stats()['failed'])
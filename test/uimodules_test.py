@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+import os
+import tornado.httpserver
+import tornado.template
+import tornado.web
+import unittest
+
+from cihui import uimodules
+
+
+class WordListTest(unittest.TestCase):
+    def setUp(self):
+        template_path = os.path.join(os.path.dirname(__file__), '../templates')
+        application = tornado.web.Application(template_path=template_path,
+                                              ui_modules=uimodules)
+        request = tornado.httpserver.HTTPRequest('GET', '/list/1')
+        self.handler = tornado.web.RequestHandler(application, request)
+
+    def render(self, source, words):
+        template = tornado.template.Template(source, name='test.html')
+        namespace = self.handler.get_template_namespace()
+        namespace['words'] = words
+        return template.generate(**namespace)
+
+    def assertSameAsWordEntries(self, words):
+        per_word = self.render('''
+{% for word_entry in words %}
+  {% module WordEntry(word_entry[0], word_entry[1], word_entry[3]) %}
+{% end %}
+''', words)
+        self.assertEqual(per_word, self.render('''
+{% module WordList(words) %}''', words))
+
+    def test_same_as_word_entries(self):
+        self.assertSameAsWordEntries([['大', 'da', ['big'], 'big'],
+                                      ['<&>', '"pin"', [], "'quoted'"]])
+
+    def test_no_words(self):
+        self.assertSameAsWordEntries([])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Geoff Wilson <gmwils@gmail.com>
+
+from cihui import upload
+
+import json
+import unittest
+
+
+class TestWordNormalizer(unittest.TestCase):
+    def setUp(self):
+        self.normalizer = upload.WordNormalizer()
+
+    def test_normalized(self):
+        self.assertEqual(['很', 'h\u00e9n', ['caf\u00e9']],
+                         self.normalizer.word(['很', 'he\u0301n', ['cafe\u0301']]))
+
+    def test_single_definition(self):
+        self.assertEqual(['大', 'dà', ['big']], self.normalizer.word(['大', 'dà', 'big']))
+
+    def test_definitions_shared(self):
+        first, second = self.normalizer.words([['大', 'dà', ['big'.upper().lower()]],
+                                               ['巨', 'jù', [''.join(['b', 'i', 'g'])]]])
+        self.assertIs(first[2][0], second[2][0])
+
+    def test_invalid_words(self):
+        invalid = [(['大', 'dà'], 'word'),
+                   ('大dà', 'word'),
+                   (['', 'dà', []], 'zi'),
+                   (['大', None, []], 'pinyin'),
+                   (['大', 'dà', [1]], 'definitions'),
+                   (['大', 'dà', [['big']]], 'definitions'),
+                   (['大', 'dà', {'big': 1}], 'definitions'),
+                   ({'zi': '大'}, 'word')]
+
+        for word, field in invalid:
+            with self.assertRaises(upload.WordError) as raised:
+                self.normalizer.word(word, 4)
+            self.assertEqual([{'word': 4, 'field': field}],
+                             [{'word': error['word'], 'field': error['field']}
+                              for error in raised.exception.errors])
+
+    def test_all_errors_in_word(self):
+        with self.assertRaises(upload.WordError) as raised:
+            self.normalizer.word(['', None, 'big'])
+        self.assertEqual(['zi', 'pinyin'], [error['field'] for error in raised.exception.errors])
+
+    def test_errors_across_words(self):
+        words = [['大', 'dà', []], ['大'], ['小', 'xiǎo', []], [1, 'x', []]]
+        with self.assertRaises(upload.WordError) as raised:
+            self.normalizer.words(words)
+        self.assertEqual([1, 3], [error['word'] for error in raised.exception.errors])
+
+    def test_max_errors(self):
+        with self.assertRaises(upload.WordError) as raised:
+            self.normalizer.words([[]] * 50, max_errors=5)
+        self.assertEqual(5, len(raised.exception.errors))
+
+    def test_words_must_be_list(self):
+        self.assertRaisesRegex(upload.WordError, '^words: must be a list$',
+                               self.normalizer.words, 'words')
+
+
+class TestWordParser(unittest.TestCase):
+    words = [['大', 'dà', ['big', 'say "hi"']], ['小', 'xiǎo', []], ['中', 'zhōng', ['middle']]]
+
+    def parse(self, body, slice_bytes=1, **kwargs):
+        parser = upload.WordParser(**kwargs)
+        for start in range(0, len(body), slice_bytes):
+            parser.feed(body[start:start + slice_bytes])
+        return parser.close()
+
+    def test_array_byte_at_a_time(self):
+        body = json.dumps(self.words, ensure_ascii=False).encode('utf-8')
+        self.assertEqual(self.words, self.parse(body))
+
+    def test_array_whitespace(self):
+        body = b' [\n ["\xe5\xa4\xa7", "da", []] ,\n["x", "y", []]\n]\n'
+        self.assertEqual([['大', 'da', []], ['x', 'y', []]], self.parse(body, slice_bytes=3))
+
+    def test_empty_array(self):
+        self.assertEqual([], self.parse(b'[ ]'))
+
+    def test_ndjson(self):
+        body = '\n'.join(json.dumps(word) for word in self.words).encode('utf-8')
+        self.assertEqual(self.words, self.parse(body, slice_bytes=5, ndjson=True))
+
+    def test_malformed_word_stops_parsing(self):
+        parser = upload.WordParser()
+        with self.assertRaisesRegex(upload.UploadError, r'Word 1 \(character 17\): word expected'):
+            parser.feed(b'[["a", "b", []], ["c"], ["d", ')
+
+    def test_invalid_json(self):
+        with self.assertRaisesRegex(upload.UploadError, 'Word 1 is not valid JSON'):
+            self.parse(b'[["a", "b", []], [nope]]', slice_bytes=100)
+
+    def test_missing_separator(self):
+        with self.assertRaisesRegex(upload.UploadError, 'Expected , or ] after word 0'):
+            self.parse(b'[["a", "b", []] ["c", "d", []]]')
+
+    def test_not_an_array(self):
+        self.assertRaises(upload.UploadError, self.parse, b'{"words": []}')
+
+    def test_trailing_data(self):
+        self.assertRaises(upload.UploadError, self.parse, b'[] []')
+
+    def test_truncated(self):
+        with self.assertRaisesRegex(upload.UploadError, 'ends before the closing'):
+            self.parse(b'[["a", "b", []]')
+
+    def test_ndjson_line_number(self):
+        with self.assertRaisesRegex(upload.UploadError, 'Line 3'):
+            self.parse(b'["a", "b", []]\n\n["c", \n', ndjson=True)
+
+    def test_not_utf8(self):
+        self.assertRaises(upload.UploadError, self.parse, b'[["\xff", "b", []]]')
+
+    def test_max_bytes(self):
+        parser = upload.WordParser(max_bytes=10)
+        self.assertRaises(upload.UploadError, parser.expect, 11)
+
+        parser.feed(b'[' * 10)
+        with self.assertRaises(upload.UploadError) as raised:
+            parser.feed(b'[')
+        self.assertEqual(413, raised.exception.status)
+
+    def test_word_too_long(self):
+        body = b'[["' + b'a' * upload.MAX_WORD_CHARS
+        self.assertRaises(upload.UploadError, self.parse, body, slice_bytes=1024)